@@ -0,0 +1,259 @@
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+# Ответы, после которых запрос имеет смысл повторить
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class QuotaExceededError(Exception):
+    """
+    Не удалось дождаться свободной квоты на запрос к API
+    """
+
+
+class TokenBucket:
+    """
+    Потокобезопасный ограничитель частоты запросов ("ведро токенов").
+
+    Токены восполняются равномерно со скоростью rate_per_minute, в ведре
+    помещается не больше capacity токенов - это допустимый всплеск.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate_per_minute (float): Сколько запросов в минуту разрешено в среднем
+            capacity (Optional[float]): Размер всплеска, по умолчанию четверть минутной квоты
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_minute / 4)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        Пытается взять токены без ожидания
+
+        Returns:
+            float: 0, если токены получены, иначе сколько секунд подождать до следующей попытки
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет, пока в ведре появятся токены
+
+        Args:
+            tokens (float): Сколько токенов взять
+            timeout (Optional[float]): Максимальное ожидание в секундах (None - без ограничения)
+
+        Returns:
+            bool: True, если токены получены, False по таймауту
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 64.0) -> float:
+    """
+    Экспоненциальная пауза с полным случайным разбросом (full jitter)
+
+    Args:
+        attempt (int): Номер повторной попытки, начиная с 0
+        base (float): Пауза первой попытки в секундах
+        cap (float): Верхняя граница паузы
+
+    Returns:
+        float: Пауза в секундах в диапазоне [0, min(cap, base * 2 ** attempt)]
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after_seconds(response: Any) -> Optional[float]:
+    """
+    Читает заголовок Retry-After из ответа, если он есть (секунды или HTTP дата)
+    """
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when is None:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def request_not_sent(error: Exception) -> bool:
+    """
+    True, если ошибка доказывает, что запрос не дошел до сервера
+    (таймаут или отказ при установке соединения)
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        # requests оборачивает MaxRetryError, причина которого - ошибка установки соединения
+        reason = error.args[0] if error.args else None
+        return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+    return False
+
+
+def _error_status(error: Exception) -> Optional[int]:
+    # gspread.exceptions.APIError и requests.HTTPError хранят ответ в .response
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """
+    True, если API отклонил запрос окончательно (4xx, кроме 429):
+    повтор того же запроса даст ту же ошибку
+    """
+    status = _error_status(error)
+    return status is not None and 400 <= status < 500 and status not in RETRYABLE_STATUS_CODES
+
+
+class QuotaGuard:
+    """
+    Обертка над вызовами Google Sheets API с учетом квот.
+
+    Чтения и записи расходуют отдельные ведра токенов (у Sheets API раздельные
+    минутные квоты), запросы версии файла к Drive API - свое ведро. Ответы 429
+    и 5xx, а также сетевые ошибки повторяются с экспоненциальной паузой и
+    разбросом; Retry-After учитывается. Добавление строк ('append') не
+    идемпотентно: после 5xx или обрыва ответа строки могли уже записаться,
+    поэтому оно повторяется только после 429 и ошибок, при которых запрос
+    точно не был отправлен. Счетчики доступны через stats() для мониторинга.
+    """
+
+    def __init__(self, read_per_minute: Optional[float] = None, write_per_minute: Optional[float] = None,
+                 max_retries: Optional[int] = None, max_wait: float = 120,
+                 drive_per_minute: Optional[float] = None):
+        """
+        Args:
+            read_per_minute (Optional[float]): Квота чтений в минуту, по умолчанию SHEETS_READ_PER_MINUTE (30)
+            write_per_minute (Optional[float]): Квота записей в минуту, по умолчанию SHEETS_WRITE_PER_MINUTE (30)
+            max_retries (Optional[int]): Число повторов, по умолчанию SHEETS_MAX_RETRIES (5)
+            max_wait (float): Сколько секунд вызов может ждать свободной квоты
+            drive_per_minute (Optional[float]): Запросов версии файла к Drive API в минуту,
+                по умолчанию SHEETS_DRIVE_PER_MINUTE (60)
+        """
+        if read_per_minute is None:
+            read_per_minute = float(os.getenv('SHEETS_READ_PER_MINUTE', '30'))
+        if write_per_minute is None:
+            write_per_minute = float(os.getenv('SHEETS_WRITE_PER_MINUTE', '30'))
+        if max_retries is None:
+            max_retries = int(os.getenv('SHEETS_MAX_RETRIES', '5'))
+        if drive_per_minute is None:
+            drive_per_minute = float(os.getenv('SHEETS_DRIVE_PER_MINUTE', '60'))
+        write_bucket = TokenBucket(write_per_minute)
+        self.buckets = {
+            'read': TokenBucket(read_per_minute),
+            'write': write_bucket,
+            # Добавление строк расходует ту же квоту записей
+            'append': write_bucket,
+            'drive': TokenBucket(drive_per_minute),
+        }
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self._counters = {
+            'calls': 0,
+            'throttled': 0,
+            'retries': 0,
+            'quota_errors': 0,
+            'failures': 0,
+        }
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._counters_lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Счетчики вызовов: всего, ожидавших квоту, повторов, ответов 429, окончательных ошибок
+        """
+        with self._counters_lock:
+            return dict(self._counters)
+
+    def call(self, kind: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        Выполняет вызов API в пределах квоты с повторами
+
+        Args:
+            kind (str): 'read', 'write' (идемпотентная запись), 'append' (добавление строк) или 'drive'
+            func (Callable): Вызываемая функция gspread
+            *args, **kwargs: Аргументы функции
+
+        Returns:
+            Any: Результат функции
+        """
+        bucket = self.buckets[kind]
+        self._count('calls')
+        attempt = 0
+        while True:
+            if bucket.try_acquire() > 0:
+                self._count('throttled')
+                if not bucket.acquire(timeout=self.max_wait):
+                    self._count('failures')
+                    raise QuotaExceededError(f"Квота Google Sheets ({kind}) исчерпана, ожидание превысило {self.max_wait} с")
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                status = _error_status(e)
+                if kind == 'append':
+                    # Повтор добавления после 5xx или таймаута ответа может записать строки дважды
+                    retryable = status == 429 or request_not_sent(e)
+                else:
+                    network_error = isinstance(e, (requests.ConnectionError, requests.Timeout))
+                    retryable = status in RETRYABLE_STATUS_CODES or network_error
+                if not retryable:
+                    raise
+                if status == 429:
+                    self._count('quota_errors')
+                if attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+                delay = retry_after_seconds(getattr(e, 'response', None))
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                self._count('retries')
+                print(f"Google Sheets API: ошибка {status or type(e).__name__}, повтор через {delay:.1f} с")
+                time.sleep(delay)
+                attempt += 1
@@ -0,0 +1,197 @@
+import os
+import random
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна
+    fcntl = None
+
+
+def _utcnow() -> datetime:
+    # google-auth хранит expiry как наивное время UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class CredentialManager:
+    """
+    Общий для всех процессов бота менеджер OAuth токена Google (token.json).
+
+    Токен обновляется заранее, до истечения, в фоновом потоке. Запись файла
+    атомарная (временный файл + os.replace) и выполняется под файловой
+    блокировкой: процесс, получивший блокировку вторым, сначала перечитывает
+    файл и берет уже обновленный соседом токен вместо повторного обновления.
+    Объект Credentials обновляется на месте, поэтому gspread и сессии,
+    созданные с ним, сразу используют новый токен.
+    """
+
+    def __init__(self, token_file: str, scopes: List[str], refresh_margin: Optional[float] = None,
+                 poll_interval: float = 60):
+        """
+        Args:
+            token_file (str): Путь к token.json
+            scopes (List[str]): Области доступа OAuth
+            refresh_margin (Optional[float]): За сколько секунд до истечения обновлять токен.
+                По умолчанию берется из GOOGLE_TOKEN_REFRESH_MARGIN (300).
+            poll_interval (float): Период проверки токена и файла в фоновом потоке, секунды
+        """
+        self.token_file = token_file
+        self.lock_file = token_file + '.lock'
+        self.scopes = scopes
+        if refresh_margin is None:
+            refresh_margin = float(os.getenv('GOOGLE_TOKEN_REFRESH_MARGIN', '300'))
+        self.refresh_margin = refresh_margin
+        self.poll_interval = poll_interval
+        self.creds: Optional[Credentials] = None
+        self._file_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @contextmanager
+    def _file_lock(self):
+        """
+        Эксклюзивная блокировка token.json между процессами
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_file(self) -> Optional[Credentials]:
+        if not os.path.exists(self.token_file):
+            return None
+        creds = Credentials.from_authorized_user_file(self.token_file, self.scopes)
+        self._file_mtime = os.path.getmtime(self.token_file)
+        return creds
+
+    def _write_file(self, creds: Credentials) -> None:
+        """
+        Атомарно записывает токен: читатели видят либо старый, либо новый файл целиком
+        """
+        directory = os.path.dirname(os.path.abspath(self.token_file))
+        fd, tmp_path = tempfile.mkstemp(prefix='.token.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                tmp.write(creds.to_json())
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, self.token_file)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._file_mtime = os.path.getmtime(self.token_file)
+
+    def _adopt(self, other: Credentials) -> None:
+        """
+        Переносит токен в текущий объект Credentials, не заменяя сам объект
+        """
+        if self.creds is None:
+            self.creds = other
+        else:
+            self.creds.token = other.token
+            self.creds.expiry = other.expiry
+
+    def _expires_soon(self, creds: Optional[Credentials]) -> bool:
+        if creds is None or not creds.token:
+            return True
+        if creds.expiry is None:
+            return False
+        return (creds.expiry - _utcnow()).total_seconds() <= self.refresh_margin
+
+    def load(self) -> Optional[Credentials]:
+        """
+        Загружает токен из файла
+
+        Returns:
+            Optional[Credentials]: Учетные данные или None, если файла нет
+        """
+        with self._lock:
+            creds = self._read_file()
+            if creds is not None:
+                self._adopt(creds)
+            return self.creds
+
+    def save(self, creds: Credentials) -> None:
+        """
+        Сохраняет новые учетные данные (например, после браузерной авторизации)
+        """
+        with self._lock, self._file_lock():
+            self._adopt(creds)
+            self._write_file(self.creds)
+
+    def refresh(self) -> Credentials:
+        """
+        Обновляет токен, если соседний процесс еще не сделал этого
+
+        Returns:
+            Credentials: Действительные учетные данные
+        """
+        with self._lock, self._file_lock():
+            # Пока ждали блокировку, токен мог обновить другой процесс
+            on_disk = self._read_file()
+            if on_disk is not None and not self._expires_soon(on_disk):
+                self._adopt(on_disk)
+                return self.creds
+            if self.creds is None:
+                if on_disk is None:
+                    raise FileNotFoundError(f"Файл токена не найден: {self.token_file}")
+                self.creds = on_disk
+            self.creds.refresh(Request())
+            self._write_file(self.creds)
+            return self.creds
+
+    def _sync_from_file(self) -> None:
+        """
+        Подхватывает токен, записанный другим процессом
+        """
+        try:
+            mtime = os.path.getmtime(self.token_file)
+        except OSError:
+            return
+        if mtime == self._file_mtime:
+            return
+        with self._lock:
+            creds = self._read_file()
+            if creds is not None and creds.expiry and self.creds is not None and \
+                    (self.creds.expiry is None or creds.expiry > self.creds.expiry):
+                self._adopt(creds)
+
+    def _refresh_loop(self) -> None:
+        # Случайный сдвиг, чтобы процессы не просыпались одновременно
+        while not self._stop.wait(self.poll_interval * random.uniform(0.8, 1.2)):
+            try:
+                self._sync_from_file()
+                if self.creds is not None and self.creds.refresh_token and self._expires_soon(self.creds):
+                    self.refresh()
+            except Exception as e:
+                print(f"Ошибка фонового обновления токена Google: {e}")
+
+    def start(self) -> None:
+        """
+        Запускает фоновое упреждающее обновление токена
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._refresh_loop, name='google-token-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Останавливает фоновое обновление токена
+        """
+        self._stop.set()
@@ -0,0 +1,403 @@
+import csv
+import os
+import re
+import tempfile
+import threading
+from itertools import islice, zip_longest
+from typing import Dict, List, Optional, Tuple
+
+import gspread
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+from credentials_manager import CredentialManager
+from api_quota import QuotaGuard
+
+# Метаданные файла в Google Drive: по ним дешево проверяется, менялась ли таблица
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files/{}'
+
+# Хосты Google API, которые перенаправляются на SHEETS_API_ENDPOINT
+GOOGLE_API_HOSTS = ('https://sheets.googleapis.com', 'https://www.googleapis.com')
+
+_A1_CELL = re.compile(r'^([A-Z]+)(\d+)$')
+
+
+def column_letter(index: int) -> str:
+    """
+    Преобразует индекс столбца (с нуля) в буквенное обозначение A1: 0 -> A, 27 -> AB
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def column_index(letters: str) -> int:
+    """
+    Преобразует буквенное обозначение столбца в индекс (с нуля): A -> 0, AB -> 27
+    """
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+class EndpointAdapter(HTTPAdapter):
+    """
+    Транспорт requests, отправляющий запросы к Google API на другой адрес
+
+    Используется с локальной имитацией Sheets API (fake_sheets_server.py):
+    gspread формирует обычные URL Google, а запросы уходят на endpoint.
+    """
+
+    def __init__(self, endpoint: str, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint.rstrip('/')
+
+    def send(self, request, **kwargs):
+        for host in GOOGLE_API_HOSTS:
+            if request.url.startswith(host):
+                request.url = self.endpoint + request.url[len(host):]
+                break
+        return super().send(request, **kwargs)
+
+
+class SheetDataSource:
+    """
+    Источник данных листа SIMS для GoogleSheetsProcessor.
+
+    Процессор (снимок, индексы, кэш, зеркало) работает только через эти
+    методы, поэтому тот же код выполняется и с Google Sheets, и с локальным
+    файлом - например, с большой синтетической таблицей для профилирования.
+    Значения возвращаются строками, как их отдает Sheets API.
+    """
+
+    def connect(self, interactive: bool) -> None:
+        """
+        Устанавливает подключение к хранилищу
+
+        Args:
+            interactive (bool): Разрешить действия, требующие участия пользователя
+                (браузерная OAuth авторизация)
+        """
+
+    def read_values(self) -> List[List[str]]:
+        """
+        Читает лист целиком
+
+        Returns:
+            List[List[str]]: Строки листа, первая - заголовки
+        """
+        raise NotImplementedError
+
+    def read_headers(self) -> List[str]:
+        """
+        Читает строку заголовков
+
+        Returns:
+            List[str]: Заголовки в порядке столбцов
+        """
+        raise NotImplementedError
+
+    def read_columns(self, indexes: List[int]) -> Tuple[List[str], List[Tuple[str, ...]]]:
+        """
+        Читает только указанные столбцы вместе с актуальной строкой заголовков
+
+        Args:
+            indexes (List[int]): Индексы столбцов (с нуля)
+
+        Returns:
+            Tuple[List[str], List[Tuple[str, ...]]]: Текущие заголовки листа и строки
+            данных со значениями столбцов в запрошенном порядке (строка i - строка листа i + 2)
+        """
+        raise NotImplementedError
+
+    def row_count(self) -> int:
+        """
+        Количество строк листа вместе с заголовком (верхняя граница для чтения частями)
+        """
+        raise NotImplementedError
+
+    def read_column_range(self, indexes: List[int], first_row: int, last_row: int) -> List[Tuple[str, ...]]:
+        """
+        Читает указанные столбцы в диапазоне строк листа
+
+        Args:
+            indexes (List[int]): Индексы столбцов (с нуля)
+            first_row (int): Первая строка листа (с единицы, включительно)
+            last_row (int): Последняя строка листа (включительно)
+
+        Returns:
+            List[Tuple[str, ...]]: Строки со значениями столбцов в запрошенном порядке;
+            строка i соответствует строке листа first_row + i, пустой хвост может отсутствовать
+        """
+        raise NotImplementedError
+
+    def append_rows(self, rows: List[list]) -> None:
+        """
+        Дописывает строки в конец листа
+        """
+        raise NotImplementedError
+
+    def batch_update(self, data: List[Dict]) -> None:
+        """
+        Записывает значения в диапазоны A1 одним запросом
+
+        Args:
+            data (List[Dict]): Элементы вида {'range': 'B5', 'values': [[значение]]}
+        """
+        raise NotImplementedError
+
+    def probe_revision(self) -> Optional[str]:
+        """
+        Дешевая проверка актуальности: маркер версии данных
+
+        Returns:
+            Optional[str]: Маркер версии; меняется при любом изменении листа
+        """
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        """
+        Счетчики обращений к хранилищу для мониторинга
+        """
+        return {}
+
+    def storage_key(self) -> str:
+        """
+        Короткий идентификатор листа для имен локальных файлов (журнала записи и т.п.)
+        """
+        return type(self).__name__
+
+
+class GspreadDataSource(SheetDataSource):
+    """
+    Лист SIMS в Google Sheets (gspread), все вызовы - в пределах квот API
+    """
+
+    SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
+              'https://www.googleapis.com/auth/drive']
+
+    def __init__(self, credentials_file: str = 'client_secret.json', token_file: str = 'token.json',
+                 spreadsheet_id: Optional[str] = None, worksheet_name: str = 'SIMS',
+                 endpoint: Optional[str] = None):
+        """
+        Args:
+            credentials_file (str): Путь к файлу с учетными данными OAuth 2.0
+            token_file (str): Путь к файлу с токеном OAuth, общему для всех процессов бота
+            spreadsheet_id (Optional[str]): ID таблицы, по умолчанию из GOOGLE_SHEETS_ID
+            worksheet_name (str): Название листа
+            endpoint (Optional[str]): Адрес имитации Sheets API вместо Google (без авторизации).
+                По умолчанию берется из SHEETS_API_ENDPOINT.
+        """
+        self.credentials_file = credentials_file
+        self.token_file = token_file
+        self.spreadsheet_id = spreadsheet_id or os.getenv(
+            'GOOGLE_SHEETS_ID', '1nx2QSynzcvt_gOb8gsC0l6Zs7nb7V_x-19kOLx93-WI')
+        self.worksheet_name = worksheet_name
+        self.endpoint = endpoint if endpoint is not None else os.getenv('SHEETS_API_ENDPOINT')
+        self.credential_manager = CredentialManager(token_file, self.SCOPES)
+        # Квоты Sheets API: ограничение частоты и повторы при 429/5xx
+        self.quota = QuotaGuard()
+        self.creds = None
+        self.client = None
+        self.spreadsheet = None
+        self.worksheet = None
+        self._drive_session = None
+
+    def connect(self, interactive: bool) -> None:
+        if self.endpoint:
+            self._connect_endpoint()
+            return
+
+        # Загружаем сохраненный токен; обновление согласовано с другими процессами бота
+        self.creds = self.credential_manager.load()
+
+        # Если нет действительных учетных данных, запрашиваем новые
+        if not self.creds or not self.creds.valid:
+            if self.creds and self.creds.expired and self.creds.refresh_token:
+                self.creds = self.credential_manager.refresh()
+            elif interactive:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    self.credentials_file, self.SCOPES)
+                # Сохраняем учетные данные для следующего запуска
+                self.credential_manager.save(flow.run_local_server(port=0))
+                self.creds = self.credential_manager.creds
+            else:
+                raise Exception(
+                    f"Нет действительного {self.token_file}. Создайте токен вручную: "
+                    "python3 google_sheets_processor.py")
+
+        self.client = gspread.authorize(self.creds)
+        self.spreadsheet = self.quota.call('read', self.client.open_by_key, self.spreadsheet_id)
+        self.worksheet = self.quota.call('read', self.spreadsheet.worksheet, self.worksheet_name)
+        self._drive_session = AuthorizedSession(self.creds)
+        # Дальше токен обновляется заранее в фоне, запросы не ждут его обновления
+        self.credential_manager.start()
+
+    def _connect_endpoint(self) -> None:
+        """
+        Подключение к имитации Sheets API: тот же gspread, но без OAuth и с другим адресом
+        """
+        self.creds = AnonymousCredentials()
+        self.client = gspread.authorize(self.creds)
+        self._drive_session = AuthorizedSession(self.creds)
+        # gspread 6 хранит сессию в client.http_client, gspread 5 - в client.session
+        http_client = getattr(self.client, 'http_client', self.client)
+        for session in (http_client.session, self._drive_session):
+            adapter = EndpointAdapter(self.endpoint)
+            for host in GOOGLE_API_HOSTS:
+                session.mount(host, adapter)
+        self.spreadsheet = self.quota.call('read', self.client.open_by_key, self.spreadsheet_id)
+        self.worksheet = self.quota.call('read', self.spreadsheet.worksheet, self.worksheet_name)
+
+    def read_values(self) -> List[List[str]]:
+        return self.quota.call('read', self.worksheet.get_all_values)
+
+    def read_headers(self) -> List[str]:
+        return [str(header).strip() for header in self.quota.call('read', self.worksheet.row_values, 1)]
+
+    def read_columns(self, indexes: List[int]) -> Tuple[List[str], List[Tuple[str, ...]]]:
+        # Строка заголовков в том же пакете values.batchGet, что и столбцы
+        ranges = ['1:1'] + [f'{column_letter(i)}2:{column_letter(i)}' for i in indexes]
+        value_ranges = self.quota.call('read', self.worksheet.batch_get, ranges, major_dimension='COLUMNS')
+        headers = [str(column[0]).strip() if column else '' for column in value_ranges[0]]
+        data_columns = [value_range[0] if value_range else [] for value_range in value_ranges[1:]]
+        return headers, list(zip_longest(*data_columns, fillvalue=''))
+
+    def row_count(self) -> int:
+        # Размер сетки берем из свежих метаданных: лист мог вырасти после подключения
+        metadata = self.quota.call('read', self.spreadsheet.fetch_sheet_metadata)
+        for sheet in metadata.get('sheets', []):
+            properties = sheet.get('properties', {})
+            if properties.get('title') == self.worksheet_name:
+                return properties.get('gridProperties', {}).get('rowCount', 0)
+        return self.worksheet.row_count
+
+    def read_column_range(self, indexes: List[int], first_row: int, last_row: int) -> List[Tuple[str, ...]]:
+        ranges = [f'{column_letter(i)}{first_row}:{column_letter(i)}{last_row}' for i in indexes]
+        value_ranges = self.quota.call('read', self.worksheet.batch_get, ranges, major_dimension='COLUMNS')
+        data_columns = [value_range[0] if value_range else [] for value_range in value_ranges]
+        return list(zip_longest(*data_columns, fillvalue=''))
+
+    def append_rows(self, rows: List[list]) -> None:
+        self.quota.call('append', self.worksheet.append_rows, rows)
+
+    def batch_update(self, data: List[Dict]) -> None:
+        self.quota.call('write', self.worksheet.batch_update, data, value_input_option='USER_ENTERED')
+
+    def probe_revision(self) -> Optional[str]:
+        """
+        Запрашивает у Google Drive версию таблицы (version, иначе modifiedTime)
+        """
+        metadata = self.quota.call('drive', self._fetch_drive_metadata)
+        return metadata.get('version') or metadata.get('modifiedTime')
+
+    def storage_key(self) -> str:
+        return f'{self.spreadsheet_id}_{self.worksheet_name}'
+
+    def _fetch_drive_metadata(self) -> Dict:
+        response = self._drive_session.get(
+            DRIVE_FILES_URL.format(self.spreadsheet_id),
+            params={'fields': 'version,modifiedTime', 'supportsAllDrives': 'true'},
+            timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def stats(self) -> Dict:
+        return self.quota.stats()
+
+
+class CsvDataSource(SheetDataSource):
+    """
+    Лист в локальном CSV файле (первая строка - заголовки).
+
+    Заменяет Google Sheets там, где нет учетных данных: на CI, при
+    профилировании на больших синтетических таблицах, при отладке.
+    Запись атомарная (временный файл + os.replace), маркер версии - время
+    изменения и размер файла.
+    """
+
+    def __init__(self, path: str, delimiter: str = ','):
+        """
+        Args:
+            path (str): Путь к CSV файлу
+            delimiter (str): Разделитель полей
+        """
+        self.path = path
+        self.delimiter = delimiter
+        self._lock = threading.Lock()
+
+    def storage_key(self) -> str:
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def connect(self, interactive: bool) -> None:
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"Файл с данными листа не найден: {self.path}")
+
+    def read_values(self) -> List[List[str]]:
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            return [row for row in csv.reader(f, delimiter=self.delimiter)]
+
+    def read_headers(self) -> List[str]:
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            return [str(header).strip() for header in next(csv.reader(f, delimiter=self.delimiter), [])]
+
+    def read_columns(self, indexes: List[int]) -> Tuple[List[str], List[Tuple[str, ...]]]:
+        values = self.read_values()
+        if not values:
+            return [], []
+        headers = [str(header).strip() for header in values[0]]
+        rows = [tuple(row[i] if i < len(row) else '' for i in indexes) for row in values[1:]]
+        # Как и Sheets API, не возвращаем хвост строк, пустых во всех запрошенных столбцах
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return headers, rows
+
+    def row_count(self) -> int:
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            return sum(1 for _ in csv.reader(f, delimiter=self.delimiter))
+
+    def read_column_range(self, indexes: List[int], first_row: int, last_row: int) -> List[Tuple[str, ...]]:
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            return [tuple(row[i] if i < len(row) else '' for i in indexes)
+                    for row in islice(reader, first_row - 1, last_row)]
+
+    def append_rows(self, rows: List[list]) -> None:
+        with self._lock, open(self.path, 'a', encoding='utf-8', newline='') as f:
+            csv.writer(f, delimiter=self.delimiter).writerows(rows)
+
+    def batch_update(self, data: List[Dict]) -> None:
+        with self._lock:
+            values = self.read_values()
+            for item in data:
+                # 'SIMS!B5' или 'B5:C6' - берем левую верхнюю ячейку диапазона
+                start = item['range'].split('!')[-1].split(':')[0]
+                match = _A1_CELL.match(start)
+                if not match:
+                    raise ValueError(f"Неподдерживаемый диапазон: {item['range']}")
+                first_col, first_row = column_index(match.group(1)), int(match.group(2)) - 1
+                for row_offset, row_values in enumerate(item['values']):
+                    row_number = first_row + row_offset
+                    while len(values) <= row_number:
+                        values.append([])
+                    row = values[row_number]
+                    for col_offset, value in enumerate(row_values):
+                        col = first_col + col_offset
+                        if len(row) <= col:
+                            row.extend([''] * (col + 1 - len(row)))
+                        row[col] = str(value)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(prefix='.sheet.', suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='') as tmp:
+                csv.writer(tmp, delimiter=self.delimiter).writerows(values)
+            os.replace(tmp_path, self.path)
+
+    def probe_revision(self) -> Optional[str]:
+        stat = os.stat(self.path)
+        return f'{stat.st_mtime_ns}:{stat.st_size}'
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная имитация Google Sheets API v4 для замеров и проверки повторов
+
+Сервер отвечает на запросы gspread, которые используют GoogleSheetsProcessor
+и выгрузка ICCID:IMEI: метаданные таблицы, values.get, values.batchGet,
+values.batchUpdate, values.append, а также запрос версии файла в Drive.
+Задержка ответа, размер листа и доля ответов 429 настраиваются, поэтому
+можно измерять реальные затраты на HTTP, сериализацию и разбор ответов
+без доступа к сети.
+
+Запуск:
+    python3 fake_sheets_server.py --rows 20000 --latency 150 --rate-429 0.05
+
+Затем бот или выгрузка направляются на сервер переменной окружения:
+    SHEETS_API_ENDPOINT=http://127.0.0.1:8088 python3 iccid_imei_export/main.py
+"""
+
+import argparse
+import csv
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from data_sources import column_index, column_letter
+
+_A1_RANGE = re.compile(r'^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$')
+
+SHEET_TITLE = 'SIMS'
+
+# Заголовки синтетического листа: ICCID в столбце E, как ожидает выгрузка
+SYNTHETIC_HEADERS = ['1', '2 Оператор', '5 Мобильный номер (MSISDN)', 'phone', 'ICCID',
+                     'Трафик', 'Тариф', 'Состояние симкарт', 'Устройство', 'IMEI']
+
+_OPERATOR_PREFIXES = [('МТС', '8970101'), ('Мегафон', '8970102'), ('Теле2', '8970120'), ('Билайн', '8970199')]
+
+
+def synthetic_values(rows: int, extra_columns: int = 0, cell_size: int = 16,
+                     seed: int = 0) -> List[List[str]]:
+    """
+    Строит синтетический лист SIMS
+
+    Args:
+        rows (int): Количество строк данных
+        extra_columns (int): Дополнительные столбцы-заполнители для увеличения ответа
+        cell_size (int): Длина значения в столбцах-заполнителях
+        seed (int): Начальное значение генератора случайных чисел
+
+    Returns:
+        List[List[str]]: Строки листа, первая - заголовки
+    """
+    rnd = random.Random(seed)
+    headers = SYNTHETIC_HEADERS + [f'Доп {i + 1}' for i in range(extra_columns)]
+    filler = 'x' * cell_size
+    values = [headers]
+    for i in range(rows):
+        operator, prefix = rnd.choice(_OPERATOR_PREFIXES)
+        phone = f'79{rnd.randrange(10 ** 9):09d}'
+        row = [str(i + 1), operator, phone, phone, f'{prefix}{rnd.randrange(10 ** 12):012d}',
+               f'{rnd.randrange(1, 50)} ГБ', 'Корпоративный', rnd.choice(['Активна', 'Заблокирована']),
+               f'router-{i // 2:06d}', f'35{rnd.randrange(10 ** 13):013d}' if rnd.random() < 0.9 else '']
+        values.append(row + [filler] * extra_columns)
+    return values
+
+
+def _trim(values: List[List[str]]) -> List[List[str]]:
+    # Sheets API не возвращает пустые хвосты строк и пустые последние строки
+    result = []
+    for row in values:
+        end = len(row)
+        while end and row[end - 1] == '':
+            end -= 1
+        result.append(row[:end])
+    while result and not result[-1]:
+        result.pop()
+    return result
+
+
+class FakeSheet:
+    """
+    Лист в памяти с разбором диапазонов A1 и версией, растущей при записи
+    """
+
+    def __init__(self, values: List[List[str]]):
+        self.values = [list(map(str, row)) for row in values]
+        self.version = 1
+        self.lock = threading.Lock()
+
+    @property
+    def column_count(self) -> int:
+        return max((len(row) for row in self.values), default=0)
+
+    def parse_range(self, a1: str) -> Tuple[int, int, int, int]:
+        """
+        Переводит диапазон A1 ('SIMS'!E2:E, 1:1, A1:1, 'SIMS') в границы строк и столбцов (с нуля, включительно)
+        """
+        a1 = unquote(a1)
+        if '!' in a1:
+            a1 = a1.rsplit('!', 1)[1]
+        last_row, last_col = max(len(self.values) - 1, 0), max(self.column_count - 1, 0)
+        match = _A1_RANGE.match(a1)
+        if not a1 or not match or a1.strip("'") == SHEET_TITLE:
+            return 0, last_row, 0, last_col
+        start_col, start_row, end_col, end_row = match.groups()
+        if ':' not in a1:
+            end_col, end_row = start_col, start_row
+        r0 = int(start_row) - 1 if start_row else 0
+        c0 = column_index(start_col) if start_col else 0
+        r1 = int(end_row) - 1 if end_row else last_row
+        c1 = column_index(end_col) if end_col else last_col
+        return r0, r1, c0, c1
+
+    def get(self, a1: str, major_dimension: str = 'ROWS') -> Dict:
+        with self.lock:
+            r0, r1, c0, c1 = self.parse_range(a1)
+            block = [[row[c] if c < len(row) else '' for c in range(c0, c1 + 1)]
+                     for row in self.values[r0:r1 + 1]]
+        if major_dimension == 'COLUMNS':
+            block = [list(column) for column in zip(*block)] if block else []
+        result = {
+            'range': f"{SHEET_TITLE}!{column_letter(c0)}{r0 + 1}:{column_letter(c1)}{r1 + 1}",
+            'majorDimension': major_dimension,
+        }
+        values = _trim(block)
+        if values:
+            result['values'] = values
+        return result
+
+    def update(self, a1: str, values: List[List]) -> int:
+        with self.lock:
+            r0, _, c0, _ = self.parse_range(a1)
+            cells = 0
+            for row_offset, row_values in enumerate(values):
+                while len(self.values) <= r0 + row_offset:
+                    self.values.append([])
+                row = self.values[r0 + row_offset]
+                for col_offset, value in enumerate(row_values):
+                    col = c0 + col_offset
+                    if len(row) <= col:
+                        row.extend([''] * (col + 1 - len(row)))
+                    row[col] = '' if value is None else str(value)
+                    cells += 1
+            self.version += 1
+            return cells
+
+    def append(self, values: List[List]) -> str:
+        with self.lock:
+            start = len(_trim(self.values)) + 1
+            for row_values in values:
+                self.values.append(['' if value is None else str(value) for value in row_values])
+            self.version += 1
+            return f"{SHEET_TITLE}!A{start}:{column_letter(max(len(v) for v in values) - 1)}{start + len(values) - 1}"
+
+
+class FakeSheetsServer(ThreadingHTTPServer):
+    """
+    HTTP сервер с настраиваемой задержкой и ответами 429
+    """
+
+    daemon_threads = True
+
+    def __init__(self, sheet: FakeSheet, host: str = '127.0.0.1', port: int = 8088,
+                 latency: float = 0.0, jitter: float = 0.0, rate_429: float = 0.0,
+                 retry_after: Optional[float] = None, verbose: bool = False):
+        """
+        Args:
+            sheet (FakeSheet): Данные листа
+            host (str): Адрес для прослушивания
+            port (int): Порт (0 - выбрать свободный)
+            latency (float): Задержка каждого ответа в секундах
+            jitter (float): Случайная добавка к задержке, до jitter секунд
+            rate_429 (float): Доля запросов к Sheets API, получающих 429 (0..1)
+            retry_after (Optional[float]): Значение заголовка Retry-After в ответах 429
+            verbose (bool): Печатать журнал запросов
+        """
+        super().__init__((host, port), _Handler)
+        self.sheet = sheet
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.verbose = verbose
+        self.stats = {'requests': 0, 'throttled': 0, 'bytes_sent': 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        """
+        Адрес для SHEETS_API_ENDPOINT
+        """
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> threading.Thread:
+        """
+        Запускает сервер в фоновом потоке (для скриптов замеров)
+        """
+        thread = threading.Thread(target=self.serve_forever, name='fake-sheets', daemon=True)
+        thread.start()
+        return thread
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.stats_lock:
+            self.stats[name] += value
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeSheetsServer
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, payload: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('bytes_sent', len(body))
+
+    def _read_json(self) -> Dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def _prepare(self) -> bool:
+        """
+        Общая часть обработки: задержка и случайный 429. False - ответ уже отправлен.
+        """
+        server = self.server
+        server.count('requests')
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.path.startswith('/v4/') and server.rate_429 and random.random() < server.rate_429:
+            server.count('throttled')
+            # Тело запроса нужно дочитать, иначе соединение keep-alive рассинхронизируется
+            self._read_json()
+            headers = {'Retry-After': str(server.retry_after)} if server.retry_after is not None else None
+            self._send_json(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED',
+                                            'message': 'Quota exceeded (fake server)'}}, headers)
+            return False
+        return True
+
+    def _metadata(self, spreadsheet_id: str) -> Dict:
+        sheet = self.server.sheet
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'properties': {'title': 'Fake SIMS', 'locale': 'ru_RU', 'timeZone': 'Europe/Moscow'},
+            'sheets': [{'properties': {
+                'sheetId': 0, 'title': SHEET_TITLE, 'index': 0, 'sheetType': 'GRID',
+                'gridProperties': {'rowCount': max(len(sheet.values), 1000),
+                                   'columnCount': max(sheet.column_count, 26)},
+            }}],
+        }
+
+    def do_GET(self):
+        if not self._prepare():
+            return
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        path = parts.path
+        sheet = self.server.sheet
+
+        if path == '/_stats':
+            with self.server.stats_lock:
+                stats = dict(self.server.stats)
+            self._send_json(200, dict(stats, version=sheet.version, rows=len(sheet.values)))
+            return
+        drive = re.match(r'^/drive/v3/files/([^/]+)$', path)
+        if drive:
+            self._send_json(200, {'version': str(sheet.version),
+                                  'modifiedTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())})
+            return
+        match = re.match(r'^/v4/spreadsheets/([^/:]+)(.*)$', path)
+        if not match:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {path}'}})
+            return
+        spreadsheet_id, rest = match.groups()
+        major = query.get('majorDimension', ['ROWS'])[0]
+        if rest == '':
+            self._send_json(200, self._metadata(spreadsheet_id))
+        elif rest == '/values:batchGet':
+            self._send_json(200, {'spreadsheetId': spreadsheet_id,
+                                  'valueRanges': [sheet.get(r, major) for r in query.get('ranges', [])]})
+        elif rest.startswith('/values/'):
+            self._send_json(200, sheet.get(rest[len('/values/'):], major))
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {path}'}})
+
+    def do_POST(self):
+        if not self._prepare():
+            return
+        parts = urlsplit(self.path)
+        path = parts.path
+        sheet = self.server.sheet
+        match = re.match(r'^/v4/spreadsheets/([^/:]+)(.*)$', path)
+        if not match:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {path}'}})
+            return
+        spreadsheet_id, rest = match.groups()
+        body = self._read_json()
+        if rest == '/values:batchUpdate':
+            responses = []
+            total = 0
+            for item in body.get('data', []):
+                cells = sheet.update(item['range'], item.get('values', []))
+                total += cells
+                responses.append({'spreadsheetId': spreadsheet_id, 'updatedRange': item['range'],
+                                  'updatedCells': cells})
+            self._send_json(200, {'spreadsheetId': spreadsheet_id, 'totalUpdatedCells': total,
+                                  'responses': responses})
+        elif rest.startswith('/values/') and rest.endswith(':append'):
+            values = body.get('values', [])
+            updated_range = sheet.append(values) if values else ''
+            self._send_json(200, {'spreadsheetId': spreadsheet_id, 'tableRange': SHEET_TITLE,
+                                  'updates': {'spreadsheetId': spreadsheet_id, 'updatedRange': updated_range,
+                                              'updatedRows': len(values)}})
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {path}'}})
+
+
+def load_csv(path: str) -> List[List[str]]:
+    """
+    Загружает лист из CSV файла (первая строка - заголовки)
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return [row for row in csv.reader(f)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Имитация Google Sheets API v4 для замеров')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--csv', help='CSV файл с данными листа (по умолчанию синтетический лист)')
+    parser.add_argument('--rows', type=int, default=10000, help='Строк в синтетическом листе')
+    parser.add_argument('--extra-columns', type=int, default=0, help='Дополнительные столбцы-заполнители')
+    parser.add_argument('--cell-size', type=int, default=16, help='Длина значений в столбцах-заполнителях')
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Случайная добавка к задержке, мс')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Доля ответов 429 (0..1)')
+    parser.add_argument('--retry-after', type=float, default=None, help='Retry-After в ответах 429, секунды')
+    parser.add_argument('--verbose', action='store_true', help='Печатать журнал запросов')
+    args = parser.parse_args()
+
+    values = load_csv(args.csv) if args.csv else synthetic_values(args.rows, args.extra_columns, args.cell_size)
+    server = FakeSheetsServer(FakeSheet(values), args.host, args.port,
+                              latency=args.latency / 1000, jitter=args.jitter / 1000,
+                              rate_429=args.rate_429, retry_after=args.retry_after, verbose=args.verbose)
+    print(f"Имитация Google Sheets API: {server.endpoint} ({len(values) - 1} строк)")
+    print(f"Для подключения: SHEETS_API_ENDPOINT={server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,580 @@
-import gspread
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 import os
 import os.path
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from typing import List, Dict, Optional, Union
+from typing import Iterator, List, Dict, Optional, Union, Tuple
 from tabulate import tabulate
+from sheets_snapshot import IMEI_COLUMN, SheetSnapshot, SheetRecord, find_imei_header, find_imei_index, unique_headers
+from data_sources import SheetDataSource, GspreadDataSource, CsvDataSource, column_letter
+from write_behind import WriteBehindQueue
+from snapshot_mirror import SnapshotMirror
+
+
+class SheetsNotReadyError(Exception):
+    """
+    Подключение к Google Sheets еще не установлено
+    """
+
 
 class GoogleSheetsProcessor:
-    def __init__(self, credentials_file: str = 'client_secret.json'):
+    # Столбцы, которых достаточно для /active и точечного поиска по номеру, ICCID и IMEI.
+    # IMEI_COLUMN подставляется заголовком листа со словом imei
+    LOOKUP_COLUMNS = ['2 Оператор', 'ICCID', 'Трафик', 'Тариф', 'Состояние симкарт',
+                      'Устройство', '5 Мобильный номер (MSISDN)', 'phone', IMEI_COLUMN]
+
+    def __init__(self, credentials_file: str = 'client_secret.json', cache_ttl: Optional[float] = None,
+                 columns: Optional[List[str]] = None, lazy: bool = False, token_file: str = 'token.json',
+                 write_behind: Optional[bool] = None, mirror_path: Optional[str] = None,
+                 source: Optional[SheetDataSource] = None):
         """
         Инициализация процессора Google таблиц с использованием OAuth 2.0
         
         Args:
             credentials_file (str): Путь к файлу с учетными данными OAuth 2.0
+            cache_ttl (Optional[float]): Время жизни снимка листа в секундах.
+                По умолчанию берется из SHEETS_CACHE_TTL (60). 0 отключает кэш.
+            columns (Optional[List[str]]): Загружать в снимок только эти столбцы
+                (например, LOOKUP_COLUMNS). По умолчанию загружается весь лист.
+            lazy (bool): Подключаться к Google в фоновом потоке с повторными попытками.
+                Конструктор возвращается сразу, готовность проверяется через is_ready.
+            token_file (str): Путь к файлу с токеном OAuth, общему для всех процессов бота
+            write_behind (Optional[bool]): Копить новые записи add_record в локальной очереди
+                и отправлять пачками. По умолчанию берется из SHEETS_WRITE_BEHIND (выключено).
+            mirror_path (Optional[str]): Файл SQLite с зеркалом последнего снимка листа.
+                По умолчанию для настоящего Google Sheets берется из SHEETS_MIRROR_PATH
+                (sheets_mirror.sqlite3), пустая строка отключает.
+            source (Optional[SheetDataSource]): Источник данных листа. По умолчанию - Google Sheets,
+                а если задан SHEETS_LOCAL_SOURCE - локальный CSV файл по этому пути.
+        """
+        if source is None:
+            local_path = os.getenv('SHEETS_LOCAL_SOURCE')
+            if local_path:
+                source = CsvDataSource(local_path)
+            else:
+                source = GspreadDataSource(credentials_file, token_file)
+        self.data_source = source
+        
+        # Состояние подключения к источнику
+        self._ready = threading.Event()
+        self.connect_error: Optional[str] = None
+        # Сколько ждать подключения при обращении к листу из запроса
+        self.connect_timeout = float(os.getenv('SHEETS_CONNECT_TIMEOUT', '30'))
+        
+        # Снимок листа в памяти, общий для всех методов чтения
+        if cache_ttl is None:
+            cache_ttl = float(os.getenv('SHEETS_CACHE_TTL', '60'))
+        self.cache_ttl = cache_ttl
+        self._snapshot: Optional[SheetSnapshot] = None
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._refresh_stop = threading.Event()
+        
+        # Проекция снимка и кэш строки заголовков для чтения отдельных столбцов
+        self.columns = columns
+        self._headers: Optional[List[str]] = None
+        
+        # Локальное зеркало снимка: чтения доступны сразу после старта и без связи с Google.
+        # Локальному файловому источнику зеркало по умолчанию не нужно.
+        if mirror_path is None:
+            mirror_path = os.getenv('SHEETS_MIRROR_PATH', 'sheets_mirror.sqlite3') \
+                if isinstance(source, GspreadDataSource) and not source.endpoint else ''
+        self.mirror: Optional[SnapshotMirror] = None
+        if mirror_path:
+            self._load_mirror(mirror_path)
+        
+        # Отложенная запись: add_record кладет запись в журнал на диске, в лист она уходит пачкой
+        if write_behind is None:
+            write_behind = os.getenv('SHEETS_WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes')
+        self.write_queue: Optional[WriteBehindQueue] = None
+        if write_behind:
+            # Журнал у каждого листа свой: процессы, работающие с разными листами, не делят один файл
+            storage_key = re.sub(r'[^\w.-]', '_', source.storage_key())
+            self.write_queue = WriteBehindQueue(
+                os.getenv('SHEETS_WRITE_QUEUE_FILE', f'sheets_write_queue_{storage_key}.jsonl'),
+                self._append_records,
+                batch_size=int(os.getenv('SHEETS_WRITE_BATCH_SIZE', '100')),
+                flush_interval=float(os.getenv('SHEETS_WRITE_FLUSH_INTERVAL', '5')))
+        
+        if lazy:
+            threading.Thread(target=self._connect_with_retries, name='sheets-connect', daemon=True).start()
+        else:
+            self._connect(interactive=True)
+
+    def _mirror_key(self) -> str:
+        """
+        Ключ снимка в зеркале: лист (таблица и вкладка) и проекция - весь лист
+        или конкретный набор столбцов. Процессы с разными таблицами, запущенные
+        из одной папки, не подхватят снимки друг друга.
+        """
+        projection = ','.join(self.columns) if self.columns else '*'
+        return f'{self.data_source.storage_key()}:{projection}'
+
+    def _load_mirror(self, path: str) -> None:
+        """
+        Открывает зеркало и берет из него снимок, сохраненный прошлым запуском
+        
+        Снимок помечается непроверенным: первое чтение после подключения
+        сверит его версию с Google Drive в фоне.
+        """
+        try:
+            self.mirror = SnapshotMirror(path)
+            snapshot = self.mirror.load(self._mirror_key())
+        except Exception as e:
+            print(f"Не удалось открыть зеркало таблицы {path}: {e}")
+            self.mirror = None
+            return
+        if snapshot is not None:
+            snapshot.checked_at = 0
+            self._snapshot = snapshot
+            print(f"Загружено {len(snapshot)} строк из зеркала таблицы {path}")
+
+    def _save_mirror(self, snapshot: SheetSnapshot) -> None:
+        if self.mirror is None:
+            return
+        try:
+            self.mirror.save(self._mirror_key(), snapshot)
+        except Exception as e:
+            print(f"Не удалось сохранить снимок таблицы в зеркало: {e}")
+
+    def _connect(self, interactive: bool) -> None:
+        """
+        Подключается к источнику данных (для Google - получает учетные данные и открывает лист SIMS)
+        
+        Args:
+            interactive (bool): Разрешить запуск браузерной OAuth авторизации,
+                если сохраненного токена нет. В фоновом режиме это запрещено.
+        """
+        self.data_source.connect(interactive)
+        self.connect_error = None
+        self._ready.set()
+
+    def _connect_with_retries(self) -> None:
+        """
+        Фоновое подключение: повторяет попытки с растущей паузой до успеха
+        """
+        delay = 5
+        while not self._ready.is_set():
+            try:
+                self._connect(interactive=False)
+                print("Подключение к Google Sheets установлено")
+            except Exception as e:
+                self.connect_error = str(e)
+                print(f"Ошибка подключения к Google Sheets, повтор через {delay} с: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
+
+    @property
+    def is_ready(self) -> bool:
+        """
+        True, если подключение к Google Sheets установлено
+        """
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет завершения подключения к Google Sheets
+        
+        Args:
+            timeout (Optional[float]): Максимальное время ожидания в секундах (None - без ограничения)
+            
+        Returns:
+            bool: True, если подключение установлено
+        """
+        return self._ready.wait(timeout)
+
+    @property
+    def has_data(self) -> bool:
+        """
+        True, если снимок листа уже есть в памяти (в том числе из зеркала)
+        и чтения не зависят от подключения к Google
+        """
+        return self._snapshot is not None
+
+    def _ensure_ready(self) -> None:
+        """
+        Ждет подключения не дольше connect_timeout, иначе выбрасывает SheetsNotReadyError
+        """
+        if not self._ready.wait(self.connect_timeout):
+            raise SheetsNotReadyError(
+                f"Подключение к Google Sheets еще не установлено: {self.connect_error or 'выполняется'}")
+
+    @property
+    def source(self) -> SheetDataSource:
+        """
+        Подключенный источник данных. При фоновом подключении ждет его не дольше connect_timeout.
+        """
+        self._ensure_ready()
+        return self.data_source
+
+    def status(self) -> Dict:
+        """
+        Состояние процессора для мониторинга (/health)
+        
+        Returns:
+            Dict: Готовность подключения, последняя ошибка, возраст и размер снимка
+        """
+        snapshot = self._snapshot
+        return {
+            'ready': self.is_ready,
+            'error': self.connect_error,
+            'snapshot_rows': len(snapshot) if snapshot else None,
+            'snapshot_age': round(snapshot.age(), 1) if snapshot else None,
+            'revision': snapshot.revision if snapshot else None,
+            'quota': self.data_source.stats(),
+            'write_queue': self.write_queue.pending_count() if self.write_queue else None,
+        }
+
+    def _probe_revision(self) -> Optional[str]:
+        """
+        Запрашивает у источника версию данных (для Google - версию файла в Drive)
+        
+        Returns:
+            Optional[str]: Маркер версии или None, если версия недоступна
+        """
+        try:
+            return self.source.probe_revision()
+        except Exception as e:
+            print(f"Не удалось получить версию таблицы: {e}")
+            return None
+
+    def get_headers(self) -> List[str]:
+        """
+        Загружает строку заголовков листа и запоминает ее для разрешения столбцов
+        
+        Returns:
+            List[str]: Заголовки в порядке столбцов
         """
-        self.SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
-                      'https://www.googleapis.com/auth/drive']
-        self.credentials_file = credentials_file
-        self.creds = None
-        # Получаем ID таблицы из переменной окружения
-        self.spreadsheet_id = os.getenv('GOOGLE_SHEETS_ID', '1nx2QSynzcvt_gOb8gsC0l6Zs7nb7V_x-19kOLx93-WI')
-        
-        # Проверяем наличие сохраненных учетных данных
-        if os.path.exists('token.json'):
-            self.creds = Credentials.from_authorized_user_file('token.json', self.SCOPES)
-        
-        # Если нет действительных учетных данных, запрашиваем новые
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
+        self._headers = self.source.read_headers()
+        return self._headers
+
+    @staticmethod
+    def _resolve_columns(headers: List[str], columns: List[Union[str, int]]) -> List[int]:
+        """
+        Переводит имена столбцов в индексы (при повторах берется первый столбец)
+        """
+        indexes = []
+        for column in columns:
+            if isinstance(column, int):
+                indexes.append(column)
+            elif str(column).strip() in headers:
+                indexes.append(headers.index(str(column).strip()))
             else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.credentials_file, self.SCOPES)
-                self.creds = flow.run_local_server(port=0)
+                raise KeyError(f"Столбец '{column}' не найден в листе")
+        return indexes
+
+    def read_columns(self, columns: List[Union[str, int]]) -> List[Tuple[str, ...]]:
+        """
+        Читает только указанные столбцы одним пакетным запросом values.batchGet
+        
+        Имена переводятся в диапазоны A1 по запомненной строке заголовков. Строка
+        заголовков запрашивается в том же пакете: если столбцы сдвинулись,
+        диапазоны пересчитываются и чтение повторяется.
+        
+        Args:
+            columns (List[Union[str, int]]): Имена столбцов или их индексы (с нуля)
+            
+        Returns:
+            List[Tuple[str, ...]]: Строки данных (со второй строки листа) со значениями
+            столбцов в запрошенном порядке. Строка i соответствует строке листа i + 2.
+        """
+        headers = self._headers if self._headers is not None else self.get_headers()
+        for attempt in range(2):
+            indexes = self._resolve_columns(headers, columns)
+            current_headers, rows = self.source.read_columns(indexes)
+            if current_headers == headers[:len(current_headers)] or attempt == 1:
+                break
+            # Заголовки изменились с прошлого чтения - пересчитываем диапазоны
+            headers = self._headers = current_headers
+        return rows
+
+    def iter_column_chunks(self, columns: List[Union[str, int]], chunk_size: Optional[int] = None,
+                           prefetch: bool = True,
+                           from_snapshot: bool = False) -> Iterator[Tuple[int, List[Tuple[str, ...]]]]:
+        """
+        Читает указанные столбцы частями по chunk_size строк
+        
+        Пока вызывающий код обрабатывает текущую часть, следующая загружается
+        в фоновом потоке, поэтому в памяти не больше двух частей, а общее время
+        близко к max(загрузка, обработка), а не к их сумме.
+        
+        Args:
+            columns (List[Union[str, int]]): Имена столбцов или их индексы (с нуля)
+            chunk_size (Optional[int]): Строк в части, по умолчанию SHEETS_CHUNK_ROWS (5000)
+            prefetch (bool): Загружать следующую часть параллельно с обработкой текущей
+            from_snapshot (bool): Брать строки из снимка листа, если он содержит весь лист.
+                Снимок сначала сверяется с версией файла, и неизменившийся лист не скачивается.
             
-            # Сохраняем учетные данные для следующего запуска
-            with open('token.json', 'w') as token:
-                token.write(self.creds.to_json())
+        Yields:
+            Tuple[int, List[Tuple[str, ...]]]: Номер первой строки листа в части и строки
+            со значениями столбцов в запрошенном порядке (строка i - строка листа first + i)
+        """
+        if chunk_size is None:
+            chunk_size = int(os.getenv('SHEETS_CHUNK_ROWS', '5000'))
+        if from_snapshot and not self.columns:
+            snapshot = self.refresh_snapshot()
+            indexes = self._resolve_columns(snapshot.headers, columns)
+            for start in range(0, len(snapshot.rows), chunk_size):
+                rows = snapshot.rows[start:start + chunk_size]
+                yield start + 2, [tuple(row[i] for i in indexes) for row in rows]
+            return
+        indexes = self._resolve_columns(self.get_headers(), columns)
+        source = self.source
+        last_row = source.row_count()
+        starts = list(range(2, last_row + 1, chunk_size))
         
-        self.client = gspread.authorize(self.creds)
-        self.spreadsheet = self.client.open_by_key(self.spreadsheet_id)
-        self.worksheet = self.spreadsheet.worksheet('SIMS')  # Замените на нужный лист
+        def fetch(first_row: int) -> List[Tuple[str, ...]]:
+            return source.read_column_range(indexes, first_row, min(first_row + chunk_size - 1, last_row))
+        
+        if not prefetch:
+            for first_row in starts:
+                yield first_row, fetch(first_row)
+            return
+        
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets-prefetch') as pool:
+            future = pool.submit(fetch, starts[0]) if starts else None
+            for position, first_row in enumerate(starts):
+                rows = future.result()
+                if position + 1 < len(starts):
+                    future = pool.submit(fetch, starts[position + 1])
+                yield first_row, rows
+
+    def _fetch_snapshot(self, revision: Optional[str] = None) -> SheetSnapshot:
+        """
+        Загружает лист (или только столбцы проекции) и строит новый снимок
+        """
+        if not self.columns:
+            values = self.source.read_values()
+            self._headers = [str(header).strip() for header in values[0]] if values else []
+            return SheetSnapshot(self._headers, values[1:], revision=revision)
+        headers = self.get_headers()
+        # Отсутствующие в листе столбцы проекции пропускаем
+        names: List[str] = []
+        columns: List[Union[str, int]] = []
+        for column in self.columns:
+            if column == IMEI_COLUMN:
+                # Столбец IMEI выбирается так же, как в выгрузке ICCID:IMEI
+                position = find_imei_index(headers)
+                if position is None:
+                    continue
+                column = headers[position]
+                # Повторяющееся имя разрешилось бы в первый столбец - читаем по номеру
+                read_as = position if headers.count(column) > 1 else column
+            elif column in headers:
+                read_as = column
+            else:
+                continue
+            if column not in names:
+                names.append(column)
+                columns.append(read_as)
+        return SheetSnapshot(names, self.read_columns(columns), revision=revision)
 
-    def search_by_phone(self, phone: str) -> Optional[Dict]:
+    def refresh_snapshot(self) -> SheetSnapshot:
+        """
+        Загружает свежий снимок листа и атомарно подменяет текущий
+        
+        Сначала проверяется версия файла в Google Drive: если она не изменилась,
+        лист не скачивается, а текущий снимок только помечается актуальным.
+        Одновременные вызовы не порождают повторных загрузок: если пока поток
+        ждал блокировку снимок уже обновили, возвращается готовый результат.
+        
+        Returns:
+            SheetSnapshot: Актуальный снимок листа
+        """
+        self._ensure_ready()
+        requested_at = time.time()
+        with self._refresh_lock:
+            current = self._snapshot
+            if current is not None and current.checked_at >= requested_at:
+                return current
+            # Версию запрашиваем до загрузки: правка между запросами даст лишь лишнюю загрузку позже
+            revision = self._probe_revision()
+            if current is not None and revision is not None and current.revision == revision:
+                current.touch()
+                return current
+            # Файл изменился - строка заголовков тоже могла измениться
+            self._headers = None
+            snapshot = self._fetch_snapshot(revision)
+            self._snapshot = snapshot
+            self._save_mirror(snapshot)
+            return snapshot
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh_snapshot()
+        except Exception as e:
+            print(f"Ошибка при фоновом обновлении снимка таблицы: {e}")
+
+    def _get_snapshot(self) -> SheetSnapshot:
+        """
+        Возвращает снимок листа для чтения
+        
+        Первый вызов загружает лист синхронно. Устаревший снимок (в том числе
+        из зеркала) отдается сразу, а обновление запускается в фоне, так что
+        читатели не ждут сети. Пока нет подключения к Google, отдается
+        имеющийся снимок без попыток обновления.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or (self.cache_ttl <= 0 and self.is_ready):
+            return self.refresh_snapshot()
+        if snapshot.age() >= self.cache_ttl and self.is_ready and not self._refresh_lock.locked():
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        return snapshot
+
+    def warm_up(self, wait: bool = True) -> None:
+        """
+        Прогрев кэша: загрузка снимка листа до первого запроса
+        
+        Args:
+            wait (bool): Ждать окончания загрузки или выполнить ее в фоне
+        """
+        if wait:
+            self.refresh_snapshot()
+        else:
+            threading.Thread(target=self._warm_up_when_ready, daemon=True).start()
+
+    def _warm_up_when_ready(self) -> None:
+        self._ready.wait()
+        self._refresh_in_background()
+
+    def start_background_refresh(self, interval: Optional[float] = None) -> None:
+        """
+        Запускает периодическое фоновое обновление снимка
+        
+        Args:
+            interval (Optional[float]): Период обновления в секундах, по умолчанию cache_ttl
+        """
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        interval = interval or self.cache_ttl
+        if not interval or interval <= 0:
+            return
+        self._refresh_stop.clear()
+        self._refresh_thread = threading.Thread(
+            target=self._refresh_loop, args=(interval,), name='sheets-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self) -> None:
+        """
+        Останавливает периодическое фоновое обновление снимка
+        """
+        self._refresh_stop.set()
+
+    def _refresh_loop(self, interval: float) -> None:
+        while not self._refresh_stop.wait(interval):
+            if self.is_ready:
+                self._refresh_in_background()
+
+    def invalidate_cache(self) -> None:
+        """
+        Сбрасывает снимок листа: следующее чтение загрузит свежие данные
+        """
+        self._snapshot = None
+
+    def _find_one(self, key: str, value: str) -> Optional[SheetRecord]:
+        """
+        Точечный поиск первой записи по индексу снимка
+        """
+        snapshot = self._get_snapshot()
+        row_ids = snapshot.lookup(key, value)
+        return snapshot.record(row_ids[0]) if row_ids else None
+
+    def find_by_phone(self, phone: str) -> Optional[SheetRecord]:
+        """
+        Поиск записи по столбцу phone (номер нормализуется)
+        
+        Args:
+            phone (str): Номер телефона в любом формате
+            
+        Returns:
+            Optional[SheetRecord]: Найденная запись или None
+        """
+        return self._find_one('phone', phone)
+
+    def find_by_msisdn(self, msisdn: str) -> Optional[SheetRecord]:
+        """
+        Поиск записи по столбцу '5 Мобильный номер (MSISDN)' (номер нормализуется)
+        
+        Args:
+            msisdn (str): Мобильный номер в любом формате
+            
+        Returns:
+            Optional[SheetRecord]: Найденная запись или None
+        """
+        return self._find_one('msisdn', msisdn)
+
+    def find_by_iccid(self, iccid: str) -> Optional[SheetRecord]:
+        """
+        Поиск записи по ICCID (сравниваются только цифры)
+        
+        Args:
+            iccid (str): ICCID симкарты
+            
+        Returns:
+            Optional[SheetRecord]: Найденная запись или None
+        """
+        return self._find_one('iccid', iccid)
+
+    def find_by_imei(self, imei: str) -> List[SheetRecord]:
+        """
+        Поиск записей по IMEI (сравниваются только цифры)
+        
+        В одном модеме может стоять несколько симкарт, поэтому возвращается список.
+        
+        Args:
+            imei (str): IMEI модема
+            
+        Returns:
+            List[SheetRecord]: Найденные записи
+            
+        Raises:
+            KeyError: Столбец IMEI есть в листе, но не входит в проекцию процессора
+        """
+        snapshot = self._get_snapshot()
+        if find_imei_header(snapshot.headers) is None and self.columns and find_imei_header(self._headers or []):
+            # В листе столбец IMEI есть, но в проекцию не загружен - пустой ответ был бы ложным
+            raise KeyError("Столбец IMEI не входит в загруженные столбцы листа")
+        return [snapshot.record(row_id) for row_id in snapshot.lookup('imei', imei)]
+
+    def _locate_row(self, value: str) -> Optional[Tuple[SheetSnapshot, int]]:
+        """
+        Находит запись по телефону, MSISDN или ICCID без сканирования таблицы
+        
+        Перед записью актуальность снимка сверяется с версией файла в Drive,
+        чтобы номер строки не указывал на сдвинувшиеся после правок данные.
+        
+        Returns:
+            Optional[Tuple[SheetSnapshot, int]]: Снимок и номер записи в нем
+            (строка листа = номер + 2) или None
+        """
+        snapshot = self.refresh_snapshot()
+        for key in ('phone', 'msisdn', 'iccid'):
+            row_ids = snapshot.lookup(key, value)
+            if row_ids:
+                return snapshot, row_ids[0]
+        return None
+
+    def _record_columns(self, record: Dict) -> List[Tuple[int, Optional[str], object]]:
+        """
+        Сопоставляет поля записи столбцам листа
+        
+        Если все ключи записи - заголовки листа, значения раскладываются по именам.
+        Иначе, как и раньше, значения пишутся по порядку начиная со столбца A.
+        
+        Returns:
+            List[Tuple[int, Optional[str], object]]: (индекс столбца, заголовок, значение)
+        """
+        headers = unique_headers(self._headers if self._headers is not None else self.get_headers())
+        positions = {header: position for position, header in enumerate(headers)}
+        keys = [str(key).strip() for key in record]
+        if keys and all(key in positions for key in keys):
+            return [(positions[key], key, value) for key, value in zip(keys, record.values())]
+        return [(position, headers[position] if position < len(headers) else None, value)
+                for position, value in enumerate(record.values())]
+
+    def search_by_phone(self, phone: str) -> Optional[SheetRecord]:
         """
         Поиск записи по номеру телефона
         
@@ -52,22 +582,22 @@ class GoogleSheetsProcessor:
             phone (str): Номер телефона для поиска
             
         Returns:
-            Optional[Dict]: Словарь с данными найденной записи или None, если запись не найдена
+            Optional[SheetRecord]: Запись (словарь-представление) или None, если запись не найдена
+            
+        Raises:
+            SheetsNotReadyError: Подключение к таблице еще не установлено и данных нет
         """
         try:
-            # Получаем все данные из таблицы
-            data = self.worksheet.get_all_records()
-            
-            # Ищем запись с указанным номером телефона
-            for record in data:
-                if str(record.get('phone', '')).strip() == str(phone).strip():
-                    return record
-            return None
+            # Ищем по индексу столбца phone, затем по MSISDN
+            return self.find_by_phone(phone) or self.find_by_msisdn(phone)
+        except SheetsNotReadyError:
+            # "Таблица еще загружается" - не то же самое, что "запись не найдена"
+            raise
         except Exception as e:
             print(f"Ошибка при поиске по телефону: {e}")
             return None
 
-    def search_by_name(self, name: str) -> List[Dict]:
+    def search_by_name(self, name: str) -> List[SheetRecord]:
         """
         Поиск записей по имени
         
@@ -75,17 +605,18 @@ class GoogleSheetsProcessor:
             name (str): Имя для поиска
             
         Returns:
-            List[Dict]: Список словарей с найденными записями
+            List[SheetRecord]: Найденные записи (словари-представления)
+            
+        Raises:
+            SheetsNotReadyError: Подключение к таблице еще не установлено и данных нет
         """
         try:
             #headers = ["1"	"2 Оператор"	"3 Дата прихода сим"	"4 ЛК"	"5 Мобильный номер (MSISDN)"	"ICCID"	"Дата активации на Госуслугах"	"Тип Симкарты на Госуслугах"	"Тип модемов"	"Адрес установки"	"Получена"	"Активирована"	"Дата возврата симкарты"	"Тариф"	"Трафик"	Абон плата	Состояние симкарт	Контрагент	Устройство	Состояние ( Адрес)	Где симка физически	Комментарий	ДО какого блок	Устройство в котором была ранее	Дата отправки новому клиенту	Предыдущая стоимость	дата возврата	от кого вернулась симкарта	из какого устройства	"дата возврата"	"от кого вернулась симкарта"	"из какого устройства"	"дата возврата"	"от кого вернулась симкарта"	"из какого устройства"]
-            data = self.worksheet.get_all_records()
-            results = []
-            
-            for record in data:
-                if name.lower() in str(record.get('Устройство', '')).lower():
-                    results.append(record)
-            return results
+            snapshot = self._get_snapshot()
+            # Кандидаты выбираются по n-граммному индексу снимка, а не полным проходом
+            return [snapshot.record(row_id) for row_id in snapshot.search_device(name)]
+        except SheetsNotReadyError:
+            raise
         except Exception as e:
             print(f"Ошибка при поиске по имени: {e}")
             return []
@@ -96,18 +627,53 @@ class GoogleSheetsProcessor:
         
         Returns:
             pd.DataFrame: DataFrame с данными из таблицы
+            
+        Raises:
+            SheetsNotReadyError: Подключение к таблице еще не установлено и данных нет
         """
         try:
-            data = self.worksheet.get_all_records()
-            return pd.DataFrame(data)
+            if self.columns:
+                # В снимке только часть столбцов - читаем лист целиком
+                values = self.source.read_values()
+                snapshot = SheetSnapshot(values[0] if values else [], values[1:])
+            else:
+                snapshot = self._get_snapshot()
+            return pd.DataFrame(snapshot.rows, columns=snapshot.headers)
+        except SheetsNotReadyError:
+            raise
         except Exception as e:
             print(f"Ошибка при получении данных: {e}")
             return pd.DataFrame()
 
+    def _record_row(self, record: Dict) -> List:
+        """
+        Строит строку листа из записи: значения по своим столбцам, пропуски пустые
+        """
+        cells = self._record_columns(record)
+        row = [''] * (max(col for col, _, _ in cells) + 1) if cells else []
+        for col, _, value in cells:
+            row[col] = value
+        return row
+
+    def _append_records(self, records: List[Dict]) -> None:
+        """
+        Дописывает записи в конец листа одним запросом append_rows
+        """
+        self.source.append_rows([self._record_row(record) for record in records])
+        # Строки добавлены в конец, номера существующих не сдвинулись: снимок не сбрасываем,
+        # а помечаем устаревшим - следующее чтение обновит его в фоне
+        snapshot = self._snapshot
+        if snapshot is not None:
+            snapshot.checked_at = 0
+
     def add_record(self, record: Dict) -> bool:
         """
         Добавление новой записи в таблицу
         
+        В режиме отложенной записи запись сохраняется в локальный журнал и
+        отправляется в лист пачкой в фоне; дождаться отправки можно через
+        flush_writes или wait_durable.
+        
         Args:
             record (Dict): Словарь с данными для добавления
             
@@ -115,16 +681,75 @@ class GoogleSheetsProcessor:
             bool: True если запись успешно добавлена, False в случае ошибки
         """
         try:
-            self.worksheet.append_row(list(record.values()))
+            if self.write_queue is not None:
+                self.write_queue.put(dict(record))
+            else:
+                self._append_records([record])
             return True
         except Exception as e:
             print(f"Ошибка при добавлении записи: {e}")
             return False
 
+    def add_records(self, records: List[Dict]) -> bool:
+        """
+        Добавление нескольких записей одним запросом append_rows
+        
+        Args:
+            records (List[Dict]): Записи для добавления
+            
+        Returns:
+            bool: True если записи успешно добавлены (или поставлены в очередь), False в случае ошибки
+        """
+        try:
+            if self.write_queue is not None:
+                for record in records:
+                    self.write_queue.put(dict(record))
+            elif records:
+                self._append_records(records)
+            return True
+        except Exception as e:
+            print(f"Ошибка при добавлении записей: {e}")
+            return False
+
+    def flush_writes(self, timeout: Optional[float] = None) -> bool:
+        """
+        Немедленно отправляет записи из очереди отложенной записи
+        
+        Args:
+            timeout (Optional[float]): Максимальное ожидание в секундах
+            
+        Returns:
+            bool: True, если все поставленные записи сохранены в листе
+                (False, если часть записей API отклонил - см. write_queue.last_error)
+        """
+        if self.write_queue is None:
+            return True
+        return self.write_queue.flush(timeout)
+
+    def wait_durable(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет, пока фоновая отправка сохранит в листе все поставленные записи
+        
+        Args:
+            timeout (Optional[float]): Максимальное ожидание в секундах
+            
+        Returns:
+            bool: True, если очередь отложенной записи отправлена
+        """
+        if self.write_queue is None:
+            return True
+        return self.write_queue.wait_durable(timeout=timeout)
+
     def update_record(self, phone: str, new_data: Dict) -> bool:
         """
         Обновление существующей записи
         
+        Строка находится по индексу снимка, все изменившиеся ячейки отправляются
+        одним запросом batch_update, а строка снимка исправляется на месте.
+        Лист разбирает значения сам (USER_ENTERED: формулы, даты, числа), поэтому
+        исправленная строка - лишь временная копия: снимок помечается устаревшим,
+        и следующее чтение перезагрузит лист в фоне и обновит зеркало.
+        
         Args:
             phone (str): Номер телефона записи для обновления
             new_data (Dict): Новые данные для записи
@@ -133,15 +758,37 @@ class GoogleSheetsProcessor:
             bool: True если запись успешно обновлена, False в случае ошибки
         """
         try:
-            # Находим строку с указанным телефоном
-            cell = self.worksheet.find(phone)
-            if cell:
-                # Обновляем данные в найденной строке
-                row = cell.row
-                for col, value in enumerate(new_data.values(), start=1):
-                    self.worksheet.update_cell(row, col, value)
+            # Находим строку с указанным телефоном по индексу снимка
+            located = self._locate_row(phone)
+            if not located:
+                return False
+            snapshot, row_id = located
+            row = row_id + 2
+            current = snapshot.record(row_id)
+            
+            # Отправляем только ячейки, значение которых действительно меняется
+            data = []
+            changes = {}
+            for col, header, value in self._record_columns(new_data):
+                if header in current and str(current[header]) == str(value):
+                    continue
+                data.append({'range': f'{column_letter(col)}{row}', 'values': [[value]]})
+                if header:
+                    changes[header] = value
+            if not data:
                 return True
-            return False
+            
+            self.source.batch_update(data)
+            
+            # Правим снимок на месте, чтобы чтения сразу видели новые значения. Значения
+            # в листе могут отличаться от записанных (формулы, даты), поэтому снимок
+            # помечается устаревшим без версии: следующее чтение перезагрузит лист целиком
+            with self._refresh_lock:
+                if self._snapshot is snapshot:
+                    snapshot.patch_row(row_id, changes)
+                    snapshot.revision = None
+                    snapshot.checked_at = 0
+            return True
         except Exception as e:
             print(f"Ошибка при обновлении записи: {e}")
             return False
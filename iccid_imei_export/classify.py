@@ -0,0 +1,66 @@
+"""
+Векторная классификация пар ICCID:IMEI по операторам
+
+Часть строк листа загружается в DataFrame целиком: лишние символы удаляются
+одним регулярным выражением по всему столбцу, оператор определяется сравнением
+префиксов ICCID сразу для всех строк, а строки раскладываются по операторам
+одной группировкой вместо цикла Python по каждой строке.
+"""
+
+from typing import Dict, List, Sequence, Tuple
+
+import pandas as pd
+
+# Все, кроме цифр
+NON_DIGITS = r'\D+'
+
+# Метка строк, ICCID которых не подходит ни под один префикс
+UNKNOWN_OPERATOR = ''
+
+
+def digits_only(values: pd.Series) -> pd.Series:
+    """
+    Оставляет в каждом значении столбца только цифры (пустые ячейки - пустая строка)
+    """
+    return values.fillna('').astype(str).str.replace(NON_DIGITS, '', regex=True)
+
+
+def classify_pairs(rows: Sequence[Sequence[str]], operators: Dict[str, str],
+                   first_row: int = 2) -> Tuple[Dict[str, pd.DataFrame], pd.DataFrame]:
+    """
+    Нормализует пары (IMEI, ICCID) и раскладывает их по операторам
+
+    Строки без цифр в IMEI или ICCID отбрасываются. Если ICCID подходит под
+    несколько префиксов, выбирается первый оператор в порядке словаря.
+
+    Args:
+        rows (Sequence[Sequence[str]]): Строки вида (IMEI, ICCID)
+        operators (Dict[str, str]): Оператор -> префикс ICCID
+        first_row (int): Номер строки листа для первой строки rows
+
+    Returns:
+        Tuple[Dict[str, pd.DataFrame], pd.DataFrame]: Таблицы со столбцами iccid и imei
+        для каждого найденного оператора и таблица строк с неизвестным оператором;
+        индекс таблиц - номер строки листа
+    """
+    frame = pd.DataFrame(list(rows), columns=['imei', 'iccid'],
+                         index=pd.RangeIndex(first_row, first_row + len(rows)), dtype=object)
+    pairs = pd.DataFrame({'iccid': digits_only(frame['iccid']), 'imei': digits_only(frame['imei'])})
+    pairs = pairs[(pairs['iccid'] != '') & (pairs['imei'] != '')]
+
+    # Проходим префиксы с конца, чтобы при пересечении побеждал первый оператор словаря
+    operator = pd.Series(UNKNOWN_OPERATOR, index=pairs.index, dtype=object)
+    for name, prefix in reversed(list(operators.items())):
+        operator = operator.mask(pairs['iccid'].str.startswith(prefix), name)
+
+    frames = {name: group for name, group in pairs.groupby(operator, sort=False)}
+    unknown = frames.pop(UNKNOWN_OPERATOR, pairs.iloc[0:0])
+    return frames, unknown
+
+
+def unknown_records(unknown: pd.DataFrame) -> List[Dict]:
+    """
+    Преобразует строки с неизвестным оператором в записи {'iccid', 'imei', 'row'}
+    """
+    return [{'iccid': iccid, 'imei': imei, 'row': int(row)}
+            for row, iccid, imei in zip(unknown.index, unknown['iccid'], unknown['imei'])]
@@ -0,0 +1,118 @@
+"""
+Изменения пар ICCID:IMEI между выгрузками
+
+После каждой выгрузки набор пар каждого оператора сохраняется в служебной
+папке exports/.state. Следующая выгрузка сравнивает с ним свой набор и
+пишет рядом с полными файлами файлы добавленных и удаленных пар: порталы
+операторов принимают небольшие файлы изменений быстрее полной перезагрузки.
+"""
+
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from iccid_imei_export.export_sinks import OperatorExport
+
+# Служебная папка с наборами пар прошлой выгрузки (внутри папки выгрузки)
+STATE_DIR_NAME = '.state'
+
+# Имена файлов сохраненных наборов для операторов, у которых есть файлы выгрузки
+DELTA_NAMES = {
+    'МТС': 'MTS',
+    'Теле2': 'Теле2',
+    'Билайн': 'Билайн',
+}
+
+# Виды изменений: добавленные и удаленные пары
+DELTA_KINDS = ('added', 'removed')
+
+Pair = Tuple[str, str]
+
+
+class PairState:
+    """
+    Наборы пар ICCID:IMEI прошлой выгрузки по операторам
+    """
+
+    def __init__(self, output_dir: Path):
+        """
+        Args:
+            output_dir (Path): Папка выгрузки
+        """
+        self.state_dir = Path(output_dir) / STATE_DIR_NAME
+
+    def _path(self, operator: str) -> Path:
+        return self.state_dir / f'{DELTA_NAMES[operator]}.pairs'
+
+    def load(self, operator: str) -> Optional[Set[Pair]]:
+        """
+        Набор пар оператора из прошлой выгрузки или None, если его еще нет
+        """
+        try:
+            with open(self._path(operator), 'r', encoding='utf-8') as f:
+                return {tuple(line.rstrip('\n').split(';', 1)) for line in f if line.strip()}
+        except FileNotFoundError:
+            return None
+
+    def save(self, operator: str, pairs: Iterable[Pair]) -> None:
+        """
+        Атомарно заменяет сохраненный набор пар оператора
+        """
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(operator)
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{path.name}.', suffix='.tmp', dir=str(self.state_dir))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for iccid, imei in sorted(pairs):
+                    f.write(f'{iccid};{imei}\n')
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def write_deltas(output_dir: Path, timestamp: str,
+                 current: Dict[str, Set[Pair]]) -> Tuple[Dict[str, List[Path]], Dict[str, Dict[str, int]]]:
+    """
+    Пишет файлы добавленных и удаленных пар и запоминает текущие наборы
+
+    Файлы изменений пишутся в формате полной выгрузки оператора (OperatorExport
+    с видом изменений в имени), например у Билайна это отдельные файлы списка
+    ICCID и списка IMEI. Для оператора без сохраненного набора (первая
+    выгрузка) файлы изменений не создаются: текущий набор только запоминается
+    как точка отсчета.
+
+    Args:
+        output_dir (Path): Папка выгрузки
+        timestamp (str): Метка времени в именах файлов
+        current (Dict[str, Set[Pair]]): Оператор -> пары (ICCID, IMEI) текущей выгрузки
+
+    Returns:
+        Tuple[Dict[str, List[Path]], Dict[str, Dict[str, int]]]: Оператор -> созданные файлы
+        изменений и оператор -> {'added': число, 'removed': число}
+    """
+    state = PairState(output_dir)
+    changes: Dict[str, Dict[str, Set[Pair]]] = {kind: {} for kind in DELTA_KINDS}
+    counts: Dict[str, Dict[str, int]] = {}
+    for operator in DELTA_NAMES:
+        pairs = current.get(operator, set())
+        previous = state.load(operator)
+        if previous is not None:
+            changes['added'][operator] = pairs - previous
+            changes['removed'][operator] = previous - pairs
+            counts[operator] = {kind: len(changes[kind][operator]) for kind in DELTA_KINDS}
+
+    files: Dict[str, List[Path]] = {}
+    for kind in DELTA_KINDS:
+        with OperatorExport(Path(output_dir), timestamp, kind=kind) as export:
+            for operator, pairs in changes[kind].items():
+                ordered = sorted(pairs)
+                export.write_many(operator, [iccid for iccid, _ in ordered], [imei for _, imei in ordered])
+        for operator, paths in export.files.items():
+            files.setdefault(operator, []).extend(paths)
+
+    for operator in DELTA_NAMES:
+        state.save(operator, current.get(operator, set()))
+    return files, counts
@@ -0,0 +1,141 @@
+"""
+Манифест папки выгрузки
+
+Для каждого файла в exports/ хранится размер, время изменения и SHA-256
+содержимого. Изменился ли файл, определяется сравнением дайджестов, а не
+чтением старых файлов целиком. Дайджест пересчитывается только для файлов,
+которых нет в манифесте или у которых изменились размер или время.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Set
+
+# Имя файла манифеста; файлы с точкой в начале бот не раздает
+MANIFEST_NAME = '.manifest.json'
+
+# Размер блока при чтении файла для подсчета дайджеста
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Запись манифеста из нескольких потоков одного процесса (выгрузка и ежедневная задача бота)
+_lock = threading.Lock()
+
+
+def sha256_file(path: Path) -> str:
+    """
+    SHA-256 содержимого файла, прочитанного блоками по HASH_BLOCK_SIZE
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ExportManifest:
+    """
+    Манифест файлов выгрузки: имя -> {'size', 'mtime', 'sha256'}
+    """
+
+    def __init__(self, exports_dir: Path):
+        """
+        Args:
+            exports_dir (Path): Папка выгрузки
+        """
+        self.exports_dir = Path(exports_dir)
+        self.path = self.exports_dir / MANIFEST_NAME
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('files', {})
+        except FileNotFoundError:
+            return {}
+        except (ValueError, OSError) as e:
+            # Поврежденный манифест восстанавливается пересчетом дайджестов
+            print(f"Не удалось прочитать манифест выгрузки {self.path}: {e}")
+            return {}
+
+    def _save(self, entries: Dict[str, Dict]) -> None:
+        fd, tmp_path = tempfile.mkstemp(prefix=f'{MANIFEST_NAME}.', suffix='.tmp', dir=str(self.exports_dir))
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'files': entries}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _entry(path: Path, stat: os.stat_result) -> Dict:
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': sha256_file(path)}
+
+    def record(self, paths: Iterable[Path]) -> Dict[str, str]:
+        """
+        Добавляет в манифест только что записанные файлы
+
+        Args:
+            paths (Iterable[Path]): Файлы в папке выгрузки
+
+        Returns:
+            Dict[str, str]: Имя файла -> SHA-256
+        """
+        with _lock:
+            entries = self._load()
+            digests = {}
+            for path in paths:
+                path = Path(path)
+                entry = self._entry(path, path.stat())
+                entries[path.name] = entry
+                digests[path.name] = entry['sha256']
+            self._save(entries)
+            return digests
+
+    def refresh(self) -> Dict[str, Dict]:
+        """
+        Сверяет манифест с папкой за один проход
+
+        Записи удаленных файлов убираются, новые и измененные файлы хешируются заново.
+
+        Returns:
+            Dict[str, Dict]: Актуальные записи манифеста
+        """
+        with _lock:
+            if not self.exports_dir.exists():
+                return {}
+            entries = self._load()
+            current = {}
+            for item in os.scandir(self.exports_dir):
+                if item.name.startswith('.') or not item.is_file():
+                    continue
+                stat = item.stat()
+                entry = entries.get(item.name)
+                if entry and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime_ns:
+                    current[item.name] = entry
+                else:
+                    current[item.name] = self._entry(Path(item.path), stat)
+            if current != entries:
+                self._save(current)
+            return current
+
+    def digests(self) -> Set[str]:
+        """
+        Дайджесты всех файлов папки (после сверки манифеста с папкой)
+        """
+        return {entry['sha256'] for entry in self.refresh().values()}
+
+    def forget(self, names: Iterable[str]) -> None:
+        """
+        Убирает из манифеста записи удаленных файлов
+        """
+        names = set(names)
+        with _lock:
+            entries = self._load()
+            remaining = {name: entry for name, entry in entries.items() if name not in names}
+            if remaining != entries:
+                self._save(remaining)
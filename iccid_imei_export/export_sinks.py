@@ -0,0 +1,174 @@
+"""
+Потоковая запись файлов выгрузки ICCID:IMEI
+
+Все файлы операторов открываются до чтения таблицы, и каждая пара
+ICCID:IMEI записывается в свой файл сразу после определения оператора.
+Данные пишутся во временные файлы рядом с итоговыми и переименовываются
+атомарно только после успешного завершения выгрузки, поэтому раздача
+файлов никогда не отдает наполовину записанный CSV.
+"""
+
+import csv
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Буфер записи файла: строки копятся в памяти и сбрасываются на диск крупными блоками
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Сколько первых записей оператора запоминается для вывода примеров
+SAMPLE_SIZE = 5
+
+# Файлы операторов: шаблон имени, строка заголовка, преобразование пары (ICCID, IMEI) в строку CSV
+OPERATOR_FILES: Dict[str, List[Tuple[str, Optional[Sequence[str]], Callable[[str, str], Sequence[str]]]]] = {
+    'МТС': [
+        ('MTS_ICCID_IMEI_{timestamp}.csv', ('ICCID', 'IMEI'), lambda iccid, imei: (iccid, imei)),
+    ],
+    'Теле2': [
+        ('Теле2_{timestamp}.csv', ('ICCID', 'IMEI'), lambda iccid, imei: (iccid, imei)),
+    ],
+    'Билайн': [
+        # Список ICCID без заголовка и список IMEI в формате type;value
+        ('Билайн_ICCID_{timestamp}.csv', None, lambda iccid, imei: (iccid,)),
+        ('Билайн_IMEI_{timestamp}.csv', None, lambda iccid, imei: ('IMEI', imei)),
+    ],
+}
+
+
+class AtomicCsvSink:
+    """
+    CSV файл, который появляется под своим именем только после commit()
+    """
+
+    def __init__(self, path: Path, header: Optional[Sequence[str]] = None, delimiter: str = ';'):
+        """
+        Args:
+            path (Path): Итоговый путь файла
+            header (Optional[Sequence[str]]): Строка заголовка
+            delimiter (str): Разделитель полей
+        """
+        self.path = Path(path)
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{self.path.name}.', suffix='.tmp', dir=str(self.path.parent))
+        self.tmp_path = tmp_path
+        self._file = os.fdopen(fd, 'w', encoding='utf-8', newline='', buffering=WRITE_BUFFER_SIZE)
+        self._writer = csv.writer(self._file, delimiter=delimiter, lineterminator='\n')
+        if header:
+            self._writer.writerow(header)
+        self.rows = 0
+
+    def write(self, row: Sequence[str]) -> None:
+        self._writer.writerow(row)
+        self.rows += 1
+
+    def write_rows(self, rows: Iterable[Sequence[str]]) -> None:
+        for row in rows:
+            self._writer.writerow(row)
+            self.rows += 1
+
+    def commit(self) -> Optional[Path]:
+        """
+        Сбрасывает данные на диск и атомарно переименовывает файл
+
+        Returns:
+            Optional[Path]: Путь файла или None, если в него не записано ни одной строки
+        """
+        if self.rows == 0:
+            self.discard()
+            return None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        # mkstemp создает файл с правами 0600, итоговый файл должен читаться как обычный
+        os.chmod(self.tmp_path, 0o644)
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+    def discard(self) -> None:
+        """
+        Удаляет временный файл (выгрузка прервана или данных нет)
+        """
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class OperatorExport:
+    """
+    Набор файлов выгрузки для всех операторов
+
+    Использование:
+        with OperatorExport(output_dir, timestamp) as export:
+            export.write_many('МТС', iccids, imeis)
+        files = export.files
+    """
+
+    def __init__(self, output_dir: Path, timestamp: str, kind: Optional[str] = None):
+        """
+        Args:
+            output_dir (Path): Папка выгрузки
+            timestamp (str): Метка времени в именах файлов
+            kind (Optional[str]): Вид файлов изменений ('added' или 'removed'); вставляется
+                в имя перед меткой времени, формат файлов тот же, что у полной выгрузки
+        """
+        self.sinks: Dict[str, List[Tuple[AtomicCsvSink, Callable[[str, str], Sequence[str]]]]] = {}
+        self.counts: Dict[str, int] = {}
+        self.samples: Dict[str, List[Dict[str, str]]] = {}
+        self.files: Dict[str, List[Path]] = {}
+        stamp = f'{kind}_{timestamp}' if kind else timestamp
+        try:
+            for operator, specs in OPERATOR_FILES.items():
+                self.sinks[operator] = [
+                    (AtomicCsvSink(output_dir / name.format(timestamp=stamp), header), formatter)
+                    for name, header, formatter in specs
+                ]
+        except Exception:
+            self.discard()
+            raise
+
+    def __enter__(self) -> 'OperatorExport':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def write_many(self, operator: str, iccids: Iterable[str], imeis: Iterable[str]) -> None:
+        """
+        Записывает пачку пар ICCID:IMEI одного оператора
+        (для оператора без файлов - только учет)
+        """
+        pairs = list(zip(iccids, imeis))
+        self.counts[operator] = self.counts.get(operator, 0) + len(pairs)
+        samples = self.samples.setdefault(operator, [])
+        for iccid, imei in pairs[:SAMPLE_SIZE - len(samples)]:
+            samples.append({'iccid': iccid, 'imei': imei})
+        for sink, formatter in self.sinks.get(operator, ()):
+            sink.write_rows(formatter(iccid, imei) for iccid, imei in pairs)
+
+    def commit(self) -> Dict[str, List[Path]]:
+        """
+        Завершает все файлы; файлы операторов без записей не создаются
+
+        Returns:
+            Dict[str, List[Path]]: Оператор -> созданные файлы
+        """
+        for operator, sinks in self.sinks.items():
+            paths = [sink.commit() for sink, _ in sinks]
+            paths = [path for path in paths if path is not None]
+            if paths:
+                self.files[operator] = paths
+        self.sinks = {}
+        return self.files
+
+    def discard(self) -> None:
+        """
+        Удаляет все временные файлы
+        """
+        for sinks in self.sinks.values():
+            for sink, _ in sinks:
+                sink.discard()
+        self.sinks = {}
@@ -0,0 +1,228 @@
+"""
+Выгрузка ICCID:IMEI как функция для вызова из других модулей
+
+run_export читает столбцы ICCID и IMEI через уже подключенный процессор
+таблицы (или источник данных), раскладывает пары по операторам и пишет
+файлы в exports/. Результат возвращается объектом ExportResult, а не
+печатью в консоль: бот запускает выгрузку в своем процессе и переиспользует
+подключение к Google и снимок листа, а main.py только выводит результат.
+"""
+
+import datetime
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from google_sheets_processor import GoogleSheetsProcessor
+from data_sources import SheetDataSource
+from sheets_snapshot import find_imei_index
+from iccid_imei_export.classify import classify_pairs, unknown_records
+from iccid_imei_export.export_delta import DELTA_NAMES, write_deltas
+from iccid_imei_export.export_manifest import ExportManifest
+from iccid_imei_export.export_sinks import OperatorExport
+
+# Операторы по префиксам ICCID
+OPERATORS = {
+    'МТС': '8970101',
+    'Мегафон': '8970102',
+    'Теле2': '8970120',
+    'Билайн': '8970199'
+}
+
+# ICCID всегда в столбце E (A=0, B=1, C=2, D=3, E=4)
+ICCID_COLUMN_INDEX = 4
+
+# Папка выгрузки по умолчанию (ее же раздает бот по /files/)
+EXPORTS_DIR = Path(__file__).parent / 'exports'
+
+
+class ExportError(Exception):
+    """
+    Выгрузка невозможна: нет нужных столбцов или данных
+    """
+    pass
+
+
+class ExportCancelled(ExportError):
+    """
+    Выгрузка прервана по сроку или по запросу; файлы не созданы
+    """
+    pass
+
+
+class ExportResult:
+    """
+    Итог выгрузки
+
+    Attributes:
+        files (Dict[str, List[Path]]): Оператор -> созданные файлы
+        counts (Dict[str, int]): Оператор -> число пар
+        samples (Dict[str, List[Dict[str, str]]]): Оператор -> первые пары для примера
+        unknown (List[Dict]): Пары с неизвестным оператором ({'iccid', 'imei', 'row'})
+        processed (int): Прочитано строк листа
+        found (int): Пар с известным оператором
+        imei_column (int): Индекс столбца IMEI
+        iccid_column (int): Индекс столбца ICCID
+        output_dir (Path): Папка выгрузки
+        delta_files (Dict[str, List[Path]]): Оператор -> файлы добавленных и удаленных пар
+        delta_counts (Dict[str, Dict[str, int]]): Оператор -> {'added': число, 'removed': число};
+            оператора нет, если это первая выгрузка и сравнивать не с чем
+        digests (Dict[str, str]): Имя созданного файла -> SHA-256 (записаны в манифест папки)
+        timings (Dict[str, float]): Время этапов в секундах: headers, read, classify, write, delta, total
+    """
+
+    def __init__(self, output_dir: Path, imei_column: int, iccid_column: int):
+        self.output_dir = output_dir
+        self.imei_column = imei_column
+        self.iccid_column = iccid_column
+        self.files: Dict[str, List[Path]] = {}
+        self.counts: Dict[str, int] = {}
+        self.samples: Dict[str, List[Dict[str, str]]] = {}
+        self.unknown: List[Dict] = []
+        self.processed = 0
+        self.found = 0
+        self.delta_files: Dict[str, List[Path]] = {}
+        self.delta_counts: Dict[str, Dict[str, int]] = {}
+        self.digests: Dict[str, str] = {}
+        self.timings: Dict[str, float] = {}
+
+    @property
+    def all_files(self) -> List[Path]:
+        """
+        Все полные файлы выгрузки одним списком
+        """
+        return [path for paths in self.files.values() for path in paths]
+
+    @property
+    def all_delta_files(self) -> List[Path]:
+        """
+        Все файлы изменений одним списком
+        """
+        return [path for paths in self.delta_files.values() for path in paths]
+
+
+def find_columns(headers: List[str]) -> Tuple[int, int]:
+    """
+    Находит столбцы IMEI (см. find_imei_index) и ICCID
+
+    Returns:
+        Tuple[int, int]: Индексы столбцов IMEI и ICCID
+
+    Raises:
+        ExportError: Столбец не найден
+    """
+    imei_col_idx = find_imei_index(headers)
+    if imei_col_idx is None:
+        raise ExportError(f"Не найден столбец 'IMEI' в таблице. Найденные заголовки: {headers}")
+    if len(headers) <= ICCID_COLUMN_INDEX:
+        raise ExportError("Не найден столбец E (ICCID) в таблице")
+    return imei_col_idx, ICCID_COLUMN_INDEX
+
+
+def run_export(source: Union[GoogleSheetsProcessor, SheetDataSource], output_dir: Optional[Path] = None,
+               deadline: Optional[float] = None, cancel: Optional[threading.Event] = None,
+               from_snapshot: bool = False, deltas: bool = False) -> ExportResult:
+    """
+    Выгружает пары ICCID:IMEI по операторам в CSV файлы
+
+    Срок и флаг отмены проверяются между частями листа; при прерывании
+    временные файлы удаляются и ни один итоговый файл не появляется.
+
+    Args:
+        source (Union[GoogleSheetsProcessor, SheetDataSource]): Подключенный процессор
+            таблицы или источник данных
+        output_dir (Optional[Path]): Папка выгрузки, по умолчанию EXPORTS_DIR
+        deadline (Optional[float]): Крайний срок по time.monotonic()
+        cancel (Optional[threading.Event]): Флаг отмены выгрузки
+        from_snapshot (bool): Брать строки из снимка листа процессора, если он содержит весь лист.
+            Неизменившийся лист при этом не скачивается повторно.
+        deltas (bool): Писать файлы изменений и запоминать текущие пары как точку отсчета
+            следующей выгрузки. Включается только для плановой выгрузки (bot3), чтобы
+            разовый ручной запуск не скрыл изменения от следующей плановой.
+
+    С deltas рядом с полными файлами пишутся файлы пар, добавленных и удаленных с
+    прошлой выгрузки. Созданные файлы добавляются в манифест папки вместе с
+    дайджестами SHA-256.
+
+    Returns:
+        ExportResult: Созданные файлы, статистика и время этапов
+
+    Raises:
+        ExportError: Нет нужных столбцов или таблица пуста
+        ExportCancelled: Истек срок или выставлен флаг отмены
+    """
+    started = time.monotonic()
+    if isinstance(source, SheetDataSource):
+        processor = GoogleSheetsProcessor(source=source, cache_ttl=0, mirror_path='')
+    else:
+        processor = source
+
+    def check_cancelled() -> None:
+        if cancel is not None and cancel.is_set():
+            raise ExportCancelled("Выгрузка отменена")
+        if deadline is not None and time.monotonic() > deadline:
+            raise ExportCancelled("Истек срок выполнения выгрузки")
+
+    headers = processor.get_headers()
+    imei_col_idx, iccid_col_idx = find_columns(headers)
+    output_dir = Path(output_dir) if output_dir is not None else EXPORTS_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+    result = ExportResult(output_dir, imei_col_idx, iccid_col_idx)
+    result.timings['headers'] = time.monotonic() - started
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    read_time = classify_time = write_time = 0.0
+    # Наборы пар для сравнения с прошлой выгрузкой
+    current_pairs = {operator: set() for operator in DELTA_NAMES}
+
+    # Файлы всех операторов открываются сразу, и каждая пара пишется в свой файл
+    # по мере чтения. Под итоговыми именами файлы появляются только в конце выгрузки.
+    with OperatorExport(output_dir, timestamp) as export:
+        # Читаем только два нужных столбца частями по SHEETS_CHUNK_ROWS строк:
+        # следующая часть загружается в фоне, пока обрабатывается текущая
+        chunks = processor.iter_column_chunks([imei_col_idx, iccid_col_idx], from_snapshot=from_snapshot)
+        try:
+            while True:
+                check_cancelled()
+                step = time.monotonic()
+                chunk = next(chunks, None)
+                read_time += time.monotonic() - step
+                if chunk is None:
+                    break
+                first_row, rows = chunk
+
+                # Нормализация и определение оператора выполняются сразу для всей части
+                step = time.monotonic()
+                frames, unknown = classify_pairs(rows, OPERATORS, first_row)
+                result.unknown.extend(unknown_records(unknown))
+                classify_time += time.monotonic() - step
+
+                step = time.monotonic()
+                for operator, pairs in frames.items():
+                    export.write_many(operator, pairs['iccid'], pairs['imei'])
+                    if operator in current_pairs:
+                        current_pairs[operator].update(zip(pairs['iccid'], pairs['imei']))
+                    result.found += len(pairs)
+                write_time += time.monotonic() - step
+                result.processed += len(rows)
+        finally:
+            # Останавливаем фоновую загрузку следующей части, если выгрузка прервана
+            chunks.close()
+
+        if not result.processed:
+            raise ExportError("Таблица пуста или содержит только заголовки")
+
+    result.files = export.files
+    result.counts = export.counts
+    result.samples = export.samples
+
+    step = time.monotonic()
+    if deltas:
+        result.delta_files, result.delta_counts = write_deltas(output_dir, timestamp, current_pairs)
+    delta_time = time.monotonic() - step
+
+    result.digests = ExportManifest(output_dir).record(result.all_files + result.all_delta_files)
+    result.timings.update({'read': read_time, 'classify': classify_time, 'write': write_time,
+                           'delta': delta_time, 'total': time.monotonic() - started})
+    return result
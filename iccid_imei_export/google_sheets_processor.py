@@ -1,93 +0,0 @@
-import gspread
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-import os.path
-import pandas as pd
-from typing import List, Dict, Optional, Union
-from tabulate import tabulate
-
-class GoogleSheetsProcessor:
-    def __init__(self, credentials_file: str = 'client_secret.json', token_file: str = None):
-        """
-        Инициализация процессора Google таблиц с использованием OAuth 2.0
-        
-        Args:
-            credentials_file (str): Путь к файлу с учетными данными OAuth 2.0
-            token_file (str): Путь к файлу с токеном. Если None, используется token.json в той же директории, что и credentials_file
-        """
-        self.SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-        self.credentials_file = credentials_file
-        
-        # Определяем путь к token.json
-        if token_file:
-            self.token_file = token_file
-        else:
-            # Используем token.json в той же директории, что и credentials_file
-            creds_dir = os.path.dirname(os.path.abspath(credentials_file))
-            self.token_file = os.path.join(creds_dir, 'token.json')
-        
-        self.creds = None
-        self.spreadsheet_id = '1nx2QSynzcvt_gOb8gsC0l6Zs7nb7V_x-19kOLx93-WI'
-        
-        # Проверяем наличие сохраненных учетных данных
-        if os.path.exists(self.token_file):
-            try:
-                self.creds = Credentials.from_authorized_user_file(self.token_file, self.SCOPES)
-            except Exception as e:
-                # Если не удалось загрузить токен (например, несовместимые scope), удаляем старый и создаем новый
-                print(f"[ПРЕДУПРЕЖДЕНИЕ] Не удалось загрузить существующий токен: {e}")
-                print("[ИНФО] Удаляем старый токен и создадим новый")
-                try:
-                    os.remove(self.token_file)
-                except:
-                    pass
-                self.creds = None
-        
-        # Если нет действительных учетных данных, запрашиваем новые
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                try:
-                    self.creds.refresh(Request())
-                except Exception as e:
-                    # Если не удалось обновить токен (например, несовместимые scope), удаляем старый и создаем новый
-                    print(f"[ПРЕДУПРЕЖДЕНИЕ] Не удалось обновить токен: {e}")
-                    print("[ИНФО] Удаляем старый токен и создадим новый")
-                    try:
-                        os.remove(self.token_file)
-                    except:
-                        pass
-                    self.creds = None
-            
-            # Если токен все еще недействителен, создаем новый
-            if not self.creds or not self.creds.valid:
-                # Проверяем, существует ли token.json
-                if not os.path.exists(self.token_file):
-                    token_dir = os.path.dirname(self.token_file)
-                    raise Exception(
-                        f"[ОШИБКА] Файл токена не найден: {self.token_file}\n"
-                        f"[РЕШЕНИЕ] Для первого запуска необходимо создать токен вручную:\n"
-                        f"1. Подключитесь к серверу с доступом к браузеру (SSH с X11 forwarding или локально)\n"
-                        f"2. Запустите скрипт вручную:\n"
-                        f"   cd {token_dir}\n"
-                        f"   python3 -c \"from google_sheets_processor import GoogleSheetsProcessor; GoogleSheetsProcessor('{self.credentials_file}')\"\n"
-                        f"3. После авторизации файл token.json будет создан в: {token_dir}\n"
-                        f"4. Затем скрипт сможет работать автоматически"
-                    )
-                
-                # Если token.json существует, но невалиден - это критическая ошибка
-                # На сервере без браузера мы не можем создать новый токен автоматически
-                raise Exception(
-                    f"[ОШИБКА] Токен недействителен и не может быть обновлен автоматически\n"
-                    f"[РЕШЕНИЕ] Удалите файл {self.token_file} и создайте новый токен вручную:\n"
-                    f"1. Удалите старый токен: rm {self.token_file}\n"
-                    f"2. Запустите скрипт вручную с доступом к браузеру для создания нового токена"
-                )
-            
-            # Сохраняем учетные данные для следующего запуска
-            with open(self.token_file, 'w') as token:
-                token.write(self.creds.to_json())
-        
-        self.client = gspread.authorize(self.creds)
-        self.spreadsheet = self.client.open_by_key(self.spreadsheet_id)
-        self.worksheet = self.spreadsheet.worksheet('SIMS')  # Замените на нужный лист
@@ -12,21 +12,21 @@
 
 import os
 import sys
-import datetime
 from pathlib import Path
+from typing import Optional
 
-# Импортируем GoogleSheetsProcessor из текущей директории
+# GoogleSheetsProcessor общий с ботами и лежит в корне проекта
 current_dir = Path(__file__).parent
-# Добавляем текущую директорию в sys.path для импорта модулей
-sys.path.insert(0, str(current_dir))
+project_root = current_dir.parent
+sys.path.insert(0, str(project_root))
 
 try:
     from google_sheets_processor import GoogleSheetsProcessor
+    from iccid_imei_export.exporter import OPERATORS, ExportError, run_export
 except ImportError as e:
     print(f"[ОШИБКА] Не удалось импортировать GoogleSheetsProcessor: {e}")
-    print(f"[ПОДСКАЗКА] Текущая директория: {current_dir}")
     print(f"[ПОДСКАЗКА] sys.path: {sys.path}")
-    print(f"[ПОДСКАЗКА] Проверьте, что файл google_sheets_processor.py находится в: {current_dir}")
+    print(f"[ПОДСКАЗКА] Проверьте, что файл google_sheets_processor.py находится в: {project_root}")
     sys.exit(1)
 
 
@@ -58,13 +58,22 @@ def find_credentials_file():
     return None
 
 
-def export_iccid_imei():
+def create_processor() -> Optional[GoogleSheetsProcessor]:
     """
-    Основная функция выгрузки ICCID:IMEI
+    Создает процессор таблицы для выгрузки
+    
+    Если задан SHEETS_LOCAL_SOURCE, данные читаются из локального файла, а если
+    SHEETS_API_ENDPOINT - из имитации Sheets API; учетные данные Google не нужны.
+    
+    Returns:
+        Optional[GoogleSheetsProcessor]: Подключенный процессор или None
     """
-    print("=" * 60)
-    print("    ВЫГРУЗКА ICCID : IMEI")
-    print("=" * 60)
+    if os.getenv('SHEETS_LOCAL_SOURCE'):
+        print(f"\n[ИНФО] Используем локальный источник данных: {os.getenv('SHEETS_LOCAL_SOURCE')}")
+        return GoogleSheetsProcessor(mirror_path='')
+    if os.getenv('SHEETS_API_ENDPOINT'):
+        print(f"\n[ИНФО] Используем имитацию Google Sheets API: {os.getenv('SHEETS_API_ENDPOINT')}")
+        return GoogleSheetsProcessor(mirror_path='')
     
     # Ищем файл с учетными данными
     credentials_file = find_credentials_file()
@@ -82,245 +91,144 @@ def export_iccid_imei():
             parent_dir.parent / 'mrnet_ssh' / 'client_secret.json',
         ]:
             print(f"    - {path}")
-        return False
+        return None
     
     print(f"\n[ИНФО] Используем файл учетных данных: {credentials_file}")
     
+    # Токен лежит рядом с файлом учетных данных. Подключаемся без браузерной
+    # авторизации: выгрузка запускается на сервере без участия пользователя.
+    token_file = credentials_file.parent / 'token.json'
+    processor = GoogleSheetsProcessor(
+        credentials_file=str(credentials_file.absolute()),
+        token_file=str(token_file.absolute()),
+        lazy=True,
+        mirror_path=''
+    )
+    if not processor.wait_ready(processor.connect_timeout):
+        print(f"\n[ОШИБКА] Не удалось подключиться к Google Sheets: {processor.connect_error}")
+        print(f"[РЕШЕНИЕ] Создайте токен вручную с доступом к браузеру: "
+              f"cd {project_root} && python3 google_sheets_processor.py")
+        return None
+    return processor
+
+
+def export_iccid_imei(processor: Optional[GoogleSheetsProcessor] = None, deltas: bool = False):
+    """
+    Основная функция выгрузки ICCID:IMEI
+    
+    Args:
+        processor (Optional[GoogleSheetsProcessor]): Процессор таблицы; по умолчанию
+            создается create_processor() (Google Sheets или SHEETS_LOCAL_SOURCE)
+        deltas (bool): Писать файлы изменений и обновить точку отсчета плановой выгрузки
+    """
+    print("=" * 60)
+    print("    ВЫГРУЗКА ICCID : IMEI")
+    print("=" * 60)
+    
     try:
-        # Создаем экземпляр процессора
-        abs_credentials_file = str(credentials_file.absolute())
-        token_file = credentials_file.parent / 'token.json'
-        abs_token_file = str(token_file.absolute()) if token_file.exists() else None
-        
-        processor = GoogleSheetsProcessor(
-            credentials_file=abs_credentials_file,
-            token_file=abs_token_file
-        )
-        
-        print("\n[СКАНИРОВАНИЕ] Читаем данные из таблицы SIMS...")
-        
-        # Получаем все данные из таблицы
-        all_values = processor.worksheet.get_all_values()
-        
-        if not all_values or len(all_values) < 2:
-            print("\n[ОШИБКА] Таблица пуста или содержит только заголовки")
+        if processor is None:
+            processor = create_processor()
+        if processor is None:
             return False
         
-        # Первая строка - заголовки
-        headers = all_values[0]
-        
-        # Находим индексы нужных столбцов
-        imei_col_idx = None
-        iccid_col_idx = None
-        
-        for idx, header in enumerate(headers):
-            header_lower = str(header).strip().lower()
-            if 'imei' in header_lower:
-                imei_col_idx = idx
-            if idx == 4:  # Столбец E (индекс 4, так как A=0, B=1, C=2, D=3, E=4)
-                iccid_col_idx = idx
-        
-        # Проверяем, что нашли столбец IMEI
-        if imei_col_idx is None:
-            print("\n[ОШИБКА] Не найден столбец 'IMEI' в таблице")
-            print(f"[ИНФО] Найденные заголовки: {headers}")
-            return False
+        print("\n[СКАНИРОВАНИЕ] Читаем данные из таблицы SIMS...")
         
-        if iccid_col_idx is None:
-            print("\n[ОШИБКА] Не найден столбец E (ICCID) в таблице")
+        try:
+            result = run_export(processor, deltas=deltas)
+        except ExportError as e:
+            print(f"\n[ОШИБКА] {e}")
             return False
         
-        print(f"[ИНФО] Столбец IMEI найден: колонка {chr(65 + imei_col_idx)} (индекс {imei_col_idx})")
-        print(f"[ИНФО] Столбец ICCID: колонка E (индекс {iccid_col_idx})")
-        
-        # Определяем операторов по префиксам ICCID
-        operators = {
-            'МТС': '8970101',
-            'Мегафон': '8970102',
-            'Теле2': '8970120',
-            'Билайн': '8970199'
-        }
-        
-        # Собираем данные по операторам
-        operator_data = {op: [] for op in operators.keys()}
-        unknown_operator = []
-        
-        # Сканируем начиная со второй строки (индекс 1)
-        processed_count = 0
-        found_count = 0
-        
-        for row_idx in range(1, len(all_values)):
-            row = all_values[row_idx]
-            
-            # Получаем IMEI из столбца
-            if len(row) > imei_col_idx:
-                imei_value = str(row[imei_col_idx]).strip()
-                
-                # Проверяем, что IMEI содержит набор цифр
-                if imei_value and any(c.isdigit() for c in imei_value):
-                    # Извлекаем только цифры из IMEI
-                    imei_digits = ''.join(filter(str.isdigit, imei_value))
-                    
-                    if imei_digits:  # Если есть хотя бы одна цифра
-                        # Получаем ICCID из столбца E
-                        if len(row) > iccid_col_idx:
-                            iccid_value = str(row[iccid_col_idx]).strip()
-                            iccid_digits = ''.join(filter(str.isdigit, iccid_value))
-                            
-                            if iccid_digits:
-                                # Определяем оператора по префиксу ICCID
-                                operator_found = None
-                                for op_name, prefix in operators.items():
-                                    if iccid_digits.startswith(prefix):
-                                        operator_found = op_name
-                                        break
-                                
-                                if operator_found:
-                                    operator_data[operator_found].append({
-                                        'iccid': iccid_digits,
-                                        'imei': imei_digits
-                                    })
-                                    found_count += 1
-                                else:
-                                    unknown_operator.append({
-                                        'iccid': iccid_digits,
-                                        'imei': imei_digits,
-                                        'row': row_idx + 1
-                                    })
-            
-            processed_count += 1
+        print(f"[ИНФО] Столбец IMEI найден: колонка {chr(65 + result.imei_column)} (индекс {result.imei_column})")
+        print(f"[ИНФО] Столбец ICCID: колонка E (индекс {result.iccid_column})")
         
-        print(f"\n[СТАТИСТИКА] Обработано строк: {processed_count}")
-        print(f"[СТАТИСТИКА] Найдено записей с IMEI и ICCID: {found_count}")
+        print(f"\n[СТАТИСТИКА] Обработано строк: {result.processed}")
+        print(f"[СТАТИСТИКА] Найдено записей с IMEI и ICCID: {result.found}")
         
         # Выводим статистику по операторам
         print("\n" + "=" * 60)
         print("    СТАТИСТИКА ПО ОПЕРАТОРАМ")
         print("=" * 60)
-        for op_name, data_list in operator_data.items():
-            print(f"    {op_name}: {len(data_list)} записей")
-        if unknown_operator:
-            print(f"    Неизвестный оператор: {len(unknown_operator)} записей")
-        
-        # Создаем директорию для экспорта
-        script_dir = Path(__file__).parent
-        output_dir = script_dir / 'exports'
-        output_dir.mkdir(exist_ok=True)
+        for op_name in OPERATORS:
+            print(f"    {op_name}: {result.counts.get(op_name, 0)} записей")
+        if result.unknown:
+            print(f"    Неизвестный оператор: {len(result.unknown)} записей")
         
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # Обрабатываем данные для МТС
-        if operator_data['МТС']:
+        # Файлы для МТС
+        if result.counts.get('МТС'):
             print("\n" + "=" * 60)
             print("    СОЗДАНИЕ CSV ФАЙЛА ДЛЯ МТС")
             print("=" * 60)
+            print(f"\n[УСПЕХ] CSV файл создан: {result.files['МТС'][0]}")
+            print(f"[ИНФО] Записей в файле: {result.counts['МТС']}")
             
-            csv_filename = output_dir / f'MTS_ICCID_IMEI_{timestamp}.csv'
-            
-            try:
-                with open(csv_filename, 'w', encoding='utf-8') as f:
-                    # Записываем заголовок первой строкой
-                    f.write("ICCID;IMEI\n")
-                    for item in operator_data['МТС']:
-                        f.write(f"{item['iccid']};{item['imei']}\n")
-                
-                print(f"\n[УСПЕХ] CSV файл создан: {csv_filename}")
-                print(f"[ИНФО] Записей в файле: {len(operator_data['МТС'])}")
-                
-                # Показываем первые несколько записей как пример
-                print("\n[ПРИМЕР] Первые 5 записей:")
-                for i, item in enumerate(operator_data['МТС'][:5], 1):
-                    print(f"    {i}. {item['iccid']};{item['imei']}")
-                
-            except Exception as e:
-                print(f"\n[ОШИБКА] Не удалось создать CSV файл: {e}")
-                import traceback
-                traceback.print_exc()
+            # Показываем первые несколько записей как пример
+            print("\n[ПРИМЕР] Первые 5 записей:")
+            for i, item in enumerate(result.samples['МТС'][:5], 1):
+                print(f"    {i}. {item['iccid']};{item['imei']}")
         else:
             print("\n[ИНФО] Нет данных для МТС")
         
-        # Обрабатываем данные для Теле2
-        if operator_data['Теле2']:
+        # Файлы для Теле2
+        if result.counts.get('Теле2'):
             print("\n" + "=" * 60)
             print("    СОЗДАНИЕ CSV ФАЙЛА ДЛЯ ТЕЛЕ2")
             print("=" * 60)
+            print(f"\n[УСПЕХ] CSV файл создан: {result.files['Теле2'][0]}")
+            print(f"[ИНФО] Записей в файле: {result.counts['Теле2']}")
             
-            csv_filename = output_dir / f'Теле2_{timestamp}.csv'
-            
-            try:
-                with open(csv_filename, 'w', encoding='utf-8') as f:
-                    # Записываем заголовок первой строкой
-                    f.write("ICCID;IMEI\n")
-                    for item in operator_data['Теле2']:
-                        f.write(f"{item['iccid']};{item['imei']}\n")
-                
-                print(f"\n[УСПЕХ] CSV файл создан: {csv_filename}")
-                print(f"[ИНФО] Записей в файле: {len(operator_data['Теле2'])}")
-                
-                # Показываем первые несколько записей как пример
-                print("\n[ПРИМЕР] Первые 5 записей:")
-                for i, item in enumerate(operator_data['Теле2'][:5], 1):
-                    print(f"    {i}. {item['iccid']};{item['imei']}")
-                
-            except Exception as e:
-                print(f"\n[ОШИБКА] Не удалось создать CSV файл: {e}")
-                import traceback
-                traceback.print_exc()
+            # Показываем первые несколько записей как пример
+            print("\n[ПРИМЕР] Первые 5 записей:")
+            for i, item in enumerate(result.samples['Теле2'][:5], 1):
+                print(f"    {i}. {item['iccid']};{item['imei']}")
         
-        # Обрабатываем данные для Билайна
-        if operator_data['Билайн']:
+        # Файлы для Билайна: список ICCID и список IMEI в формате type;value
+        if result.counts.get('Билайн'):
             print("\n" + "=" * 60)
             print("    СОЗДАНИЕ CSV ФАЙЛОВ ДЛЯ БИЛАЙНА")
             print("=" * 60)
+            iccid_filename, imei_filename = result.files['Билайн']
+            print(f"\n[УСПЕХ] CSV файлы созданы:")
+            print(f"    ICCID файл: {iccid_filename}")
+            print(f"    IMEI файл: {imei_filename}")
+            print(f"[ИНФО] Записей в файлах: {result.counts['Билайн']}")
             
-            # Создаем первый файл: список ICCID (без заголовка)
-            iccid_filename = output_dir / f'Билайн_ICCID_{timestamp}.csv'
-            
-            # Создаем второй файл: список IMEI в формате type;value
-            imei_filename = output_dir / f'Билайн_IMEI_{timestamp}.csv'
-            
-            try:
-                # Создаем файл с ICCID
-                with open(iccid_filename, 'w', encoding='utf-8') as f:
-                    for item in operator_data['Билайн']:
-                        f.write(f"{item['iccid']}\n")
-                
-                # Создаем файл с IMEI в формате type;value
-                with open(imei_filename, 'w', encoding='utf-8') as f:
-                    for item in operator_data['Билайн']:
-                        f.write(f"IMEI;{item['imei']}\n")
-                
-                print(f"\n[УСПЕХ] CSV файлы созданы:")
-                print(f"    ICCID файл: {iccid_filename}")
-                print(f"    IMEI файл: {imei_filename}")
-                print(f"[ИНФО] Записей в файлах: {len(operator_data['Билайн'])}")
-                
-                # Показываем первые несколько записей как пример
-                print("\n[ПРИМЕР] Первые 3 записи:")
-                for i, item in enumerate(operator_data['Билайн'][:3], 1):
-                    print(f"    {i}. ICCID: {item['iccid']}, IMEI: {item['imei']}")
-                
-            except Exception as e:
-                print(f"\n[ОШИБКА] Не удалось создать CSV файлы: {e}")
-                import traceback
-                traceback.print_exc()
+            # Показываем первые несколько записей как пример
+            print("\n[ПРИМЕР] Первые 3 записи:")
+            for i, item in enumerate(result.samples['Билайн'][:3], 1):
+                print(f"    {i}. ICCID: {item['iccid']}, IMEI: {item['imei']}")
         
         # Заглушка для Мегафона
-        if operator_data['Мегафон']:
-            print(f"\n[Мегафон] Найдено {len(operator_data['Мегафон'])} записей")
+        if result.counts.get('Мегафон'):
+            megafon_first = result.samples['Мегафон'][0]
+            print(f"\n[Мегафон] Найдено {result.counts['Мегафон']} записей")
             print(f"    [ЗАГЛУШКА] Функция экспорта для Мегафон находится в разработке")
-            print(f"    [ПРИМЕР] Первая запись: ICCID={operator_data['Мегафон'][0]['iccid']}, IMEI={operator_data['Мегафон'][0]['imei']}")
+            print(f"    [ПРИМЕР] Первая запись: ICCID={megafon_first['iccid']}, IMEI={megafon_first['imei']}")
         
-        if unknown_operator:
-            print(f"\n[ВНИМАНИЕ] Найдено {len(unknown_operator)} записей с неизвестным оператором")
+        if result.unknown:
+            print(f"\n[ВНИМАНИЕ] Найдено {len(result.unknown)} записей с неизвестным оператором")
             print("    [ПРИМЕР] Первые 3 записи:")
-            for i, item in enumerate(unknown_operator[:3], 1):
+            for i, item in enumerate(result.unknown[:3], 1):
                 print(f"        {i}. Строка {item['row']}: ICCID={item['iccid']}, IMEI={item['imei']}")
         
+        # Изменения с прошлой выгрузки (только при deltas)
+        if deltas and result.delta_counts:
+            print("\n" + "=" * 60)
+            print("    ИЗМЕНЕНИЯ С ПРОШЛОЙ ВЫГРУЗКИ")
+            print("=" * 60)
+            for op_name, counts in result.delta_counts.items():
+                print(f"    {op_name}: добавлено {counts['added']}, удалено {counts['removed']}")
+                for delta_file in result.delta_files.get(op_name, []):
+                    print(f"        {delta_file}")
+        elif deltas:
+            print("\n[ИНФО] Прошлой выгрузки нет - файлы изменений появятся со следующего запуска")
+        
         print("\n" + "=" * 60)
         print("    ВЫГРУЗКА ЗАВЕРШЕНА")
         print("=" * 60)
-        print(f"[ИНФО] Файлы сохранены в директории: {output_dir}")
+        print(f"[ИНФО] Файлы сохранены в директории: {result.output_dir}")
+        print(f"[ИНФО] Время выгрузки: {result.timings['total']:.2f} с (чтение {result.timings['read']:.2f} с, "
+              f"классификация {result.timings['classify']:.2f} с, запись {result.timings['write']:.2f} с)")
         
         return True
         
@@ -332,6 +240,7 @@ def export_iccid_imei():
 
 
 if __name__ == "__main__":
-    success = export_iccid_imei()
+    # --deltas: файлы изменений, как у плановой выгрузки bot3 (сдвигает ее точку отсчета)
+    success = export_iccid_imei(deltas='--deltas' in sys.argv[1:])
     sys.exit(0 if success else 1)
 
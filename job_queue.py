@@ -0,0 +1,109 @@
+import queue
+import threading
+import traceback
+from typing import Any, Callable, Dict, Optional
+
+
+class JobQueue:
+    """
+    Ограниченная очередь задач с пулом рабочих потоков.
+
+    Обработчик webhook только кладет событие в очередь и сразу отвечает
+    Pachka, а команды (/active с загрузкой таблицы и отправкой сообщений)
+    выполняются рабочими потоками. Медленные команды не занимают потоки
+    HTTP сервера. Если очередь заполнена, submit возвращает False и
+    запрос отклоняется, а не копится в памяти без ограничений.
+    """
+
+    def __init__(self, workers: int = 4, max_size: int = 100, name: str = 'bot-jobs'):
+        """
+        Args:
+            workers (int): Число рабочих потоков
+            max_size (int): Максимум задач, ожидающих выполнения
+            name (str): Префикс имен рабочих потоков
+        """
+        self.workers = workers
+        self.max_size = max_size
+        self._queue: queue.Queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'{name}-{index + 1}', daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> bool:
+        """
+        Ставит задачу в очередь, не дожидаясь ее выполнения
+
+        Args:
+            func (Callable[..., Any]): Функция задачи
+            *args, **kwargs: Аргументы функции
+
+        Returns:
+            bool: True, если задача принята; False, если очередь заполнена
+        """
+        try:
+            self._queue.put_nowait((func, args, kwargs))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            func, args, kwargs = job
+            with self._lock:
+                self._active += 1
+            failed = True
+            try:
+                func(*args, **kwargs)
+                failed = False
+            except Exception as e:
+                print(f"Ошибка в фоновой задаче {getattr(func, '__name__', func)}: {e}")
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    if failed:
+                        self._failed += 1
+                    else:
+                        self._completed += 1
+                self._queue.task_done()
+
+    def stats(self) -> Dict:
+        """
+        Состояние очереди для мониторинга (/health)
+        """
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'max_size': self.max_size,
+                'workers': self.workers,
+                'active': self._active,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+            }
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Дожидается выполнения поставленных задач и останавливает рабочие потоки
+
+        Args:
+            timeout (Optional[float]): Сколько ждать каждый поток, секунды
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
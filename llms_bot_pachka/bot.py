@@ -1,17 +1,19 @@
-import requests
 import json
 import os
 import logging
-import time
 import sys
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from datetime import datetime
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from google_sheets_processor import GoogleSheetsProcessor
+from google_sheets_processor import GoogleSheetsProcessor, SheetsNotReadyError
+from job_queue import JobQueue
+from rate_limiter import RateLimiter
+from pachka_http import PachkaSession, RetryPolicy
+from message_outbox import DeliveryError, MessageOutbox
 
 # Загружаем переменные окружения из файла .env
 load_dotenv()
@@ -41,8 +43,12 @@ class PachkaBot:
         self.webhook_url = os.getenv("PACHKA_WEBHOOK_URL", "https://api.pachca.com/webhooks/01JXFJQRHMZR8ME5KHRY35CR05")
         # Базовый URL для API Pachka
         self.api_base_url = "https://api.pachca.com"
-        self.last_message_time = 0
-        self.min_delay = 2  # Минимальная задержка между сообщениями в секундах
+        # Ограничение частоты сообщений: отдельно на каждый чат и общее на бота
+        self.rate_limiter = RateLimiter(
+            per_key_rate=float(os.getenv('PACHKA_CHAT_RATE', '0.5')),
+            per_key_burst=float(os.getenv('PACHKA_CHAT_BURST', '3')),
+            global_rate=float(os.getenv('PACHKA_GLOBAL_RATE', '2')),
+            global_burst=float(os.getenv('PACHKA_GLOBAL_BURST', '5')))
         
         # API токен для отправки в конкретные чаты
         self.api_token = os.getenv("PACHKA_API_TOKEN")
@@ -58,10 +64,35 @@ class PachkaBot:
             else:
                 logger.warning("PACHKA_API_TOKEN format is unknown")
         
+        # Общая сессия HTTP для всех запросов к Pachka: пул keep-alive соединений и единые таймауты.
+        # Все сообщения уходят через очередь, она и повторяет неудачные - сессия не повторяет сама
+        self.http = PachkaSession(
+            pool_size=int(os.getenv('PACHKA_POOL_SIZE', '10')),
+            connect_timeout=float(os.getenv('PACHKA_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.getenv('PACHKA_READ_TIMEOUT', '10')),
+            retry_policy=RetryPolicy.without_retries())
+        
+        # Исходящие сообщения пишутся в очередь SQLite и отправляются фоновым диспетчером;
+        # неотправленные досылаются после перезапуска
+        outbox_path = os.path.join(os.getenv('PACHKA_OUTBOX_DIR', '.'),
+                                   f"pachka_outbox_{os.getenv('SERVER_PORT', '5000')}.sqlite3")
+        self.outbox = MessageOutbox(outbox_path, self._deliver_message,
+                                    max_attempts=int(os.getenv('PACHKA_OUTBOX_MAX_ATTEMPTS', '10')),
+                                    budget=self.http.retry_policy.budget)
+        
+        # Команды выполняются пулом рабочих потоков: webhook только ставит событие в очередь
+        self.jobs = JobQueue(workers=int(os.getenv('BOT_WORKERS', '4')),
+                             max_size=int(os.getenv('BOT_QUEUE_SIZE', '100')))
+        
         # Инициализируем Google Sheets процессор
         try:
-            self.sheets_processor = GoogleSheetsProcessor()
-            logger.info("Google Sheets processor initialized successfully")
+            # Для /active достаточно нескольких столбцов - не скачиваем лист целиком
+            # Подключение к Google идет в фоне, сервер стартует не дожидаясь его
+            self.sheets_processor = GoogleSheetsProcessor(columns=GoogleSheetsProcessor.LOOKUP_COLUMNS, lazy=True)
+            logger.info("Google Sheets processor created, connecting in background")
+            # Прогреваем кэш таблицы в фоне и поддерживаем его свежим
+            self.sheets_processor.warm_up(wait=False)
+            self.sheets_processor.start_background_refresh()
         except Exception as e:
             logger.error(f"Failed to initialize Google Sheets processor: {e}")
             self.sheets_processor = None
@@ -70,19 +101,41 @@ class PachkaBot:
 
     def send_api_message(self, message: str, chat_id: str) -> bool:
         """
-        Отправляет сообщение через API в конкретный чат
+        Ставит сообщение в очередь на отправку через API в конкретный чат
         """
         if not self.api_token:
             logger.error("API token not available for sending to specific chat")
             return False
+        return self.outbox.put('api', chat_id, message)
+
+    def _deliver_message(self, channel: str, chat_id: Optional[str], message: str) -> bool:
+        """
+        Отправляет сообщение из очереди (вызывается диспетчером очереди)
+
+        Returns:
+            bool: True, если сообщение отправлено
+
+        Raises:
+            DeliveryError: Сообщение не отправлено (можно ли повторить и когда)
+        """
+        if channel == 'api':
+            return self._deliver_api_message(message, chat_id)
+        if channel == 'webhook_only':
+            return self._deliver_webhook_only_message(message)
+        return self._deliver_webhook_message(message, chat_id)
+
+    def _deliver_api_message(self, message: str, chat_id: str) -> bool:
+        """
+        Отправляет сообщение через API в конкретный чат
+        """
+        if not self.api_token:
+            logger.error("API token not available for sending to specific chat")
+            raise DeliveryError("API token not available", permanent=True)
             
-        # Добавляем задержку между сообщениями
-        current_time = time.time()
-        time_since_last = current_time - self.last_message_time
-        if time_since_last < self.min_delay:
-            delay = self.min_delay - time_since_last
-            logger.info(f"Waiting {delay:.1f} seconds before sending message")
-            time.sleep(delay)
+        # Ждем слота отправки в этот чат (ограничение частоты на чат и на бота)
+        delay = self.rate_limiter.wait(f"chat:{chat_id}")
+        if delay > 0:
+            logger.info(f"Waited {delay:.1f} seconds for rate limit before sending message")
         
         # Используем правильный API endpoint для Pachka согласно документации
         url = "https://api.pachca.com/messages"
@@ -112,62 +165,56 @@ class PachkaBot:
     def _try_api_request(self, url: str, data: dict, headers: dict) -> bool:
         """
         Вспомогательный метод для выполнения API запроса
+
+        Raises:
+            DeliveryError: Запрос не прошел (повторять ли его, решает очередь)
         """
         logger.info(f"Making API request to: {url}")
         logger.info(f"Request headers: {headers}")
         logger.info(f"Request data: {data}")
         
         try:
-            response = requests.post(url, json=data, headers=headers, timeout=10)
-            self.last_message_time = time.time()
-            logger.info(f"API response: {response.status_code}")
-            logger.info(f"Response headers: {response.headers}")
-            logger.info(f"Response content: {response.text}")
-            
-            if response.status_code == 200:
-                logger.info("API message sent successfully")
-                return True
-            elif response.status_code == 401:
-                logger.error("API authentication failed (401) - check API token")
-                return False
-            elif response.status_code == 403:
-                logger.error("API access forbidden (403) - check permissions")
-                return False
-            elif response.status_code == 404:
-                logger.error("API endpoint not found (404) - check URL")
-                return False
-            elif response.status_code == 429:
-                logger.warning("Rate limit reached (429), waiting 5 seconds")
-                time.sleep(5)
-                # Повторная попытка
-                response = requests.post(url, json=data, headers=headers, timeout=10)
-                self.last_message_time = time.time()
-                if response.status_code == 200:
-                    logger.info("API message sent successfully after retry")
-                    return True
-                else:
-                    logger.error(f"API error after retry: {response.status_code}")
-                    return False
-            else:
-                logger.error(f"API error: {response.status_code} - {response.text}")
-                return False
-                
+            response = self.http.post(url, json=data, headers=headers)
         except Exception as e:
             logger.error(f"API exception: {e}")
-            return False
+            raise DeliveryError(str(e)) from e
+        
+        logger.info(f"API response: {response.status_code}")
+        logger.info(f"Response headers: {response.headers}")
+        logger.info(f"Response content: {response.text}")
+        
+        if response.status_code == 200:
+            logger.info("API message sent successfully")
+            return True
+        elif response.status_code == 401:
+            logger.error("API authentication failed (401) - check API token")
+        elif response.status_code == 403:
+            logger.error("API access forbidden (403) - check permissions")
+        elif response.status_code == 404:
+            logger.error("API endpoint not found (404) - check URL")
+        elif response.status_code == 429:
+            # Повторы с учетом Retry-After уже выполнены сессией - лимит так и не освободился
+            logger.error("API rate limit reached (429), retries exhausted")
+        else:
+            logger.error(f"API error: {response.status_code} - {response.text}")
+        raise DeliveryError.from_response(response)
 
     def send_webhook_message(self, message: str, chat_id: str = None) -> bool:
+        """
+        Ставит сообщение в очередь на отправку через webhook (или через API в чат chat_id)
+        
+        Returns:
+            bool: True, если сообщение сохранено в очереди
+        """
+        return self.outbox.put('webhook', chat_id, message)
+
+    def _deliver_webhook_message(self, message: str, chat_id: str = None) -> bool:
         """
         Отправляет сообщение через webhook с задержкой
+
+        Raises:
+            DeliveryError: Сообщение не отправлено ни через API, ни через webhook
         """
-        # Добавляем задержку между сообщениями
-        current_time = time.time()
-        time_since_last = current_time - self.last_message_time
-        if time_since_last < self.min_delay:
-            delay = self.min_delay - time_since_last
-            logger.info(f"Waiting {delay:.1f} seconds before sending message")
-            time.sleep(delay)
-        
         # Если указан chat_id, используем API для отправки в конкретный чат
         if chat_id:
             logger.info(f"Using API to send message to specific chat {chat_id}")
@@ -176,11 +223,12 @@ class PachkaBot:
             if use_api and self.api_token:
                 # Пытаемся отправить через API
                 logger.info(f"Attempting to send via API with token: {self.api_token[:10]}...")
-                if self.send_api_message(message, chat_id):
+                try:
+                    self._deliver_api_message(message, chat_id)
                     logger.info("API message sent successfully")
                     return True
-                else:
-                    logger.warning("API failed, falling back to webhook (message will go to general channel)")
+                except DeliveryError as e:
+                    logger.warning(f"API failed ({e}), falling back to webhook (message will go to general channel)")
                     # Fallback на webhook без chat_id (отправится в общий канал)
                     # Добавляем префикс, чтобы показать, что это ответ на команду из другого чата
                     original_message = message
@@ -210,46 +258,50 @@ class PachkaBot:
             logger.info(f"Webhook URL: {self.webhook_url}")
             logger.info(f"Data: {data}")
             
+            # Все сообщения через webhook идут в один канал - у них общая корзина
+            delay = self.rate_limiter.wait("webhook")
+            if delay > 0:
+                logger.info(f"Waited {delay:.1f} seconds for rate limit before sending webhook message")
+            
             try:
                 headers = {
                     "Content-Type": "application/json",
                     "User-Agent": "PachkaBot/1.0"
                 }
-                response = requests.post(self.webhook_url, json=data, headers=headers, timeout=10)
-                self.last_message_time = time.time()
-                logger.info(f"Webhook response: {response.status_code}")
-                logger.info(f"Response headers: {response.headers}")
-                
-                if response.status_code == 200:
-                    logger.info("Webhook message sent successfully")
-                    logger.info(f"Response content: {response.text}")
-                    return True
-                elif response.status_code == 429:
-                    logger.warning("Rate limit reached (429), waiting 5 seconds")
-                    time.sleep(5)
-                    # Повторная попытка
-                    response = requests.post(self.webhook_url, json=data, timeout=10)
-                    self.last_message_time = time.time()
-                    if response.status_code == 200:
-                        logger.info("Webhook message sent successfully after retry")
-                        return True
-                    else:
-                        logger.error(f"Webhook error after retry: {response.status_code}")
-                        return False
-                else:
-                    logger.error(f"Webhook error: {response.status_code} - {response.text}")
-                    return False
-                    
+                response = self.http.post(self.webhook_url, json=data, headers=headers)
             except Exception as e:
                 logger.error(f"Webhook exception: {e}")
-                return False
+                raise DeliveryError(str(e)) from e
+            
+            logger.info(f"Webhook response: {response.status_code}")
+            logger.info(f"Response headers: {response.headers}")
+            
+            if response.status_code == 200:
+                logger.info("Webhook message sent successfully")
+                logger.info(f"Response content: {response.text}")
+                return True
+            elif response.status_code == 429:
+                # Повторы с учетом Retry-After уже выполнены сессией - лимит так и не освободился
+                logger.error("Webhook rate limit reached (429), retries exhausted")
+            else:
+                logger.error(f"Webhook error: {response.status_code} - {response.text}")
+            raise DeliveryError.from_response(response)
         else:
             logger.warning(f"chat_id is still set ({chat_id}), but API is disabled. Message not sent.")
-            return False
+            raise DeliveryError("API is disabled for chat messages", permanent=True)
 
     def send_webhook_only_message(self, message: str) -> bool:
+        """
+        Ставит в очередь сообщение только для webhook (для общих уведомлений)
+        """
+        return self.outbox.put('webhook_only', None, message)
+
+    def _deliver_webhook_only_message(self, message: str) -> bool:
         """
         Отправляет сообщение только через webhook (для общих уведомлений)
+
+        Raises:
+            DeliveryError: Сообщение не отправлено
         """
         # ВАЖНО: НИКОГДА НЕ МЕНЯТЬ "message" на "text" - это сломает работу webhook!
         data = {
@@ -258,21 +310,31 @@ class PachkaBot:
         
         logger.info(f"Sending webhook only message: {message}")
         
+        self.rate_limiter.wait("webhook")
+        
         try:
-            response = requests.post(self.webhook_url, json=data, timeout=10)
-            logger.info(f"Webhook only response: {response.status_code}")
-            
-            if response.status_code == 200:
-                logger.info("Webhook only message sent successfully")
-                logger.info(f"Response content: {response.text}")
-                return True
-            else:
-                logger.error(f"Webhook only error: {response.status_code} - {response.text}")
-                return False
-                
+            response = self.http.post(self.webhook_url, json=data)
         except Exception as e:
             logger.error(f"Webhook only exception: {e}")
-            return False
+            raise DeliveryError(str(e)) from e
+        
+        logger.info(f"Webhook only response: {response.status_code}")
+        
+        if response.status_code == 200:
+            logger.info("Webhook only message sent successfully")
+            logger.info(f"Response content: {response.text}")
+            return True
+        logger.error(f"Webhook only error: {response.status_code} - {response.text}")
+        raise DeliveryError.from_response(response)
+
+    def _send_sheets_not_ready(self, chat_id: str = None) -> None:
+        """
+        Сообщает, что таблица еще загружается (подключение к Google Sheets не завершено)
+        """
+        error_msg = "⏳ Подключение к Google Sheets еще устанавливается. Повторите команду через минуту."
+        if self.sheets_processor.connect_error:
+            error_msg += f"\nПоследняя ошибка: {self.sheets_processor.connect_error}"
+        self.send_webhook_message(error_msg, chat_id)
 
     def check_sim_activity(self, chat_id: str = None, router_name: str = None) -> None:
         """
@@ -290,9 +352,19 @@ class PachkaBot:
                 self.send_webhook_message(error_msg, chat_id)
                 return
             
+            # Подключение к Google Sheets могло еще не завершиться после запуска
+            # Снимок из локального зеркала позволяет отвечать и без связи с Google
+            if not self.sheets_processor.has_data and not self.sheets_processor.wait_ready(timeout=10):
+                self._send_sheets_not_ready(chat_id)
+                return
+            
             # Ищем данные в Google Sheets
             logger.info(f"Searching for router: {router_name} in Google Sheets")
-            results = self.sheets_processor.search_by_name(router_name)
+            try:
+                results = self.sheets_processor.search_by_name(router_name)
+            except SheetsNotReadyError:
+                self._send_sheets_not_ready(chat_id)
+                return
             
             if not results:
                 # Устройство не найдено
@@ -382,19 +454,19 @@ class PachkaBot:
                 logger.info("Sending welcome message")
                 # Отправляем в тот же чат, откуда пришла команда
                 if self.send_webhook_message(welcome_message, chat_id):
-                    logger.info("Welcome message sent")
+                    logger.info("Welcome message queued for sending")
                 else:
-                    logger.error("Error sending welcome message")
+                    logger.error("Error queueing welcome message")
                     
             elif command.lower().startswith("new "):
                 # Команда /new
                 text = command[4:].strip()  # Убираем "new " из начала
                 if text:
-                    logger.info(f"Sending new text via webhook: {text}")
+                    logger.info(f"Queueing new text for sending: {text}")
                     if self.send_webhook_message(text, chat_id):
-                        self.send_webhook_message(f"Text '{text}' sent successfully via webhook", chat_id)
+                        self.send_webhook_message(f"Text '{text}' queued for sending", chat_id)
                     else:
-                        self.send_webhook_message("Error sending text via webhook", chat_id)
+                        self.send_webhook_message("Error queueing text for sending", chat_id)
                 else:
                     self.send_webhook_message("Please specify text after /new command", chat_id)
                     
@@ -418,11 +490,11 @@ class PachkaBot:
                     
             else:
                 # Отправляем команду через webhook
-                logger.info(f"Sending command via webhook: {command}")
+                logger.info(f"Queueing command for sending: {command}")
                 if self.send_webhook_message(command, chat_id):
-                    self.send_webhook_message("Command sent successfully", chat_id)
+                    self.send_webhook_message("Command queued for sending", chat_id)
                 else:
-                    self.send_webhook_message("Error sending command", chat_id)
+                    self.send_webhook_message("Error queueing command for sending", chat_id)
             
         except Exception as e:
             logger.error(f"Error processing command: {e}")
@@ -495,7 +567,10 @@ def root_webhook():
                 logger.error("Empty data in webhook")
                 return jsonify({"status": "error", "message": "Empty data"}), 400
                 
-            bot.handle_webhook_event(event_data)
+            # Команда выполняется в фоне, Pachka сразу получает ответ
+            if not bot.jobs.submit(bot.handle_webhook_event, event_data):
+                logger.error("Job queue is full, rejecting webhook")
+                return jsonify({"status": "error", "message": "Bot is busy"}), 503
             return jsonify({"status": "ok"})
             
         except Exception as e:
@@ -518,7 +593,10 @@ def webhook():
                 logger.error("Empty data in webhook")
                 return jsonify({"status": "error", "message": "Empty data"}), 400
                 
-            bot.handle_webhook_event(event_data)
+            # Команда выполняется в фоне, Pachka сразу получает ответ
+            if not bot.jobs.submit(bot.handle_webhook_event, event_data):
+                logger.error("Job queue is full, rejecting webhook")
+                return jsonify({"status": "error", "message": "Bot is busy"}), 503
             return jsonify({"status": "ok"})
             
         except Exception as e:
@@ -532,7 +610,14 @@ def health_check():
     """
     Проверка здоровья сервера
     """
-    return jsonify({"status": "ok", "timestamp": datetime.now().isoformat()})
+    return jsonify({
+        "status": "ok",
+        "timestamp": datetime.now().isoformat(),
+        "sheets": bot.sheets_processor.status() if bot.sheets_processor else None,
+        "jobs": bot.jobs.stats(),
+        "http": bot.http.stats(),
+        "outbox": bot.outbox.stats()
+    })
 
 def main():
     logger.info("Starting Pachka bot (simplified version)...")
@@ -540,7 +625,7 @@ def main():
     # Отправляем тестовое сообщение через webhook
     logger.info("Sending test message...")
     if bot.send_webhook_message("bot is running and ready to work"):
-        logger.info("Test message sent successfully")
+        logger.info("Test message queued for sending")
     else:
         logger.error("Error sending test message")
     
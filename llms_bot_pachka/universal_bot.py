@@ -1,15 +1,14 @@
-import requests
 import json
 import os
 import logging
 import time
 import sys
-import subprocess
+import threading
 import base64
-import glob
 from pathlib import Path
-from typing import Dict, Any, List, Optional
-from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Dict, Any, List, Optional, Set
+from datetime import datetime
 from flask import Flask, request, jsonify, send_file
 from dotenv import load_dotenv
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -18,7 +17,13 @@ import pytz
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from google_sheets_processor import GoogleSheetsProcessor
+from google_sheets_processor import GoogleSheetsProcessor, SheetsNotReadyError
+from job_queue import JobQueue
+from rate_limiter import RateLimiter
+from pachka_http import PachkaSession, RetryPolicy
+from message_outbox import DeliveryError, MessageOutbox
+from iccid_imei_export.exporter import EXPORTS_DIR, ExportError, ExportResult, run_export
+from iccid_imei_export.export_manifest import ExportManifest
 
 # Загружаем переменные окружения из файла .env
 load_dotenv()
@@ -59,18 +64,57 @@ class UniversalPachkaBot:
             self.port == 5002
         )
         
-        # Хранилище для последней ошибки скрипта
-        self._last_script_error = None
+        # Последняя ошибка выгрузки для сообщения в чат
+        self._last_export_error = None
+        # Выгрузка ICCID:IMEI выполняется в процессе бота в отдельном потоке
+        self.export_timeout = float(os.getenv('EXPORT_TIMEOUT', '300'))
+        self._export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='iccid-export')
+        self._export_future = None
         
         # API настройки
         self.api_base_url = "https://api.pachca.com"
-        self.last_message_time = 0
-        self.min_delay = 2  # Минимальная задержка между сообщениями в секундах
+        # Ограничение частоты сообщений: отдельно на каждый чат и общее на бота
+        self.rate_limiter = RateLimiter(
+            per_key_rate=float(os.getenv('PACHKA_CHAT_RATE', '0.5')),
+            per_key_burst=float(os.getenv('PACHKA_CHAT_BURST', '3')),
+            global_rate=float(os.getenv('PACHKA_GLOBAL_RATE', '2')),
+            global_burst=float(os.getenv('PACHKA_GLOBAL_BURST', '5')))
+        
+        # Общая сессия HTTP для всех запросов к Pachka: пул keep-alive соединений и единые таймауты.
+        # Все сообщения уходят через очередь, она и повторяет неудачные - сессия не повторяет сама
+        self.http = PachkaSession(
+            pool_size=int(os.getenv('PACHKA_POOL_SIZE', '10')),
+            connect_timeout=float(os.getenv('PACHKA_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.getenv('PACHKA_READ_TIMEOUT', '10')),
+            retry_policy=RetryPolicy.without_retries())
+        
+        # Исходящие сообщения пишутся в очередь SQLite и отправляются фоновым диспетчером;
+        # неотправленные досылаются после перезапуска
+        outbox_path = os.path.join(os.getenv('PACHKA_OUTBOX_DIR', '.'), f'pachka_outbox_{self.port}.sqlite3')
+        self.outbox = MessageOutbox(outbox_path, self._deliver_message,
+                                    max_attempts=int(os.getenv('PACHKA_OUTBOX_MAX_ATTEMPTS', '10')),
+                                    budget=self.http.retry_policy.budget)
+        
+        # Команды выполняются пулом рабочих потоков: webhook только ставит событие в очередь
+        self.jobs = JobQueue(workers=int(os.getenv('BOT_WORKERS', '4')),
+                             max_size=int(os.getenv('BOT_QUEUE_SIZE', '100')))
         
         # Инициализируем Google Sheets процессор
         try:
-            self.sheets_processor = GoogleSheetsProcessor()
-            logger.info(f"[{self.name}] Google Sheets processor initialized successfully")
+            # Подключение к Google идет в фоне, сервер стартует не дожидаясь его
+            if self.is_bot3:
+                # bot3 выполняет только ежедневную выгрузку: она читает два нужных столбца
+                # частями раз в день, поэтому снимок листа, зеркало и фоновое обновление не нужны
+                self.sheets_processor = GoogleSheetsProcessor(lazy=True, mirror_path='')
+                logger.info(f"[{self.name}] Google Sheets processor created, connecting in background")
+            else:
+                # Для /active достаточно нескольких столбцов - не скачиваем лист целиком
+                self.sheets_processor = GoogleSheetsProcessor(columns=GoogleSheetsProcessor.LOOKUP_COLUMNS,
+                                                              lazy=True)
+                logger.info(f"[{self.name}] Google Sheets processor created, connecting in background")
+                # Прогреваем кэш таблицы в фоне и поддерживаем его свежим
+                self.sheets_processor.warm_up(wait=False)
+                self.sheets_processor.start_background_refresh()
         except Exception as e:
             logger.error(f"[{self.name}] Failed to initialize Google Sheets processor: {e}")
             self.sheets_processor = None
@@ -79,20 +123,41 @@ class UniversalPachkaBot:
 
     def send_api_message(self, message: str, chat_id) -> bool:
         """
-        Отправляет сообщение через API в конкретный чат
+        Ставит сообщение в очередь на отправку через API в конкретный чат
         chat_id может быть строкой или числом
         """
         if not self.access_token:
             logger.error(f"[{self.name}] Access token not available for sending to specific chat")
             return False
+        return self.outbox.put('api', chat_id, message)
+
+    def _deliver_message(self, channel: str, chat_id: Optional[str], message: str) -> bool:
+        """
+        Отправляет сообщение из очереди (вызывается диспетчером очереди)
+
+        Returns:
+            bool: True, если сообщение отправлено
+
+        Raises:
+            DeliveryError: Сообщение не отправлено (можно ли повторить и когда)
+        """
+        if channel == 'api':
+            return self._deliver_api_message(message, chat_id)
+        return self._deliver_webhook_message(message, chat_id)
+
+    def _deliver_api_message(self, message: str, chat_id) -> bool:
+        """
+        Отправляет сообщение через API в конкретный чат
+        chat_id может быть строкой или числом
+        """
+        if not self.access_token:
+            logger.error(f"[{self.name}] Access token not available for sending to specific chat")
+            raise DeliveryError("access token not available", permanent=True)
             
-        # Добавляем задержку между сообщениями
-        current_time = time.time()
-        time_since_last = current_time - self.last_message_time
-        if time_since_last < self.min_delay:
-            delay = self.min_delay - time_since_last
-            logger.info(f"[{self.name}] Waiting {delay:.1f} seconds before sending message")
-            time.sleep(delay)
+        # Ждем слота отправки в этот чат (ограничение частоты на чат и на бота)
+        delay = self.rate_limiter.wait(f"chat:{chat_id}")
+        if delay > 0:
+            logger.info(f"[{self.name}] Waited {delay:.1f} seconds for rate limit before sending message")
         
         # Используем правильный API endpoint для Pachka согласно документации
         url = f"{self.api_base_url}/messages"
@@ -103,7 +168,7 @@ class UniversalPachkaBot:
             entity_id = int(chat_id) if chat_id else None
         except (ValueError, TypeError):
             logger.error(f"[{self.name}] Invalid chat_id: {chat_id}, must be a number")
-            return False
+            raise DeliveryError(f"invalid chat_id: {chat_id}", permanent=True)
         
         data = {
             "message": {
@@ -129,62 +194,56 @@ class UniversalPachkaBot:
     def _try_api_request(self, url: str, data: dict, headers: dict) -> bool:
         """
         Вспомогательный метод для выполнения API запроса
+
+        Raises:
+            DeliveryError: Запрос не прошел (повторять ли его, решает очередь)
         """
         logger.info(f"[{self.name}] Making API request to: {url}")
         logger.info(f"[{self.name}] Request headers: {headers}")
         logger.info(f"[{self.name}] Request data: {data}")
         
         try:
-            response = requests.post(url, json=data, headers=headers, timeout=10)
-            self.last_message_time = time.time()
-            logger.info(f"[{self.name}] API response: {response.status_code}")
-            logger.info(f"[{self.name}] Response headers: {response.headers}")
-            logger.info(f"[{self.name}] Response content: {response.text}")
-            
-            if response.status_code == 200:
-                logger.info(f"[{self.name}] API message sent successfully")
-                return True
-            elif response.status_code == 401:
-                logger.error(f"[{self.name}] API authentication failed (401) - check access token")
-                return False
-            elif response.status_code == 403:
-                logger.error(f"[{self.name}] API access forbidden (403) - check permissions")
-                return False
-            elif response.status_code == 404:
-                logger.error(f"[{self.name}] API endpoint not found (404) - check URL")
-                return False
-            elif response.status_code == 429:
-                logger.warning(f"[{self.name}] Rate limit reached (429), waiting 5 seconds")
-                time.sleep(5)
-                # Повторная попытка
-                response = requests.post(url, json=data, headers=headers, timeout=10)
-                self.last_message_time = time.time()
-                if response.status_code == 200:
-                    logger.info(f"[{self.name}] API message sent successfully after retry")
-                    return True
-                else:
-                    logger.error(f"[{self.name}] API error after retry: {response.status_code}")
-                    return False
-            else:
-                logger.error(f"[{self.name}] API error: {response.status_code} - {response.text}")
-                return False
-                
+            response = self.http.post(url, json=data, headers=headers)
         except Exception as e:
             logger.error(f"[{self.name}] API exception: {e}")
-            return False
+            raise DeliveryError(str(e)) from e
+        
+        logger.info(f"[{self.name}] API response: {response.status_code}")
+        logger.info(f"[{self.name}] Response headers: {response.headers}")
+        logger.info(f"[{self.name}] Response content: {response.text}")
+        
+        if response.status_code == 200:
+            logger.info(f"[{self.name}] API message sent successfully")
+            return True
+        elif response.status_code == 401:
+            logger.error(f"[{self.name}] API authentication failed (401) - check access token")
+        elif response.status_code == 403:
+            logger.error(f"[{self.name}] API access forbidden (403) - check permissions")
+        elif response.status_code == 404:
+            logger.error(f"[{self.name}] API endpoint not found (404) - check URL")
+        elif response.status_code == 429:
+            # Повторы с учетом Retry-After уже выполнены сессией - лимит так и не освободился
+            logger.error(f"[{self.name}] API rate limit reached (429), retries exhausted")
+        else:
+            logger.error(f"[{self.name}] API error: {response.status_code} - {response.text}")
+        raise DeliveryError.from_response(response)
 
     def send_webhook_message(self, message: str, chat_id: str = None) -> bool:
+        """
+        Ставит сообщение в очередь на отправку через webhook (или через API в чат chat_id)
+        
+        Returns:
+            bool: True, если сообщение сохранено в очереди
+        """
+        return self.outbox.put('webhook', chat_id, message)
+
+    def _deliver_webhook_message(self, message: str, chat_id: str = None) -> bool:
         """
         Отправляет сообщение через webhook с задержкой
+
+        Raises:
+            DeliveryError: Сообщение не отправлено ни через API, ни через webhook
         """
-        # Добавляем задержку между сообщениями
-        current_time = time.time()
-        time_since_last = current_time - self.last_message_time
-        if time_since_last < self.min_delay:
-            delay = self.min_delay - time_since_last
-            logger.info(f"[{self.name}] Waiting {delay:.1f} seconds before sending message")
-            time.sleep(delay)
-        
         # Если указан chat_id и это НЕ bot3, используем API для отправки в конкретный чат
         # Для bot3 по ТЗ используем только webhook (вариант A - быстрый), без API,
         # поэтому ветка с API для него отключена
@@ -193,11 +252,12 @@ class UniversalPachkaBot:
             if self.access_token:
                 # Пытаемся отправить через API
                 logger.info(f"[{self.name}] Attempting to send via API with token: {self.access_token[:10]}...")
-                if self.send_api_message(message, chat_id):
+                try:
+                    self._deliver_api_message(message, chat_id)
                     logger.info(f"[{self.name}] API message sent successfully")
                     return True
-                else:
-                    logger.warning(f"[{self.name}] API failed, falling back to webhook (message will go to general channel)")
+                except DeliveryError as e:
+                    logger.warning(f"[{self.name}] API failed ({e}), falling back to webhook (message will go to general channel)")
                     # Fallback на webhook без chat_id (отправится в общий канал)
                     # Добавляем префикс, чтобы показать, что это ответ на команду из другого чата
                     original_message = message
@@ -228,43 +288,38 @@ class UniversalPachkaBot:
             logger.info(f"[{self.name}] Webhook URL: {self.webhook_incoming}")
             logger.info(f"[{self.name}] Data: {data}")
             
+            # Все сообщения через webhook идут в один канал - у них общая корзина
+            delay = self.rate_limiter.wait("webhook")
+            if delay > 0:
+                logger.info(f"[{self.name}] Waited {delay:.1f} seconds for rate limit before sending webhook message")
+            
             try:
                 headers = {
                     "Content-Type": "application/json",
                     "User-Agent": "PachkaBot/1.0"
                 }
-                response = requests.post(self.webhook_incoming, json=data, headers=headers, timeout=10)
-                self.last_message_time = time.time()
-                logger.info(f"[{self.name}] Webhook response: {response.status_code}")
-                logger.info(f"[{self.name}] Response headers: {response.headers}")
-                
-                if response.status_code == 200:
-                    logger.info(f"[{self.name}] Webhook message sent successfully")
-                    logger.info(f"[{self.name}] Response content: {response.text}")
-                    return True
-                elif response.status_code == 429:
-                    logger.warning(f"[{self.name}] Rate limit reached (429), waiting 5 seconds")
-                    time.sleep(5)
-                    # Повторная попытка
-                    response = requests.post(self.webhook_incoming, json=data, timeout=10)
-                    self.last_message_time = time.time()
-                    if response.status_code == 200:
-                        logger.info(f"[{self.name}] Webhook message sent successfully after retry")
-                        return True
-                    else:
-                        logger.error(f"[{self.name}] Webhook error after retry: {response.status_code}")
-                        return False
-                else:
-                    logger.error(f"[{self.name}] Webhook error: {response.status_code} - {response.text}")
-                    return False
-                    
+                response = self.http.post(self.webhook_incoming, json=data, headers=headers)
             except Exception as e:
                 logger.error(f"[{self.name}] Webhook exception: {e}")
-                return False
+                raise DeliveryError(str(e)) from e
+            
+            logger.info(f"[{self.name}] Webhook response: {response.status_code}")
+            logger.info(f"[{self.name}] Response headers: {response.headers}")
+            
+            if response.status_code == 200:
+                logger.info(f"[{self.name}] Webhook message sent successfully")
+                logger.info(f"[{self.name}] Response content: {response.text}")
+                return True
+            elif response.status_code == 429:
+                # Повторы с учетом Retry-After уже выполнены сессией - лимит так и не освободился
+                logger.error(f"[{self.name}] Webhook rate limit reached (429), retries exhausted")
+            else:
+                logger.error(f"[{self.name}] Webhook error: {response.status_code} - {response.text}")
+            raise DeliveryError.from_response(response)
         else:
             # Сюда попадем только для ботов, у которых API отключен и chat_id остался установлен.
             logger.warning(f"[{self.name}] chat_id is still set ({chat_id}), but API is disabled. Message not sent.")
-            return False
+            raise DeliveryError("API is disabled for chat messages", permanent=True)
 
     def process_command(self, command: str, chat_id: str = None) -> None:
         """
@@ -300,9 +355,9 @@ class UniversalPachkaBot:
                 logger.info(f"[{self.name}] Sending welcome message")
                 # Отправляем в тот же чат, откуда пришла команда
                 if self.send_webhook_message(welcome_message, chat_id):
-                    logger.info(f"[{self.name}] Welcome message sent")
+                    logger.info(f"[{self.name}] Welcome message queued for sending")
                 else:
-                    logger.error(f"[{self.name}] Error sending welcome message")
+                    logger.error(f"[{self.name}] Error queueing welcome message")
                     
             # Для bot3 обрабатываем команды
             elif self.is_bot3:
@@ -311,7 +366,6 @@ class UniversalPachkaBot:
                     logger.info(f"[{self.name}] Manual script execution requested")
                     self.send_webhook_message("🔄 Запускаю скрипт экспорта...", chat_id)
                     # Запускаем задачу в отдельном потоке, чтобы не блокировать ответ
-                    import threading
                     thread = threading.Thread(target=self.execute_daily_task)
                     thread.daemon = True
                     thread.start()
@@ -324,11 +378,11 @@ class UniversalPachkaBot:
                 # Команда /new
                 text = command[4:].strip()  # Убираем "new " из начала
                 if text:
-                    logger.info(f"[{self.name}] Sending new text via webhook: {text}")
+                    logger.info(f"[{self.name}] Queueing new text for sending: {text}")
                     if self.send_webhook_message(text, chat_id):
-                        self.send_webhook_message(f"Text '{text}' sent successfully via webhook", chat_id)
+                        self.send_webhook_message(f"Text '{text}' queued for sending", chat_id)
                     else:
-                        self.send_webhook_message("Error sending text via webhook", chat_id)
+                        self.send_webhook_message("Error queueing text for sending", chat_id)
                 else:
                     self.send_webhook_message("Please specify text after /new command", chat_id)
                     
@@ -352,16 +406,25 @@ class UniversalPachkaBot:
                     
             else:
                 # Отправляем команду через webhook
-                logger.info(f"[{self.name}] Sending command via webhook: {command}")
+                logger.info(f"[{self.name}] Queueing command for sending: {command}")
                 if self.send_webhook_message(command, chat_id):
-                    self.send_webhook_message("Command sent successfully", chat_id)
+                    self.send_webhook_message("Command queued for sending", chat_id)
                 else:
-                    self.send_webhook_message("Error sending command", chat_id)
+                    self.send_webhook_message("Error queueing command for sending", chat_id)
             
         except Exception as e:
             logger.error(f"[{self.name}] Error processing command: {e}")
             self.send_webhook_message(f"An error occurred: {str(e)}")
 
+    def _send_sheets_not_ready(self, chat_id: str = None) -> None:
+        """
+        Сообщает, что таблица еще загружается (подключение к Google Sheets не завершено)
+        """
+        error_msg = "⏳ Подключение к Google Sheets еще устанавливается. Повторите команду через минуту."
+        if self.sheets_processor.connect_error:
+            error_msg += f"\nПоследняя ошибка: {self.sheets_processor.connect_error}"
+        self.send_webhook_message(error_msg, chat_id)
+
     def check_sim_activity(self, chat_id: str = None, router_name: str = None) -> None:
         """
         Проверяет активность симкарт для конкретного устройства и отправляет отчет
@@ -378,9 +441,19 @@ class UniversalPachkaBot:
                 self.send_webhook_message(error_msg, chat_id)
                 return
             
+            # Подключение к Google Sheets могло еще не завершиться после запуска
+            # Снимок из локального зеркала позволяет отвечать и без связи с Google
+            if not self.sheets_processor.has_data and not self.sheets_processor.wait_ready(timeout=10):
+                self._send_sheets_not_ready(chat_id)
+                return
+            
             # Ищем данные в Google Sheets
             logger.info(f"[{self.name}] Searching for router: {router_name} in Google Sheets")
-            results = self.sheets_processor.search_by_name(router_name)
+            try:
+                results = self.sheets_processor.search_by_name(router_name)
+            except SheetsNotReadyError:
+                self._send_sheets_not_ready(chat_id)
+                return
             
             if not results:
                 # Устройство не найдено
@@ -446,123 +519,68 @@ class UniversalPachkaBot:
             self.send_webhook_message(error_message, chat_id)
             logger.error(f"[{self.name}] Error in check_sim_activity for router {router_name}: {e}")
 
-    def run_iccid_imei_export_script(self) -> bool:
+    def run_iccid_imei_export(self) -> Optional[ExportResult]:
         """
-        Запускает скрипт main.py из папки iccid_imei_export
+        Выполняет выгрузку ICCID:IMEI в процессе бота
+        
+        Выгрузка идет в отдельном потоке через уже подключенный процессор таблицы,
+        поэтому не нужно запускать новый интерпретатор и заново проходить
+        авторизацию Google. Через export_timeout секунд после начала выгрузка
+        прерывается, незавершенные файлы удаляются. Пока предыдущая выгрузка
+        не завершилась (например, зависла), новая не запускается.
+        
+        Returns:
+            Optional[ExportResult]: Результат выгрузки или None при ошибке (детали в _last_export_error)
         """
+        if not self.sheets_processor:
+            self._last_export_error = "Google Sheets процессор не инициализирован"
+            logger.error(f"[{self.name}] Export failed: {self._last_export_error}")
+            return None
+        
+        if self._export_future is not None and not self._export_future.done():
+            self._last_export_error = "Предыдущая выгрузка еще выполняется"
+            logger.error(f"[{self.name}] Export skipped: previous export is still running")
+            return None
+        
+        cancel = threading.Event()
+        logger.info(f"[{self.name}] Running ICCID:IMEI export in-process (timeout {self.export_timeout:.0f}s)")
+        future = self._export_future = self._export_executor.submit(self._export_job, cancel)
         try:
-            # Определяем путь к скрипту
-            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            script_dir = os.path.join(base_dir, 'iccid_imei_export')
-            script_path = os.path.join(script_dir, 'main.py')
-            
-            if not os.path.exists(script_path):
-                logger.error(f"[{self.name}] Script not found: {script_path}")
-                return False
-            
-            # Определяем Python из виртуального окружения или системный
-            # Сначала пробуем найти виртуальное окружение в родительской папке (find_sims) - там правильные зависимости
-            parent_venv = os.path.join(os.path.dirname(base_dir), 'find_sims', 'find_sims_env', 'bin', 'python')
-            if os.path.exists(parent_venv):
-                python_cmd = parent_venv
-            else:
-                # Если нет, пробуем локальное окружение
-                venv_python = os.path.join(base_dir, 'find_sims_env', 'bin', 'python')
-                if os.path.exists(venv_python):
-                    python_cmd = venv_python
-                else:
-                    python_cmd = 'python3'
-            
-            logger.info(f"[{self.name}] Running script: {script_path}")
-            logger.info(f"[{self.name}] Using Python: {python_cmd}")
-            
-            # Запускаем скрипт
-            result = subprocess.run(
-                [python_cmd, script_path],
-                cwd=script_dir,
-                capture_output=True,
-                text=True,
-                timeout=300  # 5 минут таймаут
-            )
-            
-            if result.returncode == 0:
-                logger.info(f"[{self.name}] Script executed successfully")
-                if result.stdout:
-                    logger.info(f"[{self.name}] Script output: {result.stdout}")
-                self._last_script_error = None  # Сбрасываем ошибку при успехе
-                return True
-            else:
-                logger.error(f"[{self.name}] Script failed with code {result.returncode}")
-                if result.stdout:
-                    logger.error(f"[{self.name}] Script stdout: {result.stdout}")
-                if result.stderr:
-                    logger.error(f"[{self.name}] Script stderr: {result.stderr}")
-                # Сохраняем полную ошибку для отправки в чат
-                error_details = result.stderr if result.stderr else result.stdout if result.stdout else "Неизвестная ошибка"
-                self._last_script_error = error_details  # Сохраняем для использования в сообщении об ошибке
-                logger.error(f"[{self.name}] Full script error: {error_details}")
-                return False
-                
-        except subprocess.TimeoutExpired:
-            logger.error(f"[{self.name}] Script execution timeout")
-            self._last_script_error = "Таймаут выполнения скрипта (превышено 5 минут)"
-            return False
+            # Срок проверяется между частями листа; запас на случай зависшего запроса к Google
+            result = future.result(timeout=self.export_timeout + 30)
+        except FuturesTimeoutError:
+            cancel.set()
+            logger.error(f"[{self.name}] Export timeout")
+            self._last_export_error = f"Таймаут выполнения выгрузки (превышено {self.export_timeout:.0f} с)"
+            return None
+        except ExportError as e:
+            logger.error(f"[{self.name}] Export failed: {e}")
+            self._last_export_error = str(e)
+            return None
         except Exception as e:
-            logger.error(f"[{self.name}] Error running script: {e}")
-            self._last_script_error = str(e)
-            return False
+            logger.error(f"[{self.name}] Error running export: {e}")
+            self._last_export_error = str(e)
+            return None
+        
+        timings = ', '.join(f"{stage}={seconds:.2f}s" for stage, seconds in result.timings.items())
+        logger.info(f"[{self.name}] Export finished: {result.processed} rows, counts {result.counts}, "
+                    f"{len(result.unknown)} unknown, {len(result.all_files)} file(s), {timings}")
+        self._last_export_error = None
+        return result
 
-    def find_today_json_files(self) -> List[str]:
+    def _export_job(self, cancel: threading.Event) -> ExportResult:
         """
-        Находит файлы (CSV) за текущую дату в папке iccid_imei_export/exports
-        Ищет файлы, которые были изменены сегодня
-        Скрипт создает CSV файлы, а не JSON, но функция оставлена с прежним названием для совместимости
+        Выгрузка в потоке выгрузки; срок отсчитывается от ее фактического начала
         """
-        try:
-            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            script_dir = os.path.join(base_dir, 'iccid_imei_export')
-            exports_dir = os.path.join(script_dir, 'exports')
-            
-            if not os.path.exists(script_dir):
-                logger.error(f"[{self.name}] Directory not found: {script_dir}")
-                return []
-            
-            # Создаем папку exports, если её нет
-            if not os.path.exists(exports_dir):
-                logger.warning(f"[{self.name}] Exports directory not found, creating: {exports_dir}")
-                os.makedirs(exports_dir, exist_ok=True)
-            
-            # Получаем текущую дату
-            today = date.today()
-            
-            # Ищем все CSV файлы в папке exports (скрипт создает CSV, а не JSON)
-            found_files = []
-            
-            # Ищем CSV файлы в папке exports
-            for pattern in ['*.csv', '*.json']:  # Ищем и CSV, и JSON на случай изменений
-                for file_path in glob.glob(os.path.join(exports_dir, pattern)):
-                    try:
-                        # Проверяем, что файл был изменен сегодня
-                        file_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                        if file_time.date() == today:
-                            found_files.append(file_path)
-                            logger.info(f"[{self.name}] Found today's file: {os.path.basename(file_path)} (modified: {file_time})")
-                    except Exception as e:
-                        logger.warning(f"[{self.name}] Error checking file {file_path}: {e}")
-                        continue
-            
-            # Сортируем по времени изменения (новые первыми)
-            found_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-            logger.info(f"[{self.name}] Found {len(found_files)} files for today")
-            return found_files
-            
-        except Exception as e:
-            logger.error(f"[{self.name}] Error finding files: {e}")
-            return []
+        deadline = time.monotonic() + self.export_timeout
+        return run_export(self.sheets_processor, deadline=deadline, cancel=cancel, deltas=True)
 
-    def send_files_to_pachka(self, files: List[str], chat_id: int = 26222583) -> bool:
+    def send_files_to_pachka(self, files: List[str], chat_id: int = 26222583,
+                             export_result: Optional[ExportResult] = None) -> bool:
         """
         Отправляет ссылки на файлы в Pachka
+        Если передан export_result, добавляет число добавленных и удаленных пар
+        по операторам и ссылки на файлы изменений
         """
         if not files:
             logger.warning(f"[{self.name}] No files to send")
@@ -578,26 +596,24 @@ class UniversalPachkaBot:
             message_parts = ["Ежедневный список iccid:imei\n"]
             
             for file_path in files:
-                try:
-                    file_name = os.path.basename(file_path)
-                    
-                    # Получаем размер файла
-                    file_size = os.path.getsize(file_path)
-                    
-                    # Генерируем ссылку на файл
-                    file_url = f"http://{server_ip}:{self.port}/files/{file_name}"
-                    
-                    # Добавляем ссылку в сообщение
-                    message_parts.append(f"\n📄 [{file_name}]({file_url}) ({file_size} bytes)")
-                    
-                except Exception as e:
-                    logger.error(f"[{self.name}] Error processing file {file_path}: {e}")
-                    continue
+                link = self._file_link(file_path, server_ip)
+                if link:
+                    message_parts.append(f"\n{link}")
             
             if len(message_parts) == 1:  # Только заголовок, файлов нет
                 logger.warning(f"[{self.name}] No valid files to send")
                 return False
             
+            # Изменения с прошлой выгрузки: небольшие файлы для загрузки на порталы операторов
+            if export_result is not None and export_result.delta_counts:
+                message_parts.append("\nИзменения с прошлой выгрузки:")
+                for operator, counts in export_result.delta_counts.items():
+                    message_parts.append(f"\n{operator}: +{counts['added']} / -{counts['removed']}")
+                    for file_path in export_result.delta_files.get(operator, []):
+                        link = self._file_link(file_path, server_ip)
+                        if link:
+                            message_parts.append(link)
+            
             message = "\n".join(message_parts)
             
             # Отправляем сообщение
@@ -609,71 +625,40 @@ class UniversalPachkaBot:
             logger.error(f"[{self.name}] Error sending files to Pachka: {e}")
             return False
 
-    def get_existing_files_content(self) -> Dict[str, bytes]:
+    def _file_link(self, file_path, server_ip: str) -> Optional[str]:
         """
-        Получает содержимое существующих файлов в папке exports для сравнения
-        Возвращает словарь: имя_файла -> содержимое_файла
+        Строка сообщения со ссылкой на файл выгрузки и его размером
         """
-        existing_files = {}
         try:
-            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            exports_dir = os.path.join(base_dir, 'iccid_imei_export', 'exports')
-            
-            if not os.path.exists(exports_dir):
-                return existing_files
+            file_name = os.path.basename(file_path)
             
-            # Читаем содержимое всех существующих файлов
-            for file_name in os.listdir(exports_dir):
-                file_path = os.path.join(exports_dir, file_name)
-                try:
-                    if os.path.isfile(file_path):
-                        with open(file_path, 'rb') as f:
-                            existing_files[file_name] = f.read()
-                        logger.info(f"[{self.name}] Loaded existing file for comparison: {file_name} ({len(existing_files[file_name])} bytes)")
-                except Exception as e:
-                    logger.warning(f"[{self.name}] Error reading existing file {file_path}: {e}")
-                    continue
-            
-            logger.info(f"[{self.name}] Loaded {len(existing_files)} existing file(s) for comparison")
-            return existing_files
+            # Получаем размер файла
+            file_size = os.path.getsize(file_path)
             
+            # Генерируем ссылку на файл
+            file_url = f"http://{server_ip}:{self.port}/files/{file_name}"
+            return f"📄 [{file_name}]({file_url}) ({file_size} bytes)"
         except Exception as e:
-            logger.error(f"[{self.name}] Error getting existing files content: {e}")
-            return existing_files
-    
-    def compare_files(self, existing_files: Dict[str, bytes], new_files: List[str]) -> List[str]:
+            logger.error(f"[{self.name}] Error processing file {file_path}: {e}")
+            return None
+
+    def compare_files(self, existing_digests: Set[str], export_result: ExportResult) -> List[Path]:
         """
-        Сравнивает новые файлы со старыми по содержимому (не по имени, т.к. имена содержат временные метки)
+        Сравнивает новые файлы со старыми по дайджесту SHA-256 из манифеста
+        (не по имени, т.к. имена содержат временные метки)
         Возвращает список файлов, которые изменились или являются новыми
         """
         changed_files = []
-        
-        # Преобразуем словарь существующих файлов в множество содержимого для быстрого поиска
-        existing_content_set = set(existing_files.values())
+        new_files = export_result.all_files
         
         for new_file_path in new_files:
-            new_file_name = os.path.basename(new_file_path)
-            
-            try:
-                # Читаем содержимое нового файла
-                with open(new_file_path, 'rb') as f:
-                    new_content = f.read()
-                
-                # Проверяем, есть ли файл с таким же содержимым среди старых (независимо от имени)
-                if new_content in existing_content_set:
-                    # Содержимое найдено среди старых файлов - файл не изменился
-                    logger.info(f"[{self.name}] File {new_file_name} unchanged (content matches existing file), skipping")
-                    continue
-                else:
-                    # Содержимое не найдено среди старых - файл новый или изменился
-                    logger.info(f"[{self.name}] File {new_file_name} is new or changed ({len(new_content)} bytes)")
-                    changed_files.append(new_file_path)
-                    
-            except Exception as e:
-                logger.error(f"[{self.name}] Error comparing file {new_file_path}: {e}")
-                # В случае ошибки считаем файл изменённым (на всякий случай)
-                changed_files.append(new_file_path)
+            digest = export_result.digests.get(new_file_path.name)
+            if digest is not None and digest in existing_digests:
+                # Такое же содержимое уже есть среди старых файлов - файл не изменился
+                logger.info(f"[{self.name}] File {new_file_path.name} unchanged (digest matches existing file), skipping")
                 continue
+            logger.info(f"[{self.name}] File {new_file_path.name} is new or changed")
+            changed_files.append(new_file_path)
         
         logger.info(f"[{self.name}] Found {len(changed_files)} changed or new file(s) out of {len(new_files)} total")
         return changed_files
@@ -684,8 +669,7 @@ class UniversalPachkaBot:
         keep_files - список путей к файлам, которые нужно сохранить
         """
         try:
-            base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            exports_dir = os.path.join(base_dir, 'iccid_imei_export', 'exports')
+            exports_dir = str(EXPORTS_DIR)
             
             if not os.path.exists(exports_dir):
                 return
@@ -695,18 +679,23 @@ class UniversalPachkaBot:
             if keep_files:
                 keep_file_names = {os.path.basename(f) for f in keep_files}
             
-            # Удаляем все файлы, кроме тех, что нужно сохранить
-            deleted_count = 0
+            # Удаляем все файлы, кроме тех, что нужно сохранить.
+            # Служебные файлы с точкой (манифест, временные файлы идущей выгрузки) не трогаем
+            deleted_files = []
             for file_name in os.listdir(exports_dir):
                 file_path = os.path.join(exports_dir, file_name)
                 try:
+                    if file_name.startswith('.'):
+                        continue
                     if os.path.isfile(file_path) and file_name not in keep_file_names:
                         os.remove(file_path)
-                        deleted_count += 1
+                        deleted_files.append(file_name)
                         logger.info(f"[{self.name}] Deleted old file: {file_name}")
                 except Exception as e:
                     logger.error(f"[{self.name}] Error deleting old file {file_path}: {e}")
             
+            ExportManifest(EXPORTS_DIR).forget(deleted_files)
+            deleted_count = len(deleted_files)
             if deleted_count > 0:
                 logger.info(f"[{self.name}] Cleaned up {deleted_count} old file(s) from exports directory")
             
@@ -722,20 +711,18 @@ class UniversalPachkaBot:
         logger.info(f"[{self.name}] Starting daily task execution")
         
         try:
-            # 0. Получаем содержимое существующих файлов для сравнения
-            logger.info(f"[{self.name}] Step 0: Loading existing files for comparison")
-            existing_files = self.get_existing_files_content()
+            # 0. Получаем дайджесты существующих файлов для сравнения
+            logger.info(f"[{self.name}] Step 0: Loading export manifest for comparison")
+            manifest = ExportManifest(EXPORTS_DIR)
+            existing_digests = manifest.digests()
             
-            # 1. Запускаем скрипт
-            logger.info(f"[{self.name}] Step 1: Running export script")
-            script_result = self.run_iccid_imei_export_script()
-            if not script_result:
-                # Получаем детали ошибки из последнего запуска скрипта
-                error_msg = "❌ Ошибка: не удалось запустить скрипт экспорта"
-                # Попробуем получить детали ошибки из логов (если они есть)
-                # Для этого нужно сохранить последнюю ошибку в атрибуте класса
-                if hasattr(self, '_last_script_error') and self._last_script_error:
-                    error_msg += f"\n\nДетали ошибки:\n{self._last_script_error[:500]}"  # Ограничиваем длину
+            # 1. Выполняем выгрузку
+            logger.info(f"[{self.name}] Step 1: Running export")
+            export_result = self.run_iccid_imei_export()
+            if export_result is None:
+                error_msg = "❌ Ошибка: не удалось выполнить выгрузку"
+                if self._last_export_error:
+                    error_msg += f"\n\nДетали ошибки:\n{self._last_export_error[:500]}"  # Ограничиваем длину
                 # Вариант A: для bot3 отправляем через webhook (без API),
                 # для остальных ботов оставляем API
                 if self.is_bot3:
@@ -744,12 +731,12 @@ class UniversalPachkaBot:
                     self.send_api_message(error_msg, chat_id)
                 return
             
-            # 2. Ищем файлы за сегодня
-            logger.info(f"[{self.name}] Step 2: Finding today's files")
-            new_files = self.find_today_json_files()
+            # 2. Файлы, созданные выгрузкой
+            new_files = export_result.all_files
+            logger.info(f"[{self.name}] Step 2: Export created {len(new_files)} file(s)")
             
             if not new_files:
-                error_msg = "❌ Ошибка: файлы не были созданы скриптом"
+                error_msg = "❌ Ошибка: файлы не были созданы выгрузкой"
                 if self.is_bot3:
                     self.send_webhook_message(error_msg, chat_id)
                 else:
@@ -758,24 +745,26 @@ class UniversalPachkaBot:
             
             # 3. Сравниваем новые файлы со старыми
             logger.info(f"[{self.name}] Step 3: Comparing files with existing ones")
-            changed_files = self.compare_files(existing_files, new_files)
+            changed_files = self.compare_files(existing_digests, export_result)
             
+            delta_files = export_result.all_delta_files
             if not changed_files:
                 # Все файлы идентичны - не отправляем ссылки
                 logger.info(f"[{self.name}] No files changed, skipping notification")
-                # Удаляем новые файлы (они идентичны старым)
-                for file_path in new_files:
+                # Удаляем новые файлы (они идентичны старым) вместе с файлами изменений
+                for file_path in new_files + delta_files:
                     try:
                         os.remove(file_path)
                         logger.info(f"[{self.name}] Removed unchanged file: {os.path.basename(file_path)}")
                     except Exception as e:
                         logger.error(f"[{self.name}] Error removing unchanged file {file_path}: {e}")
+                manifest.forget(file_path.name for file_path in new_files + delta_files)
                 logger.info(f"[{self.name}] Daily task completed: no changes detected")
                 return
             
-            # 4. Отправляем ссылки только на изменённые файлы
-            logger.info(f"[{self.name}] Step 4: Sending links to changed files")
-            if not self.send_files_to_pachka(changed_files, chat_id):
+            # 4. Отправляем ссылки только на изменённые файлы и на файлы изменений
+            logger.info(f"[{self.name}] Step 4: Sending links to changed files and {len(delta_files)} delta file(s)")
+            if not self.send_files_to_pachka(changed_files, chat_id, export_result=export_result):
                 error_msg = "❌ Ошибка: не удалось отправить файлы в Pachka"
                 if self.is_bot3:
                     self.send_webhook_message(error_msg, chat_id)
@@ -785,7 +774,7 @@ class UniversalPachkaBot:
             
             # 5. Удаляем старые файлы, оставляем только новые (изменённые)
             logger.info(f"[{self.name}] Step 5: Cleaning up old files")
-            self.cleanup_old_files(keep_files=changed_files)
+            self.cleanup_old_files(keep_files=changed_files + delta_files)
             
             logger.info(f"[{self.name}] Files are available for download at http://{os.getenv('SERVER_HOST', '91.217.77.71')}:{self.port}/files/")
             
@@ -880,7 +869,9 @@ def root_webhook():
                 return jsonify({"status": "error", "message": "Empty data"}), 400
                 
             if bot:
-                bot.handle_webhook_event(event_data)
+                if not bot.jobs.submit(bot.handle_webhook_event, event_data):
+                    logger.error("Job queue is full, rejecting webhook")
+                    return jsonify({"status": "error", "message": "Bot is busy"}), 503
             else:
                 logger.error("Bot not initialized")
                 return jsonify({"status": "error", "message": "Bot not initialized"}), 500
@@ -916,8 +907,10 @@ def webhook():
             logger.info(f"Bot type: {type(bot)}")
             
             if bot:
-                logger.info("Bot is initialized, processing event...")
-                bot.handle_webhook_event(event_data)
+                logger.info("Bot is initialized, queueing event...")
+                if not bot.jobs.submit(bot.handle_webhook_event, event_data):
+                    logger.error("Job queue is full, rejecting webhook")
+                    return jsonify({"status": "error", "message": "Bot is busy"}), 503
             else:
                 logger.error("Bot not initialized")
                 return jsonify({"status": "error", "message": "Bot not initialized"}), 500
@@ -941,7 +934,11 @@ def health_check():
     return jsonify({
         "status": "ok", 
         "timestamp": datetime.now().isoformat(),
-        "bot_name": bot.name if bot else "Unknown"
+        "bot_name": bot.name if bot else "Unknown",
+        "sheets": bot.sheets_processor.status() if bot and bot.sheets_processor else None,
+        "jobs": bot.jobs.stats() if bot else None,
+        "http": bot.http.stats() if bot else None,
+        "outbox": bot.outbox.stats() if bot else None
     })
 
 @app.route('/files/<filename>', methods=['GET'])
@@ -950,13 +947,13 @@ def serve_file(filename):
     Раздает файлы из папки exports для скачивания
     """
     try:
-        # Безопасность: проверяем, что filename не содержит опасных символов
-        if '..' in filename or '/' in filename or '\\' in filename:
+        # Безопасность: проверяем, что filename не содержит опасных символов.
+        # Файлы с точкой в начале служебные (манифест, незавершенная выгрузка)
+        if '..' in filename or '/' in filename or '\\' in filename or filename.startswith('.'):
             return jsonify({"status": "error", "message": "Invalid filename"}), 400
         
         # Определяем путь к файлу
-        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        exports_dir = os.path.join(base_dir, 'iccid_imei_export', 'exports')
+        exports_dir = str(EXPORTS_DIR)
         file_path = os.path.join(exports_dir, filename)
         
         # Проверяем, что файл существует и находится в правильной директории
@@ -1021,7 +1018,7 @@ def main():
         logger.info("Sending test message...")
         try:
             if bot.send_webhook_message(f"Bot {bot_id} is running and ready to work"):
-                logger.info("Test message sent successfully")
+                logger.info("Test message queued for sending")
             else:
                 logger.error("Error sending test message")
         except Exception as e:
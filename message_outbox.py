@@ -0,0 +1,308 @@
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Any, Callable, Dict, Optional, Set
+
+from api_quota import RETRYABLE_STATUS_CODES, retry_after_seconds
+from pachka_http import RetryBudget
+
+# Версия схемы файла очереди: при несовпадении таблица пересоздается
+SCHEMA_VERSION = 1
+
+# Сколько хранить доставленные и окончательно не доставленные сообщения, секунды
+KEEP_SECONDS = 7 * 24 * 3600
+
+# Как часто удалять старые записи, секунды
+PURGE_INTERVAL = 3600
+
+# Сколько ждать, если в очереди нет сообщений (запись будит диспетчер сразу)
+IDLE_WAIT = 60.0
+
+
+class DeliveryError(Exception):
+    """
+    Сообщение из очереди не отправлено.
+
+    permanent означает, что повтор не поможет (неверный токен или chat_id,
+    4xx кроме 429): сообщение сразу помечается недоставленным. retry_after -
+    через сколько секунд Pachka разрешила повторить (заголовок Retry-After).
+    """
+
+    def __init__(self, reason: str, permanent: bool = False, retry_after: Optional[float] = None):
+        super().__init__(reason)
+        self.permanent = permanent
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response: Any) -> 'DeliveryError':
+        """
+        Ошибка по ответу Pachka: повторяются только те же ответы, что повторяет PachkaSession
+        """
+        status = response.status_code
+        return cls(f'HTTP {status}', permanent=status not in RETRYABLE_STATUS_CODES,
+                   retry_after=retry_after_seconds(response))
+
+
+class MessageOutbox:
+    """
+    Очередь исходящих сообщений Pachka в SQLite (режим WAL).
+
+    Поток, формирующий ответ, только записывает сообщение в локальную базу
+    и сразу продолжает работу. Фоновый диспетчер раздает сообщения
+    небольшому пулу отправителей и отмечает доставленные; неудачная отправка
+    повторяется позже с растущей паузой, пока не кончатся попытки.
+    Неотправленные сообщения переживают перезапуск бота: диспетчер нового
+    процесса досылает их первыми.
+
+    Сообщения одного получателя (чата или общего канала webhook) уходят
+    строго по порядку записи, по одному за раз. Ожидание лимита частоты или
+    повтор после ошибки задерживают только этого получателя: остальные чаты
+    обслуживают свободные отправители.
+
+    Доставка "как минимум один раз": если процесс остановится между
+    отправкой и отметкой о доставке, сообщение будет отправлено повторно.
+    """
+
+    def __init__(self, path: str, deliver: Callable[[str, Optional[str], str], bool],
+                 max_attempts: int = 10, base_delay: float = 5.0, max_delay: float = 600.0,
+                 workers: int = 4, budget: Optional[RetryBudget] = None):
+        """
+        Args:
+            path (str): Путь к файлу базы SQLite
+            deliver (Callable[[str, Optional[str], str], bool]): Отправляет сообщение
+                (канал, chat_id, текст) и возвращает True при успехе; при неудаче
+                бросает DeliveryError (можно ли повторить и когда)
+            max_attempts (int): Сколько раз пытаться отправить сообщение
+            base_delay (float): Пауза после первой неудачной попытки, секунды
+            max_delay (float): Верхняя граница паузы между попытками
+            workers (int): Сколько получателей обслуживать одновременно
+            budget (Optional[RetryBudget]): Общий бюджет повторов запросов к Pachka;
+                когда он исчерпан, повтор откладывается на max_delay
+        """
+        self.path = path
+        self.deliver = deliver
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.workers = max(1, workers)
+        self.budget = budget
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._lock = threading.Lock()
+        # Получатели, сообщение которым сейчас отправляется
+        self._in_flight: Set[str] = set()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pachka-outbox-send')
+        self._purged_at = 0.0
+        with closing(self._connect()) as conn, conn:
+            self._create_schema(conn)
+            # После перезапуска досылаем сразу, не дожидаясь паузы, назначенной прошлым процессом
+            backlog = conn.execute("UPDATE outbox SET next_attempt_at = ? WHERE status = 'pending'",
+                                   (time.time(),)).rowcount
+        if backlog:
+            print(f"В очереди исходящих сообщений {path} осталось {backlog} неотправленных, досылаем")
+        self._thread = threading.Thread(target=self._dispatch_loop, name='pachka-outbox', daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Отдельное соединение на операцию: пишут рабочие потоки бота, читает диспетчер
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _create_schema(self, conn: sqlite3.Connection) -> None:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            conn.execute('DROP TABLE IF EXISTS outbox')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                chat_id TEXT,
+                message TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                delivered_at REAL,
+                last_error TEXT
+            )""")
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at, id)')
+        # Первое неотправленное сообщение каждого получателя (см. _dispatch_due)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_recipient ON outbox (status, chat_id, id)')
+        conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def put(self, channel: str, chat_id: Optional[str], message: str) -> bool:
+        """
+        Ставит сообщение в очередь на отправку
+
+        Если записать сообщение в базу не удалось, оно отправляется сразу в
+        вызывающем потоке, чтобы не потеряться.
+
+        Args:
+            channel (str): Канал отправки ('api', 'webhook' и т.п., как понимает deliver)
+            chat_id (Optional[str]): Чат получателя или None для общего канала
+            message (str): Текст сообщения
+
+        Returns:
+            bool: True, если сообщение сохранено в очереди (или отправлено сразу)
+        """
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    'INSERT INTO outbox (channel, chat_id, message, created_at, next_attempt_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (channel, None if chat_id is None else str(chat_id), message, now, now))
+        except sqlite3.Error as e:
+            print(f"Не удалось записать сообщение в очередь {self.path}: {e}, отправляем сразу")
+            return self._call_deliver(channel, chat_id, message) is None
+        self._wakeup.set()
+        return True
+
+    def _call_deliver(self, channel: str, chat_id: Optional[str], message: str) -> Optional[DeliveryError]:
+        # None - сообщение доставлено
+        try:
+            if self.deliver(channel, chat_id, message):
+                return None
+            return DeliveryError('delivery failed')
+        except DeliveryError as e:
+            return e
+        except Exception as e:
+            return DeliveryError(str(e))
+
+    def _retry_delay(self, attempts: int) -> float:
+        # Экспоненциальная пауза с разбросом в верхней половине: повтор не приходит раньше половины паузы
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def _recipient(chat_id: Optional[str]) -> str:
+        # Все сообщения без чата идут в один общий канал webhook (в SQL - одна группа chat_id IS NULL)
+        return f'chat:{chat_id}' if chat_id is not None else 'webhook'
+
+    def _dispatch_due(self, now: float) -> float:
+        """
+        Отдает отправителям первое неотправленное сообщение каждого свободного
+        получателя, если для него подошло время
+
+        Returns:
+            float: Сколько ждать до следующего прохода, секунды
+        """
+        # Занятых до чтения базы получателей пропускаем: их строки могли устареть, пока мы читали.
+        # Освободившийся отправитель разбудит диспетчер, и получатель попадет в следующий проход
+        with self._lock:
+            seen = set(self._in_flight)
+        # Только первое неотправленное сообщение каждого получателя: следующие ждут, пока
+        # уйдет оно, а длинная очередь одного чата не заслоняет остальных получателей
+        with closing(self._connect()) as conn:
+            heads = conn.execute(
+                "SELECT id, channel, chat_id, message, attempts, next_attempt_at FROM outbox "
+                "WHERE id IN (SELECT MIN(id) FROM outbox WHERE status = 'pending' GROUP BY chat_id) "
+                "ORDER BY id").fetchall()
+        wait = IDLE_WAIT
+        for row in heads:
+            if row[5] > now:
+                wait = min(wait, row[5] - now)
+                continue
+            recipient = self._recipient(row[2])
+            if recipient in seen:
+                continue
+            with self._lock:
+                if len(self._in_flight) >= self.workers:
+                    # Все отправители заняты; освободившийся разбудит диспетчер
+                    break
+                self._in_flight.add(recipient)
+            self._executor.submit(self._send, recipient, row[:5])
+        return wait
+
+    def _send(self, recipient: str, row: tuple) -> None:
+        message_id, channel, chat_id, message, attempts = row
+        try:
+            error = self._call_deliver(channel, chat_id, message)
+            self._mark(message_id, attempts + 1, error)
+        except sqlite3.Error as e:
+            print(f"Не удалось отметить сообщение {message_id} в очереди {self.path}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(recipient)
+            self._wakeup.set()
+
+    def _mark(self, message_id: int, attempts: int, error: Optional[DeliveryError]) -> None:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            if error is None:
+                conn.execute("UPDATE outbox SET status = 'delivered', attempts = ?, delivered_at = ?, "
+                             "last_error = NULL WHERE id = ?", (attempts, now, message_id))
+            elif error.permanent:
+                conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                             (attempts, str(error), message_id))
+                print(f"Сообщение {message_id} не доставлено, повтор не поможет: {error}")
+            elif attempts >= self.max_attempts:
+                conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                             (attempts, str(error), message_id))
+                print(f"Сообщение {message_id} не доставлено после {attempts} попыток: {error}")
+            else:
+                # Pachka сама назвала время повтора - отправляем тогда, без разброса
+                delay = error.retry_after if error.retry_after is not None else self._retry_delay(attempts)
+                if self.budget is not None and not self.budget.withdraw():
+                    # Повторы из очереди тратят тот же бюджет, что и повторы сессии:
+                    # при сбое Pachka очередь не умножает нагрузку
+                    delay = max(delay, self.max_delay)
+                conn.execute("UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                             (attempts, now + delay, str(error), message_id))
+                print(f"Сообщение {message_id} не доставлено ({error}), повтор через {delay:.0f} с")
+
+    def _purge(self, now: float) -> None:
+        if now - self._purged_at < PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM outbox WHERE status != 'pending' AND created_at < ?", (now - KEEP_SECONDS,))
+
+    def _dispatch_loop(self) -> None:
+        while not self._stop:
+            # Сбрасываем флаг до чтения базы: запись, сделанная во время чтения, снова разбудит цикл
+            self._wakeup.clear()
+            try:
+                now = time.time()
+                self._purge(now)
+                wait = self._dispatch_due(now)
+            except sqlite3.Error as e:
+                print(f"Ошибка чтения очереди исходящих сообщений {self.path}: {e}")
+                wait = IDLE_WAIT
+            self._wakeup.wait(wait)
+
+    def stats(self) -> Dict:
+        """
+        Состояние очереди для мониторинга (/health): число сообщений по статусам
+        и возраст самого старого неотправленного, секунды
+        """
+        with closing(self._connect()) as conn:
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+            oldest = conn.execute("SELECT MIN(created_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        with self._lock:
+            in_flight = len(self._in_flight)
+        return {
+            'pending': counts.get('pending', 0),
+            'delivered': counts.get('delivered', 0),
+            'failed': counts.get('failed', 0),
+            'in_flight': in_flight,
+            'oldest_pending_age': None if oldest is None else round(time.time() - oldest, 1),
+        }
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Останавливает диспетчер; неотправленные сообщения остаются в базе до следующего запуска
+
+        Args:
+            timeout (Optional[float]): Сколько ждать остановки диспетчера, секунды
+        """
+        self._stop = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+        # Начатые отправки доработают в фоне; недоставленное останется в базе
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from api_quota import RETRYABLE_STATUS_CODES, backoff_delay, retry_after_seconds
+
+
+class RetryBudget:
+    """
+    Общий бюджет повторов запросов к Pachka.
+
+    Каждый исходный запрос пополняет бюджет на ratio токена, каждый повтор
+    тратит целый токен. Пока Pachka отвечает, повторов не больше ratio от
+    числа запросов (плюс запас capacity), поэтому при сбое на их стороне
+    повторы не умножают нагрузку: бюджет кончается, и запросы завершаются
+    после первой попытки.
+    """
+
+    def __init__(self, ratio: float = 0.2, capacity: float = 10):
+        """
+        Args:
+            ratio (float): Доля повторов от числа исходных запросов
+            capacity (float): Сколько повторов можно сделать подряд из накопленного запаса
+        """
+        self.ratio = ratio
+        self.capacity = capacity
+        self._tokens = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        """
+        Учитывает исходный запрос
+        """
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        Берет токен на повтор
+
+        Returns:
+            bool: True, если повтор разрешен
+        """
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class RetryPolicy:
+    """
+    Какие ответы Pachka повторять и сколько ждать перед повтором.
+
+    Повторяются только ответы 429 и 5xx, таймауты и ошибки соединения -
+    сбои, после которых сообщение можно отправить еще раз. Ответы 4xx
+    (кроме 429) возвращаются сразу. Пауза берется из Retry-After, а без
+    него - экспоненциальная с разбросом (как у запросов к Google Sheets).
+    """
+
+    def __init__(self, max_retries: int = 3, base_delay: float = 1.0, max_delay: float = 30.0,
+                 max_retry_after: float = 60.0, budget: Optional[RetryBudget] = None):
+        """
+        Args:
+            max_retries (int): Сколько раз повторять один запрос
+            base_delay (float): Пауза перед первым повтором без Retry-After, секунды
+            max_delay (float): Верхняя граница экспоненциальной паузы
+            max_retry_after (float): Если Retry-After дольше, запрос не повторяется
+                (рабочий поток не держится минутами ради одного сообщения)
+            budget (Optional[RetryBudget]): Общий бюджет повторов
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = budget if budget is not None else RetryBudget()
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        """
+        Политика из переменных окружения PACHKA_MAX_RETRIES, PACHKA_RETRY_BUDGET и PACHKA_MAX_RETRY_AFTER
+        """
+        return cls(
+            max_retries=int(os.getenv('PACHKA_MAX_RETRIES', '3')),
+            max_retry_after=float(os.getenv('PACHKA_MAX_RETRY_AFTER', '60')),
+            budget=RetryBudget(ratio=float(os.getenv('PACHKA_RETRY_BUDGET', '0.2'))))
+
+    @classmethod
+    def without_retries(cls) -> 'RetryPolicy':
+        """
+        Политика для сессии, через которую отправляет MessageOutbox: сама сессия не
+        повторяет, повторы (с паузой и Retry-After) планирует очередь. Бюджет
+        повторов из PACHKA_RETRY_BUDGET, его же тратит очередь.
+        """
+        return cls(max_retries=0, budget=RetryBudget(ratio=float(os.getenv('PACHKA_RETRY_BUDGET', '0.2'))))
+
+    def delay(self, attempt: int, response: Optional[requests.Response]) -> Optional[float]:
+        """
+        Пауза перед повтором
+
+        Args:
+            attempt (int): Номер повтора, начиная с 0
+            response (Optional[requests.Response]): Ответ или None при сетевой ошибке
+
+        Returns:
+            Optional[float]: Секунды до повтора или None, если повторять не нужно
+        """
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            # Сервер сказал, когда можно снова - отправляем ровно тогда, без разброса
+            return retry_after if retry_after <= self.max_retry_after else None
+        return backoff_delay(attempt, base=self.base_delay, cap=self.max_delay)
+
+
+class PachkaSession(requests.Session):
+    """
+    HTTP сессия для всех запросов бота к Pachka.
+
+    Соединения с api.pachca.com держатся открытыми (keep-alive) в пуле и
+    переиспользуются, поэтому сообщение не платит за новое TCP и TLS
+    соединение. Запросы без явного timeout получают общий таймаут
+    (подключение, чтение). Сбои, которые можно повторить, повторяются по
+    RetryPolicy; вызывающий код получает последний ответ или исключение.
+    """
+
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5.0, read_timeout: float = 10.0,
+                 user_agent: str = 'PachkaBot/1.0', retry_policy: Optional[RetryPolicy] = None):
+        """
+        Args:
+            pool_size (int): Сколько соединений с одним хостом держать в пуле
+                (не меньше числа потоков, отправляющих сообщения одновременно)
+            connect_timeout (float): Таймаут установки соединения, секунды
+            read_timeout (float): Таймаут ожидания ответа, секунды
+            user_agent (str): Заголовок User-Agent для всех запросов
+            retry_policy (Optional[RetryPolicy]): Политика повторов, по умолчанию из переменных окружения
+        """
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers['User-Agent'] = user_agent
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy.from_env()
+        self._counters = {
+            'requests': 0,
+            'retries': 0,
+            'budget_exhausted': 0,
+            'failures': 0,
+        }
+        self._counters_lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._counters_lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Счетчики запросов: всего, повторов, отказов в повторе из-за бюджета, окончательных ошибок
+        """
+        with self._counters_lock:
+            return dict(self._counters)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        policy = self.retry_policy
+        policy.budget.deposit()
+        self._count('requests')
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = super().request(method, url, **kwargs)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+                reason = str(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                reason = type(e).__name__
+            delay = policy.delay(attempt, response) if attempt < policy.max_retries else None
+            if delay is not None and not policy.budget.withdraw():
+                self._count('budget_exhausted')
+                delay = None
+            if delay is None:
+                self._count('failures')
+                if response is None:
+                    raise error
+                return response
+            self._count('retries')
+            # В пути webhook есть секрет, поэтому в лог попадает только хост
+            print(f"Pachka: ответ {reason} от {urlsplit(url).netloc}, повтор через {delay:.1f} с")
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
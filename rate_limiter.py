@@ -0,0 +1,121 @@
+import threading
+import time
+from typing import Dict
+
+
+class GcraLimiter:
+    """
+    Ограничение частоты по расписанию (GCRA): rate отправок в секунду,
+    не больше capacity подряд.
+
+    В отличие от api_quota.TokenBucket, хранится не баланс токенов, а tat -
+    момент, к которому лимит восстановится полностью. reserve() не
+    отказывает и не ждет, а назначает отправке слот: одновременные
+    отправители получают последовательные слоты, а не проскакивают
+    проверку вместе. Не потокобезопасен сам по себе - вызывается под
+    блокировкой RateLimiter.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.interval = 1.0 / rate
+        # Насколько слот может опережать равномерное расписание (размер всплеска)
+        self.tolerance = (capacity - 1) * self.interval
+        self.tat = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """
+        Назначает отправке слот и возвращает задержку до него
+
+        Args:
+            now (float): Текущее время по time.monotonic()
+        """
+        slot = max(now, self.tat - self.tolerance)
+        self.tat = max(self.tat, slot) + self.interval
+        return slot - now
+
+    def is_idle(self, now: float) -> bool:
+        """
+        True, если лимит восстановился полностью - его можно удалить без потери ограничений
+        """
+        return self.tat <= now
+
+
+class RateLimiter:
+    """
+    Ограничение частоты исходящих сообщений: лимит на каждого получателя
+    (чат, webhook) и общий лимит на бота.
+
+    Сообщения в разные чаты не ждут друг друга, пока не исчерпан общий
+    лимит, а всплески сообщений в один чат растягиваются по времени.
+    Общий слот берется только когда подошел слот чата: очередь одного
+    чата не занимает общее расписание наперед и не задерживает другие чаты.
+    Потокобезопасен: слоты раздаются под блокировкой.
+    """
+
+    # Сколько лимитов получателей хранить до очистки простаивающих
+    MAX_IDLE_BUCKETS = 1000
+
+    def __init__(self, per_key_rate: float = 0.5, per_key_burst: float = 3,
+                 global_rate: float = 2.0, global_burst: float = 5):
+        """
+        Args:
+            per_key_rate (float): Сообщений в секунду на одного получателя
+            per_key_burst (float): Сколько сообщений одному получателю можно отправить подряд без ожидания
+            global_rate (float): Сообщений в секунду на всех получателей
+            global_burst (float): Сколько сообщений всего можно отправить подряд без ожидания
+        """
+        self.per_key_rate = per_key_rate
+        self.per_key_burst = per_key_burst
+        self._global = GcraLimiter(global_rate, global_burst)
+        self._buckets: Dict[str, GcraLimiter] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str) -> float:
+        """
+        Назначает сообщению слот отправки в лимите получателя
+
+        Args:
+            key (str): Получатель (например, 'chat:123' или 'webhook')
+
+        Returns:
+            float: Через сколько секунд подойдет слот получателя
+        """
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_IDLE_BUCKETS:
+                    self._buckets = {k: b for k, b in self._buckets.items() if not b.is_idle(now)}
+                bucket = self._buckets[key] = GcraLimiter(self.per_key_rate, self.per_key_burst)
+            return bucket.reserve(now)
+
+    def reserve_global(self) -> float:
+        """
+        Назначает сообщению слот в общем лимите бота; берется в момент отправки
+
+        Returns:
+            float: Через сколько секунд можно отправлять
+        """
+        with self._lock:
+            return self._global.reserve(time.monotonic())
+
+    def wait(self, key: str) -> float:
+        """
+        Ждет своего слота отправки: сначала слота получателя, затем общего.
+        Вызывается из рабочих потоков бота, обработчик HTTP запроса не ждет.
+
+        Args:
+            key (str): Получатель
+
+        Returns:
+            float: Сколько секунд пришлось ждать
+        """
+        delay = self.reserve(key)
+        if delay > 0:
+            time.sleep(delay)
+        global_delay = self.reserve_global()
+        if global_delay > 0:
+            time.sleep(global_delay)
+        return delay + global_delay
@@ -0,0 +1,365 @@
+import re
+import threading
+from bisect import insort
+import time
+from collections.abc import Mapping
+from typing import Any, Callable, Iterator, List, Dict, Optional, Sequence, Set, Tuple
+
+# Столбец с названием устройства, по которому работает поиск /active
+DEVICE_COLUMN = 'Устройство'
+
+# Столбцы-ключи для точечного поиска
+PHONE_COLUMN = 'phone'
+MSISDN_COLUMN = '5 Мобильный номер (MSISDN)'
+ICCID_COLUMN = 'ICCID'
+# Столбец IMEI: точного заголовка в листе нет, подходит любой со словом imei
+IMEI_COLUMN = 'IMEI'
+
+# Длина n-грамм в индексе подстрочного поиска по устройствам
+NGRAM_SIZE = 3
+
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def _ngrams(text: str, n: int = NGRAM_SIZE) -> Set[str]:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _with_row(posting: List[int], row_id: int) -> List[int]:
+    """
+    Новый отсортированный список с добавленной записью; исходный список не меняется
+    """
+    posting = list(posting)
+    insort(posting, row_id)
+    return posting
+
+
+def normalize_digits(value: Any) -> str:
+    """
+    Оставляет в значении только цифры (для ICCID и IMEI)
+    """
+    return _NON_DIGITS.sub('', str(value))
+
+
+def normalize_phone(value: Any) -> str:
+    """
+    Приводит российский номер телефона к виду 7XXXXXXXXXX
+
+    '+7 (900) 123-45-67', '89001234567' и '9001234567' дают одинаковый ключ.
+    """
+    digits = normalize_digits(value)
+    if len(digits) == 11 and digits.startswith('8'):
+        return '7' + digits[1:]
+    if len(digits) == 10:
+        return '7' + digits
+    return digits
+
+
+# Нормализация значений для каждого ключа точечного поиска
+KEY_NORMALIZERS: Dict[str, Callable[[Any], str]] = {
+    'phone': normalize_phone,
+    'msisdn': normalize_phone,
+    'iccid': normalize_digits,
+    'imei': normalize_digits,
+}
+
+
+def find_imei_index(headers: Sequence[Any]) -> Optional[int]:
+    """
+    Номер столбца IMEI: последний заголовок со словом imei (без учета регистра) или None.
+    Одно правило для снимка, точечного поиска и выгрузки ICCID:IMEI.
+    """
+    position = None
+    for index, header in enumerate(headers):
+        if 'imei' in str(header).strip().lower():
+            position = index
+    return position
+
+
+def find_imei_header(headers: Sequence[Any]) -> Optional[str]:
+    """
+    Заголовок столбца IMEI (см. find_imei_index) или None
+    """
+    position = find_imei_index(headers)
+    return None if position is None else str(headers[position])
+
+
+def unique_headers(headers: Sequence[Any]) -> List[str]:
+    """
+    Делает заголовки различимыми: повторы получают суффикс ' (2)', ' (3)' и т.д.
+
+    В листе SIMS 'дата возврата', 'от кого вернулась симкарта' и 'из какого устройства'
+    встречаются трижды; без суффиксов значения последних столбцов затирали бы первые.
+    """
+    seen: Dict[str, int] = {}
+    result = []
+    for header in headers:
+        name = str(header).strip()
+        count = seen.get(name, 0) + 1
+        seen[name] = count
+        result.append(name if count == 1 else f'{name} ({count})')
+    return result
+
+
+class SheetRecord(Mapping):
+    """
+    Легковесное представление строки снимка в виде словаря
+
+    Хранит только ссылку на общую карту заголовков и кортеж значений строки,
+    поддерживает record.get('Устройство'), record['ICCID'], dict(record).
+    """
+
+    __slots__ = ('_header_index', '_row')
+
+    def __init__(self, header_index: Dict[str, int], row: Tuple[str, ...]):
+        self._header_index = header_index
+        self._row = row
+
+    def __getitem__(self, key: str) -> str:
+        return self._row[self._header_index[key]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._header_index)
+
+    def __len__(self) -> int:
+        return len(self._header_index)
+
+    def __repr__(self) -> str:
+        return f'SheetRecord({dict(self)!r})'
+
+
+class SheetSnapshot:
+    """
+    Снимок листа Google таблицы, загруженный в память процесса.
+
+    При обновлении процессор строит новый экземпляр и атомарно подменяет
+    ссылку на него, поэтому читатели всегда видят целостные данные без
+    блокировок. Единственное изменение на месте - patch_row после собственной
+    записи процессора: строка заменяется целиком, а затронутые списки индексов
+    строятся заново и подменяются ссылкой (копирование при записи), поэтому
+    читатель, уже получивший список, не видит его изменения посреди обхода.
+    """
+
+    def __init__(self, headers: Sequence[Any], rows: Sequence[Sequence[Any]],
+                 fetched_at: Optional[float] = None, revision: Optional[str] = None):
+        """
+        Args:
+            headers (Sequence[Any]): Строка заголовков листа
+            rows (Sequence[Sequence[Any]]): Строки данных (как возвращает get_all_values без заголовков)
+            fetched_at (Optional[float]): Время загрузки (time.time()), по умолчанию текущее
+            revision (Optional[str]): Версия файла в Google Drive, с которой снят снимок
+        """
+        # Строки хранятся кортежами одной длины за общей картой заголовок -> индекс
+        self.headers = unique_headers(headers)
+        self.header_index = {header: position for position, header in enumerate(self.headers)}
+        width = len(self.headers)
+        self.rows: List[Tuple[str, ...]] = [
+            tuple(row[:width]) if len(row) >= width else tuple(row) + ('',) * (width - len(row))
+            for row in rows
+        ]
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        # Время последней проверки актуальности: данные те же, меняется только отметка
+        self.checked_at = self.fetched_at
+        self.revision = revision
+        self._device_names: Optional[List[str]] = None
+        self._device_index: Optional[Dict[str, List[int]]] = None
+        self._key_indexes: Dict[str, Dict[str, List[int]]] = {}
+        self._index_lock = threading.Lock()
+
+    def age(self) -> float:
+        """
+        Время в секундах с последней проверки актуальности снимка
+        """
+        return time.time() - self.checked_at
+
+    def touch(self) -> None:
+        """
+        Отмечает, что версия файла не изменилась и снимок по-прежнему актуален
+        """
+        self.checked_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def record(self, row_id: int) -> SheetRecord:
+        """
+        Возвращает строку снимка в виде словаря-представления
+
+        Args:
+            row_id (int): Номер записи (строка листа = row_id + 2)
+        """
+        return SheetRecord(self.header_index, self.rows[row_id])
+
+    def records(self) -> List[SheetRecord]:
+        """
+        Все строки снимка в виде словарей-представлений
+        """
+        return [SheetRecord(self.header_index, row) for row in self.rows]
+
+    def column_values(self, header: str) -> List[str]:
+        """
+        Значения одного столбца по всем строкам (пустой список, если столбца нет)
+        """
+        position = self.header_index.get(header)
+        if position is None:
+            return []
+        return [row[position] for row in self.rows]
+
+    def _key_column(self, key: str) -> Optional[str]:
+        """
+        Определяет заголовок столбца для ключа точечного поиска
+        """
+        if key == 'phone':
+            return PHONE_COLUMN
+        if key == 'msisdn':
+            return MSISDN_COLUMN
+        if key == 'iccid':
+            return ICCID_COLUMN
+        if key == 'imei':
+            return find_imei_header(self.headers)
+        return None
+
+    def _build_key_index(self, key: str) -> Dict[str, List[int]]:
+        """
+        Строит хэш-индекс нормализованное значение -> номера записей
+        """
+        with self._index_lock:
+            index = self._key_indexes.get(key)
+            if index is not None:
+                return index
+            index = {}
+            column = self._key_column(key)
+            normalize = KEY_NORMALIZERS[key]
+            if column is not None:
+                for row_id, raw_value in enumerate(self.column_values(column)):
+                    value = normalize(raw_value)
+                    if value:
+                        index.setdefault(value, []).append(row_id)
+            self._key_indexes[key] = index
+            return index
+
+    def lookup(self, key: str, value: Any) -> List[int]:
+        """
+        Точечный поиск записей по ключевому столбцу
+
+        Args:
+            key (str): Ключ: 'phone', 'msisdn', 'iccid' или 'imei'
+            value (Any): Искомое значение, нормализуется так же, как данные листа
+
+        Returns:
+            List[int]: Номера найденных записей в порядке следования в листе
+        """
+        index = self._key_indexes.get(key)
+        if index is None:
+            index = self._build_key_index(key)
+        normalized = KEY_NORMALIZERS[key](value)
+        if not normalized:
+            return []
+        return index.get(normalized, [])
+
+    def patch_row(self, row_id: int, values: Dict[str, Any]) -> None:
+        """
+        Применяет к строке снимка значения, только что записанные в лист
+
+        Кортеж строки заменяется новым, построенные индексы обновляются точечно,
+        так что после update_record снимок не нужно перезагружать.
+
+        Args:
+            row_id (int): Номер записи
+            values (Dict[str, Any]): Заголовок -> новое значение (столбцы вне снимка пропускаются)
+        """
+        with self._index_lock:
+            old_row = self.rows[row_id]
+            new_row = list(old_row)
+            for header, value in values.items():
+                position = self.header_index.get(header)
+                if position is not None:
+                    new_row[position] = str(value)
+            new_row = tuple(new_row)
+
+            for key, index in self._key_indexes.items():
+                column = self._key_column(key)
+                position = self.header_index.get(column) if column else None
+                if position is None or old_row[position] == new_row[position]:
+                    continue
+                normalize = KEY_NORMALIZERS[key]
+                old_value, new_value = normalize(old_row[position]), normalize(new_row[position])
+                if old_value and row_id in index.get(old_value, []):
+                    remaining = [other for other in index[old_value] if other != row_id]
+                    if remaining:
+                        index[old_value] = remaining
+                    else:
+                        del index[old_value]
+                if new_value:
+                    index[new_value] = _with_row(index.get(new_value, []), row_id)
+
+            position = self.header_index.get(DEVICE_COLUMN)
+            if self._device_index is not None and position is not None and \
+                    old_row[position] != new_row[position]:
+                old_name = self._device_names[row_id]
+                new_name = new_row[position].lower()
+                for gram in _ngrams(old_name) - _ngrams(new_name):
+                    posting = self._device_index.get(gram, [])
+                    if row_id in posting:
+                        self._device_index[gram] = [other for other in posting if other != row_id]
+                for gram in _ngrams(new_name) - _ngrams(old_name):
+                    self._device_index[gram] = _with_row(self._device_index.get(gram, []), row_id)
+                self._device_names[row_id] = new_name
+
+            self.rows[row_id] = new_row
+
+    def _build_device_index(self) -> None:
+        """
+        Строит инвертированный индекс n-грамм по названиям устройств
+
+        Индекс строится один раз на снимок при первом поиске.
+        """
+        with self._index_lock:
+            if self._device_index is not None:
+                return
+            names = [str(value).lower() for value in self.column_values(DEVICE_COLUMN)]
+            if not names:
+                names = [''] * len(self.rows)
+            index: Dict[str, List[int]] = {}
+            for row_id, name in enumerate(names):
+                for gram in _ngrams(name):
+                    index.setdefault(gram, []).append(row_id)
+            self._device_names = names
+            self._device_index = index
+
+    def search_device(self, query: str) -> List[int]:
+        """
+        Подстрочный поиск по столбцу 'Устройство' без учета регистра
+
+        Args:
+            query (str): Подстрока для поиска
+
+        Returns:
+            List[int]: Номера найденных записей в порядке следования в листе
+        """
+        if self._device_index is None:
+            self._build_device_index()
+        names = self._device_names
+        query = query.lower()
+
+        # Короткий запрос не раскладывается на n-граммы - проверяем все строки
+        if len(query) < NGRAM_SIZE:
+            return [row_id for row_id, name in enumerate(names) if query in name]
+
+        postings = []
+        for gram in _ngrams(query):
+            posting = self._device_index.get(gram)
+            if not posting:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+
+        # n-граммы могут совпасть и без вхождения подстроки - проверяем кандидатов
+        return sorted(row_id for row_id in candidates if query in names[row_id])
@@ -0,0 +1,124 @@
+import json
+import sqlite3
+from contextlib import closing
+from typing import Optional
+
+from sheets_snapshot import DEVICE_COLUMN, KEY_NORMALIZERS, SheetSnapshot
+
+# Версия схемы файла зеркала: при несовпадении таблицы пересоздаются
+SCHEMA_VERSION = 1
+
+_KEYS = ('phone', 'msisdn', 'iccid', 'imei')
+
+
+class SnapshotMirror:
+    """
+    Локальное зеркало последнего успешно загруженного снимка листа в SQLite.
+
+    После перезапуска процесс сразу отвечает по данным зеркала, а сверка с
+    Google Sheets идет в фоне: если версия файла в Drive совпадает с
+    сохраненной, лист вообще не скачивается. При недоступности Google
+    зеркало остается источником данных для /active.
+
+    Каждая проекция столбцов (например, LOOKUP_COLUMNS у ботов и весь лист)
+    хранится отдельно, чтобы процессы с разными проекциями не затирали друг
+    друга. Нормализованные ключи (phone, msisdn, iccid, imei) и название
+    устройства лежат в отдельных индексированных столбцах и доступны для
+    запросов к файлу напрямую.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Путь к файлу базы SQLite
+        """
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            self._create_schema(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Отдельное соединение на операцию: зеркало пишут фоновые потоки и соседние процессы
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _create_schema(self, conn: sqlite3.Connection) -> None:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            conn.execute('DROP TABLE IF EXISTS snapshot_rows')
+            conn.execute('DROP TABLE IF EXISTS snapshots')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                projection TEXT PRIMARY KEY,
+                headers TEXT NOT NULL,
+                revision TEXT,
+                fetched_at REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS snapshot_rows (
+                projection TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                phone TEXT,
+                msisdn TEXT,
+                iccid TEXT,
+                imei TEXT,
+                device TEXT,
+                PRIMARY KEY (projection, row_id)
+            )""")
+        for column in _KEYS + ('device',):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_snapshot_rows_{column} '
+                         f'ON snapshot_rows (projection, {column})')
+        conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def save(self, projection: str, snapshot: SheetSnapshot) -> None:
+        """
+        Заменяет сохраненный снимок проекции одним транзакционным обновлением
+
+        Args:
+            projection (str): Ключ проекции (см. GoogleSheetsProcessor._mirror_key)
+            snapshot (SheetSnapshot): Снимок для сохранения
+        """
+        key_positions = {}
+        for key in _KEYS:
+            column = snapshot._key_column(key)
+            key_positions[key] = snapshot.header_index.get(column) if column else None
+        device_position = snapshot.header_index.get(DEVICE_COLUMN)
+
+        def row_values(row_id, row):
+            keys = [KEY_NORMALIZERS[key](row[position]) if position is not None else None
+                    for key, position in key_positions.items()]
+            device = row[device_position].lower() if device_position is not None else None
+            return (projection, row_id, json.dumps(row, ensure_ascii=False), *keys, device)
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM snapshot_rows WHERE projection = ?', (projection,))
+            conn.executemany(
+                'INSERT INTO snapshot_rows (projection, row_id, data, phone, msisdn, iccid, imei, device) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (row_values(row_id, row) for row_id, row in enumerate(snapshot.rows)))
+            conn.execute(
+                'INSERT OR REPLACE INTO snapshots (projection, headers, revision, fetched_at) VALUES (?, ?, ?, ?)',
+                (projection, json.dumps(snapshot.headers, ensure_ascii=False), snapshot.revision,
+                 snapshot.fetched_at))
+
+    def load(self, projection: str) -> Optional[SheetSnapshot]:
+        """
+        Загружает сохраненный снимок проекции
+
+        Args:
+            projection (str): Ключ проекции
+
+        Returns:
+            Optional[SheetSnapshot]: Снимок с сохраненными версией и временем загрузки или None
+        """
+        with closing(self._connect()) as conn:
+            meta = conn.execute('SELECT headers, revision, fetched_at FROM snapshots WHERE projection = ?',
+                                (projection,)).fetchone()
+            if meta is None:
+                return None
+            rows = [json.loads(data) for (data,) in conn.execute(
+                'SELECT data FROM snapshot_rows WHERE projection = ? ORDER BY row_id', (projection,))]
+        headers, revision, fetched_at = meta
+        return SheetSnapshot(json.loads(headers), rows, fetched_at=fetched_at, revision=revision)
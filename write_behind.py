@@ -0,0 +1,222 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from api_quota import is_permanent_error
+
+
+class WriteBehindQueue:
+    """
+    Очередь отложенной записи в Google таблицу.
+
+    Каждая запись сначала дописывается в локальный журнал (JSON Lines, fsync),
+    поэтому после падения процесса неотправленные записи восстанавливаются при
+    следующем запуске. Фоновый поток отправляет накопленные записи пачками
+    (append_rows) - когда набралось batch_size записей или самая старая
+    ждет дольше flush_interval секунд. После успешной отправки журнал
+    перезаписывается атомарно без отправленных записей. Пачка, которую API
+    отклонил окончательно (4xx, кроме 429), не повторяется: она уходит в
+    файл недоставленных записей, ошибка видна в last_error, и очередь
+    продолжает отправлять следующие записи.
+
+    Доставка "как минимум один раз": если процесс упадет между отправкой
+    пачки и обновлением журнала, эта пачка будет отправлена повторно.
+    """
+
+    def __init__(self, journal_path: str, flush_func: Callable[[List[Any]], None],
+                 batch_size: int = 100, flush_interval: float = 5.0,
+                 dead_letter_path: Optional[str] = None):
+        """
+        Args:
+            journal_path (str): Путь к файлу журнала
+            flush_func (Callable[[List[Any]], None]): Отправляет пачку записей в таблицу
+            batch_size (int): Размер пачки, при котором отправка начинается сразу
+            flush_interval (float): Максимальное время ожидания записи в очереди, секунды
+            dead_letter_path (Optional[str]): Файл отклоненных API записей
+                (по умолчанию рядом с журналом, <журнал>.dead.jsonl)
+        """
+        self.journal_path = journal_path
+        if dead_letter_path is None:
+            dead_letter_path = os.path.splitext(journal_path)[0] + '.dead.jsonl'
+        self.dead_letter_path = dead_letter_path
+        self.flush_func = flush_func
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._condition = threading.Condition()
+        self._pending: List[dict] = []
+        self._next_seq = 1
+        self._durable_seq = 0
+        # Диапазоны номеров (первый, последний) пачек, ушедших в файл недоставленных
+        self._dead_ranges: List[Tuple[int, int]] = []
+        self._flush_requested = False
+        self.last_error: Optional[str] = None
+        self._stop = False
+        self._load_journal()
+        self._thread = threading.Thread(target=self._flush_loop, name='sheets-write-behind', daemon=True)
+        self._thread.start()
+
+    def _load_journal(self) -> None:
+        """
+        Восстанавливает неотправленные записи после перезапуска
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        torn = False
+        with open(self.journal_path, 'r', encoding='utf-8') as journal:
+            for line in journal:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Недописанная при падении последняя строка журнала
+                    torn = True
+                    continue
+                self._pending.append(entry)
+        if torn:
+            # Обрывок убираем до новых записей: иначе put допишет строку прямо к нему,
+            # и запись, подтвержденная как сохраненная, не прочитается при следующем запуске
+            self._rewrite_journal()
+        if self._pending:
+            self._next_seq = max(entry['seq'] for entry in self._pending) + 1
+            self._durable_seq = self._pending[0]['seq'] - 1
+            print(f"Восстановлено {len(self._pending)} неотправленных записей из {self.journal_path}")
+
+    def _rewrite_journal(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.journal_path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.write_queue.', suffix='.tmp', dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmp:
+            for entry in self._pending:
+                tmp.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def put(self, item: Any) -> int:
+        """
+        Ставит запись в очередь; возвращается после записи в локальный журнал
+
+        Args:
+            item (Any): Запись (должна сериализоваться в JSON)
+
+        Returns:
+            int: Порядковый номер записи для wait_durable
+        """
+        with self._condition:
+            entry = {'seq': self._next_seq, 'item': item, 'queued_at': time.time()}
+            # Номер занимается только после записи в журнал: запись, которая не
+            # сериализовалась или не записалась, не должна задерживать wait_durable
+            line = json.dumps(entry, ensure_ascii=False) + '\n'
+            with open(self.journal_path, 'a', encoding='utf-8') as journal:
+                journal.write(line)
+                journal.flush()
+                os.fsync(journal.fileno())
+            self._next_seq += 1
+            self._pending.append(entry)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+            return entry['seq']
+
+    def pending_count(self) -> int:
+        """
+        Сколько записей еще не отправлено в таблицу
+        """
+        with self._condition:
+            return len(self._pending)
+
+    def wait_durable(self, seq: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет, пока запись (по умолчанию - все поставленные) окажется в таблице
+
+        Args:
+            seq (Optional[int]): Номер записи из put
+            timeout (Optional[float]): Максимальное ожидание в секундах
+
+        Returns:
+            bool: True, если записи сохранены в таблице; False по таймауту или
+                если API отклонил запись и она ушла в файл недоставленных
+        """
+        with self._condition:
+            if seq is None:
+                return self._wait_processed(self._durable_seq + 1, self._next_seq - 1, timeout)
+            return self._wait_processed(seq, seq, timeout)
+
+    def _wait_processed(self, first: int, last: int, timeout: Optional[float]) -> bool:
+        # Вызывается под self._condition
+        if not self._condition.wait_for(lambda: self._durable_seq >= last, timeout):
+            return False
+        return not any(start <= last and first <= end for start, end in self._dead_ranges)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Отправляет все накопленные записи, не дожидаясь размера пачки или таймера
+
+        Returns:
+            bool: True, если все записи, поставленные до вызова, сохранены в таблице
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._wait_processed(self._durable_seq + 1, self._next_seq - 1, timeout)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Отправляет остаток очереди и останавливает фоновый поток
+        """
+        self.flush(timeout)
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+
+    def _ready_to_flush(self) -> bool:
+        if not self._pending:
+            return False
+        if self._flush_requested or len(self._pending) >= self.batch_size:
+            return True
+        return time.time() - self._pending[0]['queued_at'] >= self.flush_interval
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stop and not self._ready_to_flush():
+                    self._condition.wait(self.flush_interval)
+                if self._stop:
+                    return
+                batch = self._pending[:self.batch_size]
+            error = None
+            try:
+                self.flush_func([entry['item'] for entry in batch])
+            except Exception as e:
+                if not is_permanent_error(e):
+                    self.last_error = str(e)
+                    print(f"Ошибка отложенной записи в таблицу, повтор через {self.flush_interval} с: {e}")
+                    time.sleep(self.flush_interval)
+                    continue
+                error = str(e)
+                self._write_dead_letter(batch, error)
+            with self._condition:
+                del self._pending[:len(batch)]
+                self._durable_seq = batch[-1]['seq']
+                if error is not None:
+                    self._dead_ranges.append((batch[0]['seq'], batch[-1]['seq']))
+                if not self._pending:
+                    self._flush_requested = False
+                self.last_error = error
+                self._rewrite_journal()
+                self._condition.notify_all()
+
+    def _write_dead_letter(self, batch: List[dict], error: str) -> None:
+        """
+        Сохраняет отклоненную API пачку, чтобы ее можно было разобрать и отправить вручную
+        """
+        failed_at = time.time()
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as dead:
+            for entry in batch:
+                dead.write(json.dumps(dict(entry, error=error, failed_at=failed_at), ensure_ascii=False) + '\n')
+            dead.flush()
+            os.fsync(dead.fileno())
+        print(f"API отклонил {len(batch)} записей, они сохранены в {self.dead_letter_path}: {error}")